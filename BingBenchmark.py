@@ -0,0 +1,1018 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Bing Maps REST services and benchmarks of BingMapsDTExtract against it.
+No Bing Maps key or API quota is used: every request is answered by a small HTTP server running on localhost.
+
+List of functions:
+   >> bench_extractdtfrombing(n_pairs, latency, workers): wall-clock of the serial and concurrent extractdtfrombing
+       n_pairs  - Optional  :  number of (Source, Destination) couples to route (Int)
+       latency  - Optional  :  seconds the stub server waits before answering each request (Float)
+       workers  - Optional  :  list of worker counts to compare, 1 is the serial loop (List)
+   >> bench_transport(n_requests, latency): connections opened and requests per second with and without the keep-alive transport
+       n_requests  - Optional  :  number of requests sent by each client (Int)
+       latency     - Optional  :  seconds the stub server waits before answering each request (Float)
+   >> bench_ratelimiter(n_requests, throttleqps, workers): effective throughput against a stub server answering 429 above throttleqps
+       n_requests  - Optional  :  number of requests to get answered (Int)
+       throttleqps - Optional  :  requests per second above which the stub server answers 429 (Float)
+       workers     - Optional  :  number of requests in flight at the same time (Int)
+   >> bench_matrix(n_origins, n_destinations, latency): requests and wall-clock of the Distance Matrix mode vs pairwise routing
+       n_origins       - Optional  :  number of origins (Int)
+       n_destinations  - Optional  :  number of destinations (Int)
+   >> bench_errormask(n_rows, n_errors): building the error masks of 1M rows, list comprehension vs NumPy
+       n_rows      - Optional  :  number of rows (Int)
+       n_errors    - Optional  :  number of rows in error (Int)
+   >> bench_resultbuffers(n_rows): time and memory per row of Series.iloc writes vs preallocated typed arrays
+       n_rows      - Optional  :  number of rows (Int)
+   >> bench_storequeries(n_rows, chunksizes): rows per second of the SQL write paths (append, upsert) against SQLite
+       n_rows      - Optional  :  number of rows written (Int)
+       chunksizes  - Optional  :  executemany batch sizes to compare (List)
+   >> bench_cleanqueries(n_past, n_new, overlap): cleanqueries with the pandas merge vs the NOT EXISTS anti-join in SQLite, same results checked
+       n_past      - Optional  :  number of rows in the past queries table (Int)
+       n_new       - Optional  :  number of new queries (Int)
+       overlap     - Optional  :  share of the new queries already in the past table (Float)
+   >> bench_geocode(n_addresses, latency, jobdelay): wall-clock and requests of the one by one geocoding vs the Geocode Dataflow batch jobs
+       n_addresses - Optional  :  number of addresses to geocode (Int)
+       latency     - Optional  :  seconds the stub server waits before answering each request (Float)
+       jobdelay    - Optional  :  seconds a dataflow job stays Pending (Float)
+   >> bench_startup(runs): cold start of a worker process, import, construction and first pandas-free geocoding call, and the heavy modules loaded
+       runs        - Optional  :  number of fresh processes measured (Int)
+   >> bench_payload(n_requests, waypoints): bytes downloaded and JSON parsing time per Routes request, full answers vs minimal answers, json vs orjson
+       n_requests  - Optional  :  number of Routes requests sent per variant (Int)
+       waypoints   - Optional  :  number of waypoints per request (Int)
+   >> run_scenarios(sizes, scenarios, history, recordings, latency, errorrate, maxhttprows, tolerance): throughput and peak memory of every extract method and of
+      cleanqueries/storequeries at 1k/100k/1M rows, kept in a history file and compared with the previous run to flag regressions
+       sizes       - Optional  :  numbers of rows of each scenario (List)
+       history     - Optional  :  JSON lines file of the results of every run (Str)
+       recordings  - Optional  :  recorded Bing answers replayed by the stub server (Str)
+   >> recordbing(file, keyfile, couples, addresses): recording real Routes and Locations answers once, to be replayed by StubBingServer(recordings=file)
+
+Command line: python BingBenchmark.py runs the micro-benchmarks, python BingBenchmark.py --scenarios [names] --sizes 1000 100000 runs the scenarios
+"""
+
+import contextlib
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _StubBingHandler(BaseHTTPRequestHandler):
+    """ Private class. Answering Routes, Locations and Geocode Dataflow requests with synthetic but well formed Bing payloads. """
+
+    # HTTP/1.1 so that clients can keep the connection alive between requests
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately: without this, Nagle's algorithm adds ~40 ms to every keep-alive answer
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        # Silencing the default one line per request logging
+        pass
+
+    def _send(self, status, payload):
+        self._sendbody(status, json.dumps(payload).encode("utf-8"), "application/json; charset=utf-8")
+
+    def _sendbody(self, status, body, contenttype):
+        import gzip
+
+        self.send_response(status)
+        self.send_header("Content-Type", contenttype)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes += len(body)
+
+    def _throttle(self):
+        """ Private method. Server side token bucket: 429 when the request is over throttleqps, errorstatus when it is randomly picked to fail at errorrate, None otherwise """
+        import random
+
+        with self.server.lock:
+            if self.server.errorrate and random.random() < self.server.errorrate:
+                return self.server.errorstatus
+            if self.server.throttleqps is None:
+                return None
+            now = time.time()
+            bucket = self.server.bucket
+            bucket[0] = min(self.server.throttleqps, bucket[0] + (now - bucket[1]) * self.server.throttleqps)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return None
+            return 429
+
+    def _unauthorized(self):
+        """ Private method. Answering 401 as Bing does when the server only accepts one key and the request carries another one. True if it did """
+        if self.server.key is None:
+            return False
+        key = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get("key", [None])[0]
+        if key == self.server.key:
+            return False
+        self._send(401, {"errorDetails": ["Access was denied. You may have entered your credentials incorrectly"]})
+        return True
+
+    def _recorded(self, endpoint):
+        """ Private method. Next recorded resource of the endpoint ("routes" or "locations"), cycling through the recordings. None without recordings """
+        recorded = (self.server.recordings or {}).get(endpoint)
+        if not recorded:
+            return None
+        with self.server.lock:
+            self.server.replayed += 1
+            return recorded[self.server.replayed % len(recorded)]
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+
+        status = self._throttle()
+        if status is not None:
+            with self.server.lock:
+                self.server.throttled += 1
+            body = b'{"errorDetails": ["Too many requests"]}'
+            self.send_response(status)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if self._unauthorized():
+            return
+
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        path = url.path.lower()
+
+        if "/dataflows/geocode/" in path:
+            self._dataflowjob(path.split("/dataflows/geocode/")[1])
+
+        elif path.endswith("/routes/driving"):
+            n_wp = len([p for p in params if p.startswith("wp.")])
+            # Waypoints containing INVALID cannot be resolved, as Bing does for a bad address the whole request fails
+            if any("INVALID" in v[0] for p, v in params.items() if p.startswith("wp.")):
+                self._send(400, {"errorDetails": ["One or more waypoints could not be resolved"]})
+                return
+            # As Bing, the turn by turn itinerary is in every leg unless routeAttributes=excludeItinerary
+            itinerary = "excludeItinerary" not in params.get("routeAttributes", [""])[0]
+            recorded = self._recorded("routes")
+            if recorded is not None:
+                # A recorded route, with its legs repeated to match the number of waypoints asked
+                legs = [recorded["routeLegs"][leg % len(recorded["routeLegs"])] for leg in range(max(n_wp - 1, 0))]
+                if not itinerary:
+                    legs = [{k: v for k, v in leg.items() if k != "itineraryItems"} for leg in legs]
+                self._send(200, {"resourceSets": [{"resources": [dict(recorded, routeLegs=legs)]}]})
+                return
+            legs = [{"travelDuration": 60 * (leg + 1), "travelDistance": float(leg + 1),
+                     "actualStart": {"coordinates": [48.85 + leg / 100.0, 2.35]},
+                     "actualEnd": {"coordinates": [48.85 + (leg + 1) / 100.0, 2.35]}} for leg in range(max(n_wp - 1, 0))]
+            if itinerary:
+                for leg in legs:
+                    leg["itineraryItems"] = self._itinerary(leg)
+            self._send(200, {"resourceSets": [{"resources": [{"routeLegs": legs}]}]})
+
+        elif path.endswith("/locations"):
+            import zlib
+
+            # Addresses containing BADREQUEST are rejected, the ones containing INVALID are not found: Bing answers with no resource
+            if any("BADREQUEST" in v[0] for v in params.values()):
+                self._send(400, {"errorDetails": ["One or more parameters are not valid"]})
+                return
+            if any("INVALID" in v[0] for v in params.values()):
+                self._send(200, {"resourceSets": [{"resources": []}]})
+                return
+            resource = self._recorded("locations")
+            if resource is None:
+                country = params.get("countryRegion", ["France"])[0]
+                # Each free form query gets its own point in Paris
+                latitude = 48.8566 + (zlib.crc32(params["q"][0].encode("utf-8")) % 100) / 10000.0 if "q" in params else 48.8566
+                resource = {"point": {"coordinates": [round(latitude, 4), 2.3522]},
+                            "address": {"countryRegion": country, "adminDistrict": params.get("adminDistrict", ["IdF"])[0]},
+                            "confidence": "High"}
+            # Bing sends up to 5 candidates unless maxResults is given
+            self._send(200, {"resourceSets": [{"resources": [resource] * int(params.get("maxResults", ["5"])[0])}]})
+
+        else:
+            self._send(404, {"errorDetails": ["Unknown endpoint"]})
+
+    def _itinerary(self, leg, maneuvers = 15):
+        """ Private method. Synthetic turn by turn instructions of a leg, shaped like the itineraryItems of Bing """
+        latitude, longitude = leg["actualStart"]["coordinates"]
+        return [{"compassDirection": "north",
+                 "details": [{"compassDegrees": 12, "endPathIndices": [m + 1], "maneuverType": "TurnRight", "mode": "Driving",
+                              "names": ["Rue de Rivoli"], "roadType": "Street", "startPathIndices": [m]}],
+                 "exit": "", "iconType": "Auto",
+                 "instruction": {"formattedText": None, "maneuverType": "TurnRight", "text": "Turn right onto Rue de Rivoli"},
+                 "isRealTimeTransit": False,
+                 "maneuverPoint": {"type": "Point", "coordinates": [latitude + m / 1000.0, longitude]},
+                 "realTimeTransitDelay": 0, "sideOfStreet": "Unknown", "tollZone": "", "transitTerminus": "",
+                 "travelDistance": leg["travelDistance"] / maneuvers, "travelDuration": leg["travelDuration"] / maneuvers, "travelMode": "Driving"}
+                for m in range(maneuvers)]
+
+    def _jobresource(self, job):
+        """ Private method. Status resource of a dataflow job, with the output links once it is completed """
+        base = "http://%s%s/v1/Dataflows/Geocode/%s" % (self.headers.get("Host"), self.path[:self.path.lower().index("/v1/")], job["id"])
+        resource = {"id": job["id"], "status": "Pending", "links": [{"role": "self", "url": base}]}
+        if time.time() >= job["ready"]:
+            resource["status"] = "Completed"
+            resource["processedEntityCount"] = len(job["succeeded"]) + len(job["failed"])
+            resource["links"].append({"role": "output", "name": "succeeded", "url": base + "/output/succeeded"})
+            if job["failed"]:
+                resource["links"].append({"role": "output", "name": "failed", "url": base + "/output/failed"})
+        return resource
+
+    def _dataflowjob(self, tail):
+        """ Private method. Answering the status (<id>) and the result downloads (<id>/output/succeeded|failed) of a dataflow job """
+        parts = tail.split("/")
+        job = self.server.jobs.get(parts[0])
+        if job is None:
+            self._send(404, {"errorDetails": ["Unknown job"]})
+        elif len(parts) == 1:
+            self._send(200, {"resourceSets": [{"resources": [self._jobresource(job)]}]})
+        elif len(parts) == 3 and parts[1] == "output" and parts[2] in ("succeeded", "failed") and time.time() >= job["ready"]:
+            lines = ["Bing Spatial Data Services, 2.0", "|".join(job["header"])] + ["|".join(row) for row in job[parts[2]]]
+            self._sendbody(200, "\n".join(lines).encode("utf-8"), "text/plain; charset=utf-8")
+        else:
+            self._send(404, {"errorDetails": ["Unknown output"]})
+
+    def _createjob(self, text):
+        """ Private method. Creating a dataflow job from a pipe delimited upload: every address is found in Paris except the ones containing INVALID """
+        import uuid
+
+        lines = [line.split("|") for line in text.splitlines() if line.strip()]
+        header = lines[1]
+        column = {name: k for k, name in enumerate(header)}
+        job = {"id": uuid.uuid4().hex, "header": header, "ready": time.time() + self.server.jobdelay, "succeeded": [], "failed": []}
+
+        for row in lines[2:]:
+            row = row + [""] * (len(header) - len(row))
+            if "INVALID" in row[column["GeocodeRequest/Query"]]:
+                row[column["StatusCode"]] = "BadRequest"
+                row[column["FaultReason"]] = "No results found"
+                job["failed"].append(row)
+            else:
+                row[column["GeocodeResponse/Point/Latitude"]] = "48.8566"
+                row[column["GeocodeResponse/Point/Longitude"]] = "2.3522"
+                row[column["GeocodeResponse/Address/CountryRegion"]] = "France"
+                row[column["GeocodeResponse/Confidence"]] = "High"
+                row[column["StatusCode"]] = "Success"
+                job["succeeded"].append(row)
+
+        with self.server.lock:
+            self.server.jobs[job["id"]] = job
+        return job
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urllib.parse.urlsplit(self.path).path.lower()
+
+        if self._unauthorized():
+            return
+
+        if path.endswith("/dataflows/geocode"):
+            job = self._createjob(body.decode("utf-8"))
+            self._send(201, {"resourceSets": [{"resources": [self._jobresource(job)]}]})
+
+        elif path.endswith("/routes/distancematrix"):
+            payload = json.loads(body or b"{}")
+            origins = payload.get("origins", [])
+            destinations = payload.get("destinations", [])
+            if len(origins) * len(destinations) > 2500:
+                self._send(400, {"errorDetails": ["The number of origins x destinations must not exceed 2500"]})
+                return
+            cells = [{"originIndex": o, "destinationIndex": d, "travelDuration": 60.0 * (o + d + 1), "travelDistance": float(o + d + 1)}
+                     for o in range(len(origins)) for d in range(len(destinations))]
+            self._send(200, {"resourceSets": [{"resources": [{"results": cells}]}]})
+
+        else:
+            self._send(404, {"errorDetails": ["Unknown endpoint"]})
+
+
+class StubBingServer:
+    """ Local HTTP server standing in for dev.virtualearth.net and the Geocode Dataflow of spatial.virtualearth.net. Use as a context manager.
+    @params:
+        latency      - Optional  :  seconds waited before answering each request, to emulate the network round-trip (Float)
+        throttleqps  - Optional  :  requests per second above which the server answers 429 with Retry-After, None for no throttling (Float)
+        errorrate    - Optional  :  fraction of the GET requests randomly answered with errorstatus (Float)
+        jobdelay     - Optional  :  seconds a dataflow job stays Pending before it is Completed (Float)
+        recordings   - Optional  :  JSON file written by recordbing(): the Routes and Locations answers are replayed from it instead of synthetic ones (Str)
+        errorstatus  - Optional  :  HTTP status of the requests failed at errorrate (Int)
+        key          - Optional  :  the only Bing Maps key accepted, the other ones get 401. None accepts any key (Str)
+    """
+
+    def __init__(self, latency = 0.0, throttleqps = None, errorrate = 0.0, jobdelay = 0.0, recordings = None, errorstatus = 429, key = None):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _StubBingHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.throttleqps = throttleqps
+        self.httpd.errorrate = errorrate
+        self.httpd.bucket = [throttleqps or 0, time.time()]
+        self.httpd.throttled = 0
+        self.httpd.lock = threading.Lock()
+        self.httpd.requests = 0
+        self.httpd.connections = 0
+        self.httpd.bytes = 0
+        self.httpd.jobdelay = jobdelay
+        self.httpd.jobs = {}
+        self.httpd.errorstatus = errorstatus
+        self.httpd.key = key
+        self.httpd.replayed = 0
+        self.httpd.recordings = None
+        if recordings is not None:
+            with open(recordings) as f:
+                self.httpd.recordings = json.load(f)
+        self.url = "http://127.0.0.1:%d/REST" % self.httpd.server_address[1]
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def connections(self):
+        return self.httpd.connections
+
+    @property
+    def bytes(self):
+        return self.httpd.bytes
+
+    @property
+    def throttled(self):
+        return self.httpd.throttled
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def recordbing(file, keyfile, couples, addresses, bingurl = "http://dev.virtualearth.net/REST"):
+    """ Recording real Routes and Locations answers of Bing in a JSON file that StubBingServer(recordings=file) replays. This is the only function of the module using the API quota
+    @params:
+        file        - Required  :  JSON file written (Str)
+        keyfile     - Required  :  path to the file where the BingMapsKey is stored (Str)
+        couples     - Required  :  (Source, Destination) couples routed, one request each (List)
+        addresses   - Required  :  addresses geocoded, one request each (List)
+        bingurl     - Optional  :  root URL of the Bing Maps REST services (Str)
+    """
+    from BingDistanceTimeExtract import BingMapsDTExtract
+
+    key = open(keyfile, "r").read()
+    x = BingMapsDTExtract(bingurl=bingurl)
+    recordings = {"routes": [], "locations": []}
+
+    for source, destination in couples:
+        result = x._requestjson(bingurl + "/v1/Routes/Driving?wp.0=" + urllib.parse.quote(source, safe='') + "&wp.1=" + urllib.parse.quote(destination, safe='') + "&key=" + key)
+        recordings["routes"].append(result["resourceSets"][0]["resources"][0])
+
+    for address in addresses:
+        result = x._requestjson(bingurl + "/v1/Locations?q=" + urllib.parse.quote(address, safe='') + "&key=" + key)
+        recordings["locations"].append(result["resourceSets"][0]["resources"][0])
+
+    with open(file, "w") as f:
+        json.dump(recordings, f)
+
+    print("%d routes and %d locations recorded in %s" % (len(recordings["routes"]), len(recordings["locations"]), file))
+
+
+@contextlib.contextmanager
+def _keyfile():
+    """ Private function. Context manager writing a dummy Bing Maps key to a temporary file, yielding its path and deleting it on exit. """
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "key.txt")
+        with open(path, "w") as f:
+            f.write("BENCHMARKKEY")
+        yield path
+
+
+def _routequeries(extractor, n_pairs):
+    """ Private function. Filling the attributes that cleanqueries() would normally prepare with n_pairs synthetic couples. """
+    import pandas as pd
+
+    source = pd.Series(["Source address %d" % i for i in range(n_pairs)])
+    destination = pd.Series(["Destination address %d" % i for i in range(n_pairs)])
+    extractor.key = source.str.cat(others=destination, sep='+')
+    extractor.source = source
+    extractor.destination = destination
+    extractor.travelduration = pd.Series([0] * n_pairs)
+    extractor.traveldistance = pd.Series([0] * n_pairs)
+    extractor.flightdistance = pd.Series([0] * n_pairs)
+
+
+def bench_extractdtfrombing(n_pairs = 1200, latency = 0.05, workers = (1, 4, 8, 16)):
+    """ Comparing the wall-clock of extractdtfrombing for several numbers of requests in flight
+    @params:
+        n_pairs  - Optional  :  number of (Source, Destination) couples to route (Int)
+        latency  - Optional  :  seconds the stub server waits before answering each request (Float)
+        workers  - Optional  :  worker counts to compare, 1 is the serial loop (List)
+    """
+    from BingDistanceTimeExtract import BingMapsDTExtract
+
+    results = {}
+
+    with StubBingServer(latency=latency) as server, _keyfile() as keyfile:
+        for w in workers:
+            x = BingMapsDTExtract(bingurl=server.url)
+            _routequeries(x, n_pairs)
+
+            start = time.time()
+            x.extractdtfrombing(keyfile, workers=w)
+            results[w] = time.time() - start
+
+            print("workers=%-3d %8.2f s  %6d rows done  %4d rows in error" % (w, results[w], len(x.donequeries), len(x.errorqueries)))
+
+    serial = results.get(1)
+    if serial:
+        for w, elapsed in results.items():
+            print("workers=%-3d speed-up x%.1f" % (w, serial / elapsed))
+
+    return results
+
+
+def bench_transport(n_requests = 2000, latency = 0.0):
+    """ Comparing one urllib connection per request with the pooled keep-alive transport of BingMapsDTExtract
+    @params:
+        n_requests  - Optional  :  number of Locations requests sent by each client (Int)
+        latency     - Optional  :  seconds the stub server waits before answering each request (Float)
+    """
+    import urllib.request
+    from BingDistanceTimeExtract import _BingTransport
+
+    def urllib_get(url):
+        return urllib.request.urlopen(urllib.request.Request(url)).read()
+
+    results = {}
+
+    for name in ("urllib", "keep-alive", "keep-alive+gzip"):
+        with StubBingServer(latency=latency) as server:
+            if name == "urllib":
+                get = urllib_get
+            else:
+                transport = _BingTransport(gzip=name.endswith("gzip"))
+                get = transport.get
+
+            url = server.url + "/v1/Locations?q=Paris&key=BENCHMARKKEY"
+            start = time.time()
+            for i in range(n_requests):
+                get(url)
+            elapsed = time.time() - start
+
+            results[name] = {"connections": server.connections, "requests_per_second": n_requests / elapsed, "bytes": server.bytes}
+            print("%-16s %6d connections  %8.0f requests/s  %9d bytes received" % (name, server.connections, n_requests / elapsed, server.bytes))
+
+    return results
+
+
+def bench_ratelimiter(n_requests = 400, throttleqps = 50, workers = 8):
+    """ Effective throughput against a server throttling above throttleqps: no retry at all vs the adaptive rate limiter with backoff
+    @params:
+        n_requests  - Optional  :  number of Locations requests to get answered (Int)
+        throttleqps - Optional  :  requests per second above which the stub server answers 429 (Float)
+        workers     - Optional  :  number of requests in flight at the same time (Int)
+    """
+    from BingDistanceTimeExtract import BingMapsDTExtract
+
+    results = {}
+
+    for name in ("no retry", "adaptive+backoff"):
+        with StubBingServer(throttleqps=throttleqps) as server:
+            x = BingMapsDTExtract(bingurl=server.url, retries=8, backoff=0.2)
+            url = server.url + "/v1/Locations?q=Paris&key=BENCHMARKKEY"
+
+            # "no retry" is the behaviour before the rate limiter: each request is sent once, as fast as possible
+            send = x.transport.get if name == "no retry" else x._requestjson
+
+            start = time.time()
+            answered = sum(1 for item, result, error in x._runordered(lambda i: send(url), range(n_requests), workers) if error is None)
+            elapsed = time.time() - start
+
+            results[name] = {"answered": answered, "lost": n_requests - answered, "throttled": server.throttled,
+                             "effective_qps": answered / elapsed, "final_rate": x.ratelimiter.rate}
+            print("%-18s %5d answered  %5d lost  %5d throttled  %7.1f answered/s  final client rate %s" %
+                  (name, answered, n_requests - answered, server.throttled, answered / elapsed, x.ratelimiter.rate))
+
+    return results
+
+
+def bench_matrix(n_origins = 10, n_destinations = 300, latency = 0.1):
+    """ Comparing the Distance Matrix mode with the pairwise extractdtfrombing for every origin x destination: requests sent and wall-clock
+    @params:
+        n_origins       - Optional  :  number of origins (depots) (Int)
+        n_destinations  - Optional  :  number of destinations (sites) (Int)
+        latency         - Optional  :  seconds the stub server waits before answering each request (Float)
+    """
+    import pandas as pd
+    from BingDistanceTimeExtract import BingMapsDTExtract
+
+    origins = ["%.4f,%.4f" % (45 + i / 100.0, 2.0) for i in range(n_origins)]
+    destinations = ["%.4f,%.4f" % (46 + j / 1000.0, 3.0) for j in range(n_destinations)]
+    results = {}
+
+    with StubBingServer(latency=latency) as server, _keyfile() as keyfile:
+        x = BingMapsDTExtract(bingurl=server.url)
+        source = pd.Series([o for o in origins for d in destinations])
+        destination = pd.Series([d for o in origins for d in destinations])
+        x.key = source.str.cat(others=destination, sep='+')
+        x.source = source
+        x.destination = destination
+        x.travelduration = pd.Series([0] * len(source))
+        x.traveldistance = pd.Series([0] * len(source))
+        x.flightdistance = pd.Series([0] * len(source))
+
+        before = server.requests
+        start = time.time()
+        x.extractdtfrombing(keyfile)
+        results["pairwise"] = {"requests": server.requests - before, "seconds": time.time() - start}
+
+        before = server.requests
+        start = time.time()
+        x.extractmatrixfrombing(keyfile, origins, destinations)
+        x.matrixtoqueries()
+        results["matrix"] = {"requests": server.requests - before, "seconds": time.time() - start}
+
+    for name, r in results.items():
+        print("%-9s %6d requests  %8.2f s" % (name, r["requests"], r["seconds"]))
+
+    return results
+
+
+def bench_errormask(n_rows = 1000000, n_errors = 20000, sample = 20000):
+    """ Micro-benchmark of the result assembly: list comprehension over a list of error indexes vs the NumPy mask built from a set
+    @params:
+        n_rows      - Optional  :  number of rows of the batch (Int)
+        n_errors    - Optional  :  number of rows in error (Int)
+        sample      - Optional  :  rows on which the quadratic list comprehension is actually timed, then extrapolated to n_rows (Int)
+    """
+    import random
+    from BingDistanceTimeExtract import BingMapsDTExtract
+
+    error_list = random.sample(range(n_rows), n_errors)
+
+    start = time.time()
+    error_mask = [i not in error_list for i in range(sample)]
+    [not i for i in error_mask]
+    list_seconds = (time.time() - start) * n_rows / sample
+
+    x = BingMapsDTExtract()
+    x.error_indexes = set(error_list)
+
+    start = time.time()
+    error_mask = x._errormask(n_rows)
+    ~error_mask
+    numpy_seconds = time.time() - start
+
+    print("list comprehension %10.2f s (extrapolated from %d rows)" % (list_seconds, sample))
+    print("numpy mask         %10.4f s" % numpy_seconds)
+
+    return {"list": list_seconds, "numpy": numpy_seconds}
+
+
+def bench_resultbuffers(n_rows = 100000):
+    """ Writing geocoding results row by row: Series.iloc with formatted strings (previous path) vs preallocated typed arrays put in a DataFrame once
+    @params:
+        n_rows  - Optional  :  number of rows written (Int)
+    """
+    import numpy as np
+    import pandas as pd
+
+    coordinates = np.random.uniform(-90, 90, size=(n_rows, 2))
+    confidences = np.random.choice(["High", "Medium", "Low"], size=n_rows)
+
+    new = pd.DataFrame({'Latitude': 0, 'Longitude': 0, 'Confidence': 0}, index=range(n_rows))
+    latitude = new['Latitude'].copy()
+    longitude = new['Longitude'].copy()
+    confidence = new['Confidence'].copy()
+
+    start = time.time()
+    for i in range(n_rows):
+        latitude.iloc[i] = str("%.4f" % round(coordinates[i, 0], 4))
+        longitude.iloc[i] = str("%.4f" % round(coordinates[i, 1], 4))
+        confidence.iloc[i] = str(confidences[i])
+    series = pd.DataFrame({'Latitude': latitude, 'Longitude': longitude, 'Confidence': confidence})
+    series_seconds = time.time() - start
+
+    start = time.time()
+    latitude = np.zeros(n_rows, dtype='float64')
+    longitude = np.zeros(n_rows, dtype='float64')
+    confidence = np.array([None] * n_rows, dtype=object)
+    for i in range(n_rows):
+        latitude[i] = round(coordinates[i, 0], 4)
+        longitude[i] = round(coordinates[i, 1], 4)
+        confidence[i] = str(confidences[i])
+    arrays = pd.DataFrame({'Latitude': latitude, 'Longitude': longitude, 'Confidence': pd.Categorical(confidence)})
+    arrays_seconds = time.time() - start
+
+    series_bytes = series.memory_usage(deep=True).sum()
+    arrays_bytes = arrays.memory_usage(deep=True).sum()
+
+    print("Series.iloc + strings %8.2f s  %6.1f bytes/row" % (series_seconds, series_bytes / n_rows))
+    print("typed arrays          %8.2f s  %6.1f bytes/row" % (arrays_seconds, arrays_bytes / n_rows))
+
+    return {"series": (series_seconds, series_bytes), "arrays": (arrays_seconds, arrays_bytes)}
+
+
+def bench_storequeries(n_rows = 200000, chunksizes = (None, 1000, 10000)):
+    """ Rows per second of the storequeries write paths against a local SQLite database: plain append with several chunk sizes, then the staging table + merge upsert
+    @params:
+        n_rows      - Optional  :  number of result rows written (Int)
+        chunksizes  - Optional  :  executemany batch sizes to compare, None lets pandas send everything at once (List)
+    """
+    import os
+    import tempfile
+    import pandas as pd
+    import sqlalchemy
+    from BingDistanceTimeExtract import BingMapsDTExtract
+
+    x = BingMapsDTExtract()
+    source = pd.Series(["Source address %d" % i for i in range(n_rows)])
+    destination = pd.Series(["Destination address %d" % i for i in range(n_rows)])
+    x.donequeries = pd.DataFrame({'KeyID': source.str.cat(others=destination, sep='+'), 'Source': source, 'Destination': destination,
+                                  'TravelDuration': 600.0, 'TravelDistance': 10.0, 'FlightDistance': 8.0})
+    x.errorqueries = x.donequeries[['Source', 'Destination', 'FlightDistance']].head(0)
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as folder:
+        for chunksize in chunksizes:
+            engine = sqlalchemy.create_engine("sqlite:///" + os.path.join(folder, "append_%s.db" % chunksize))
+            x._storequeries(engine, "done", "errors", chunksize=chunksize)
+            results["append chunksize=%s" % chunksize] = x.storerowspersecond
+            engine.dispose()
+
+        # The upsert runs go through the shared engine: both runs must reuse the same pooled connections
+        x.openengine("sqlite:///" + os.path.join(folder, "upsert.db"))
+        for run in range(2):
+            x.storequeries(None, None, "done", "errors", upsert=True)
+            results["upsert run %d" % (run + 1)] = x.storerowspersecond
+
+        with x.engine.connect() as connection:
+            stored = connection.execute(sqlalchemy.text("SELECT COUNT(*) FROM done")).scalar()
+        print("upsert: %d rows in the table after 2 runs of %d rows" % (stored, n_rows))
+        x.enginestats()
+        x.closeengine()
+
+    for name, rows_per_second in results.items():
+        print("%-22s %10.0f rows/s" % (name, rows_per_second))
+
+    return results
+
+
+def bench_cleanqueries(n_past = 1000000, n_new = 10000, overlap = 0.5):
+    """ Time and rows transferred of cleanqueries: pandas merge with the whole history (getpastqueries) vs the NOT EXISTS anti-join in SQLite (getnetnewqueries).
+    Checks that both give the same net new and past sets
+    @params:
+        n_past      - Optional  :  number of rows in the past queries table (Int)
+        n_new       - Optional  :  number of new queries (Int)
+        overlap     - Optional  :  share of the new queries already in the past table (Float)
+    """
+    import os
+    import tempfile
+    import pandas as pd
+    from BingDistanceTimeExtract import BingMapsDTExtract
+
+    with tempfile.TemporaryDirectory() as folder:
+        url = "sqlite:///" + os.path.join(folder, "history.db")
+
+        source = pd.Series(["Source %d" % i for i in range(n_past)])
+        destination = pd.Series(["Destination %d" % i for i in range(n_past)])
+        past = pd.DataFrame({'KeyID': source.str.cat(others=destination, sep='+'), 'Source': source, 'Destination': destination,
+                             'TravelDuration': 600.0, 'TravelDistance': 10.0})
+
+        n_old = int(n_new * overlap)
+        new = pd.DataFrame({'Source': ["Source %d" % i for i in range(n_old)] + ["New source %d" % i for i in range(n_new - n_old)],
+                            'Destination': ["Destination %d" % i for i in range(n_old)] + ["New destination %d" % i for i in range(n_new - n_old)]})
+
+        x = BingMapsDTExtract()
+        x.openengine(url)
+        past.to_sql("past", con=x._getengine(), index=False)
+        new.to_sql("new", con=x._getengine(), index=False)
+
+        start = time.time()
+        x.getnewqueries(None, None, "SELECT Source, Destination FROM new")
+        x.getpastqueries(None, None, "SELECT * FROM past")
+        x.cleanqueries()
+        pandas_seconds = time.time() - start
+        pandas_rows = len(x.new) + len(x.past)
+        pandas_key, pandas_past = x.key.tolist(), x.pastqueries.copy()
+
+        del x.past
+        start = time.time()
+        x.getnetnewqueries(None, None, "SELECT Source, Destination FROM new", "past")
+        x.cleanqueries()
+        sql_seconds = time.time() - start
+        sql_rows = len(x.new)
+
+        assert x.key.tolist() == pandas_key
+        assert x.pastqueries.equals(pandas_past)
+
+        print("pandas merge      %8.2f s  %10d rows transferred" % (pandas_seconds, pandas_rows))
+        print("SQL NOT EXISTS    %8.2f s  %10d rows transferred (index created on the first call)" % (sql_seconds, sql_rows))
+        x.closeengine()
+
+    return {"pandas": pandas_seconds, "sql": sql_seconds}
+
+
+def bench_geocode(n_addresses = 2000, latency = 0.005, jobdelay = 1.0):
+    """ Wall-clock and requests of extractcoorfrombing_obo (one request per address) vs extractcoorfrombing_dataflow (batch jobs) against the stub server
+    @params:
+        n_addresses - Optional  :  number of addresses to geocode (Int)
+        latency     - Optional  :  seconds the stub server waits before answering each request (Float)
+        jobdelay    - Optional  :  seconds a dataflow job stays Pending (Float)
+    """
+    import pandas as pd
+    from BingDistanceTimeExtract import BingMapsDTExtract
+
+    addresses = pd.Series(["%d Main Street, Paris" % i for i in range(n_addresses)])
+    results = {}
+
+    for name in ("obo", "dataflow"):
+        with StubBingServer(latency=latency, jobdelay=jobdelay) as server, _keyfile() as key:
+            x = BingMapsDTExtract(bingurl=server.url, spatialurl=server.url)
+            x.address = addresses
+            start = time.time()
+            if name == "obo":
+                x.extractcoorfrombing_obo(key)
+            else:
+                x.extractcoorfrombing_dataflow(key, poll=0.2)
+            results[name] = time.time() - start
+            print("%-9s %8.2f s  %6d requests  %6d geocoded" % (name, results[name], server.requests, len(x.donequeries)))
+
+    return results
+
+
+_STARTUP = """
+import sys, time
+start = time.perf_counter()
+import BingDistanceTimeExtract
+imported = time.perf_counter()
+x = BingDistanceTimeExtract.BingMapsDTExtract(bingurl=sys.argv[1])
+constructed = time.perf_counter()
+x.geocodeaddresses(sys.argv[2], ["10 Main Street, Paris"])
+called = time.perf_counter()
+heavy = [m for m in ("pandas", "numpy", "sqlalchemy") if m in sys.modules]
+print(repr((imported - start, constructed - imported, called - constructed, heavy)))
+"""
+
+
+def bench_startup(runs = 5):
+    """ Cold start of a worker process: time to import the module, to build BingMapsDTExtract and to geocode a first address with the pandas-free geocodeaddresses(),
+    and the heavy modules loaded on the way. Compared with the import of pandas alone, the cost that the core path avoids
+    @params:
+        runs    - Optional  :  number of fresh processes measured, the median is reported (Int)
+    """
+    import ast
+    import os
+    import statistics
+    import subprocess
+    import sys
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    measures = []
+
+    with StubBingServer() as server, _keyfile() as keyfile:
+        for run in range(runs):
+            output = subprocess.run([sys.executable, "-c", _STARTUP, server.url, keyfile], cwd=folder, capture_output=True, text=True, check=True).stdout
+            measures.append(ast.literal_eval(output.strip().splitlines()[-1]))
+
+    importing, constructing, calling = (statistics.median(m[i] for m in measures) for i in range(3))
+    print("import BingDistanceTimeExtract %8.1f ms" % (importing * 1000))
+    print("BingMapsDTExtract()            %8.1f ms" % (constructing * 1000))
+    print("first geocodeaddresses() call  %8.1f ms" % (calling * 1000))
+    print("heavy modules loaded: %s" % (", ".join(measures[0][3]) or "none"))
+
+    pandas = subprocess.run([sys.executable, "-c", "import time; start = time.perf_counter(); import pandas; print(time.perf_counter() - start)"],
+                            capture_output=True, text=True)
+    if pandas.returncode == 0:
+        print("import pandas (avoided)        %8.1f ms" % (float(pandas.stdout) * 1000))
+
+    return {"import": importing, "construct": constructing, "firstcall": calling, "heavy": measures[0][3]}
+
+
+def bench_payload(n_requests = 200, waypoints = 25):
+    """ Bytes received and JSON decoding time per Routes request: full answers (itinerary included) vs the minimal ones asked by BingMapsDTExtract,
+    decoded with json and with orjson when it is installed
+    @params:
+        n_requests  - Optional  :  number of Routes requests sent per variant (Int)
+        waypoints   - Optional  :  number of waypoints per request (Int)
+    """
+    import importlib.util
+    from BingDistanceTimeExtract import BingMapsDTExtract
+
+    # orjson is only compared when it is installed
+    decoders = (False, True) if importlib.util.find_spec("orjson") is not None else (False,)
+
+    results = {}
+
+    for name, options in (("full", ""), ("minimal", BingMapsDTExtract.ROUTEOPTIONS)):
+        for fastjson in decoders:
+            label = name + ("+orjson" if fastjson else "+json")
+            with StubBingServer() as server:
+                x = BingMapsDTExtract(bingurl=server.url, fastjson=fastjson)
+                x.ROUTEOPTIONS = options
+                url = x._routeurl(["%d Main Street, Paris" % i for i in range(waypoints)], "BENCHMARKKEY")
+                start = time.time()
+                for i in range(n_requests):
+                    x._requestjson(url)
+                elapsed = time.time() - start
+                parse = x.metrics.histogram("bing_parse_seconds", endpoint="routes/driving")[0]
+                decoded = x.metrics.counter("bing_response_bytes_total", endpoint="routes/driving")
+
+            results[label] = {"wire_bytes": x.transport.bytes / n_requests, "bytes": decoded / n_requests,
+                              "parse_seconds": parse / n_requests, "requests_per_second": n_requests / elapsed}
+            print("%-16s %9.1f KB downloaded  %9.1f KB decoded  %8.3f ms parsing  %8.0f requests/s" % (label, x.transport.bytes / n_requests / 1024,
+                  decoded / n_requests / 1024, parse / n_requests * 1000, n_requests / elapsed))
+
+    return results
+
+
+# Scenarios of run_scenarios(), the ones sending one request per row are capped by maxhttprows
+SCENARIOS = ("cleanqueries", "storequeries", "extractdtfrombing", "extractmatrixfrombing", "extractcoorfrombing_dataflow",
+             "extractdtfrombing_obo", "extractcoorfrombing_obo", "extractcoorfrombing_obo_segmented")
+ONEREQUESTPERROW = ("extractdtfrombing_obo", "extractcoorfrombing_obo", "extractcoorfrombing_obo_segmented")
+
+
+def _scenario(name, x, keyfile, n_rows, folder):
+    """ Private function. Preparing x for a scenario of n_rows rows (not timed) and returning the function timed by run_scenarios() """
+    import os
+    import pandas as pd
+
+    if name in ("extractdtfrombing", "extractdtfrombing_obo"):
+        _routequeries(x, n_rows)
+        if name == "extractdtfrombing":
+            return lambda: x.extractdtfrombing(keyfile, workers=8)
+        return lambda: x.extractdtfrombing_obo(keyfile)
+
+    if name == "extractmatrixfrombing":
+        side = max(int(n_rows ** 0.5), 1)
+        points = ["%.4f,%.4f" % (48.0 + i / 1000.0, 2.0) for i in range(side)]
+        return lambda: x.extractmatrixfrombing(keyfile, points, points, workers=8)
+
+    if name in ("extractcoorfrombing_obo", "extractcoorfrombing_dataflow"):
+        x.address = pd.Series(["%d Main Street, Paris" % i for i in range(n_rows)])
+        if name == "extractcoorfrombing_obo":
+            return lambda: x.extractcoorfrombing_obo(keyfile)
+        return lambda: x.extractcoorfrombing_dataflow(keyfile, poll=0.1)
+
+    if name == "extractcoorfrombing_obo_segmented":
+        x.new = pd.DataFrame({'countryRegion': 'France', 'adminDistrict': 'IdF', 'locality': 'Paris', 'postalCode': '75001',
+                              'addressLine': ["%d Rue de Rivoli" % i for i in range(n_rows)]})
+        x.countryregion = x.new['countryRegion']
+        return lambda: x.extractcoorfrombing_obo_segmented(keyfile)
+
+    if name == "cleanqueries":
+        # Half of the new queries were already queried
+        new = pd.DataFrame({'Source': ["Source %d" % i for i in range(n_rows)], 'Destination': ["Destination %d" % i for i in range(n_rows)]})
+        past = new.iloc[::2]
+        x._setnewqueries(new)
+        x.past = pd.DataFrame({'KeyID': past['Source'].str.cat(others=past['Destination'], sep='+'), 'Source': past['Source'], 'Destination': past['Destination'],
+                               'TravelDuration': 600.0, 'TravelDistance': 10.0})
+        return lambda: x.cleanqueries()
+
+    if name == "storequeries":
+        source = pd.Series(["Source %d" % i for i in range(n_rows)])
+        destination = pd.Series(["Destination %d" % i for i in range(n_rows)])
+        x.donequeries = pd.DataFrame({'KeyID': source.str.cat(others=destination, sep='+'), 'Source': source, 'Destination': destination,
+                                      'TravelDuration': 600.0, 'TravelDistance': 10.0, 'FlightDistance': 8.0})
+        x.errorqueries = x.donequeries[['Source', 'Destination', 'FlightDistance']].head(0)
+        x.openengine("sqlite:///" + os.path.join(folder, "store_%d.db" % n_rows))
+        return lambda: x.storequeries(None, None, "done", "errors")
+
+    raise ValueError("Unknown scenario: " + name)
+
+
+def _gitcommit():
+    """ Private function. Commit of the working tree, None outside of a git repository """
+    import os
+    import subprocess
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scenarios(sizes = (1000, 100000, 1000000), scenarios = SCENARIOS, history = "benchmark_history.jsonl", recordings = None,
+                  latency = 0.0, errorrate = 0.0, maxhttprows = 100000, tolerance = 0.2):
+    """ Scripted scenarios of every extract method and of cleanqueries/storequeries against the stub server: throughput and peak memory (tracemalloc) per scenario and size.
+    Each result is appended to the history file and compared with the previous run of the same scenario and size
+    @params:
+        sizes       - Optional  :  numbers of rows of each scenario (List)
+        scenarios   - Optional  :  names of the scenarios to run, see SCENARIOS (List)
+        history     - Optional  :  JSON lines file keeping the results of every run, None not to keep them (Str)
+        recordings  - Optional  :  JSON file of recorded Bing answers replayed by the stub server, see recordbing() (Str)
+        latency     - Optional  :  seconds the stub server waits before answering each request (Float)
+        errorrate   - Optional  :  fraction of the requests answered with 429 (Float)
+        maxhttprows - Optional  :  sizes above which the scenarios sending one request per row are skipped (Int)
+        tolerance   - Optional  :  relative drop of throughput (or growth of peak memory) reported as a regression (Float)
+    """
+    import datetime
+    import os
+    import tempfile
+    import tracemalloc
+    from BingDistanceTimeExtract import BingMapsDTExtract
+
+    commit = _gitcommit()
+
+    previous = {}
+    if history is not None and os.path.exists(history):
+        with open(history) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    previous[(entry["scenario"], entry["rows"])] = entry
+
+    results = []
+
+    with _keyfile() as keyfile, tempfile.TemporaryDirectory() as folder:
+        for name in scenarios:
+            for n_rows in sizes:
+
+                if name in ONEREQUESTPERROW and n_rows > maxhttprows:
+                    print("%-34s %8d rows  skipped (one request per row, above maxhttprows)" % (name, n_rows))
+                    continue
+
+                with StubBingServer(latency=latency, errorrate=errorrate, recordings=recordings) as server:
+                    x = BingMapsDTExtract(bingurl=server.url, spatialurl=server.url, backoff=0.01)
+                    run = _scenario(name, x, keyfile, n_rows, folder)
+
+                    # The methods print a progress bar per row: silenced during the measure
+                    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                        tracemalloc.start()
+                        start = time.perf_counter()
+                        run()
+                        seconds = time.perf_counter() - start
+                        peak = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+
+                    if x.engine is not None:
+                        x.closeengine()
+
+                    entry = {"time": datetime.datetime.now().isoformat(timespec="seconds"), "commit": commit, "scenario": name, "rows": n_rows,
+                             "seconds": seconds, "rowspersecond": n_rows / seconds if seconds > 0 else float("inf"),
+                             "peakmb": peak / 2 ** 20, "requests": server.requests}
+
+                flags = []
+                last = previous.get((name, n_rows))
+                if last is not None:
+                    if entry["rowspersecond"] < last["rowspersecond"] * (1 - tolerance):
+                        flags.append("THROUGHPUT REGRESSION vs %s (%.0f rows/s)" % (last["commit"], last["rowspersecond"]))
+                    if entry["peakmb"] > last["peakmb"] * (1 + tolerance):
+                        flags.append("MEMORY REGRESSION vs %s (%.1f MB)" % (last["commit"], last["peakmb"]))
+                entry["regressions"] = flags
+
+                print("%-34s %8d rows %9.2f s %11.0f rows/s %8.1f MB peak %8d requests  %s" % (name, n_rows, seconds, entry["rowspersecond"], entry["peakmb"], entry["requests"], " ".join(flags)))
+
+                if history is not None:
+                    with open(history, "a") as f:
+                        f.write(json.dumps(entry) + "\n")
+
+                results.append(entry)
+
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmarks of BingMapsDTExtract against a local stand-in of Bing. Without arguments: the micro-benchmarks")
+    parser.add_argument("--scenarios", nargs="*", help="run the scripted scenarios (all of them when no name is given) instead of the micro-benchmarks")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 100000, 1000000], help="numbers of rows of each scenario")
+    parser.add_argument("--history", default="benchmark_history.jsonl", help="JSON lines file keeping the results of the scenarios")
+    parser.add_argument("--recordings", help="JSON file of recorded Bing answers, see recordbing()")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the stub server waits before each answer")
+    parser.add_argument("--errorrate", type=float, default=0.0, help="fraction of the requests answered with 429")
+    args = parser.parse_args()
+
+    if args.scenarios is not None:
+        run_scenarios(args.sizes, args.scenarios or SCENARIOS, args.history, args.recordings, args.latency, args.errorrate)
+    else:
+        bench_extractdtfrombing()
+        bench_transport()
+        bench_ratelimiter()
+        bench_matrix()
+        bench_errormask()
+        bench_resultbuffers()
+        bench_storequeries()
+        bench_cleanqueries()
+        bench_geocode()
+        bench_startup()
+        bench_payload()
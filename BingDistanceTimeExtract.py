@@ -5,10 +5,777 @@ Created on Wed Feb  6 13:13:28 2019
 @author: iasedric
 """
 
+class _BingTransport:
+    """ Private class. HTTP transport shared by all the Bing REST calls of BingMapsDTExtract.
+    Keeps the TCP connections alive and pools them per host so that consecutive (or concurrent) requests do not pay a new handshake each time.
+    
+    @params:
+        gzip            - Optional  :  asking the server for gzip encoded answers and decoding them (Bool)
+        maxconnections  - Optional  :  maximum number of idle connections kept per host (Int)
+        timeout         - Optional  :  socket timeout in seconds (Float)
+    
+    List of attributes:
+       >>self.connections  : number of TCP connections opened since the creation of the transport (Int)
+       >>self.requests     : number of requests sent since the creation of the transport (Int)
+       >>self.bytes        : number of body bytes received on the wire (before gzip decoding) since the creation of the transport (Int)
+       """
+
+    def __init__(self, gzip = True, maxconnections = 16, timeout = 60):
+        import threading
+
+        self.gzip = gzip
+        self.maxconnections = maxconnections
+        self.timeout = timeout
+        self.connections = 0
+        self.requests = 0
+        self.bytes = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, scheme, netloc):
+        """ Private method. Taking an idle connection from the pool or opening a new one. Returns (connection, reused) """
+        import http.client
+
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+            self.connections += 1
+
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout), False
+        return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _release(self, scheme, netloc, connection):
+        """ Private method. Giving a connection back to the pool, closing it if the pool is full """
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.maxconnections:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def get(self, url):
+        """ Sending a GET request and returning the (decoded) body as bytes. Raises urllib.error.HTTPError on a non 200 answer.
+        @params:
+            url     - Required  :  full request URL (Str)
+        """
+        return self.request(url)[0]
+
+    def request(self, url, data = None, contenttype = "application/json"):
+        """ Sending a GET request (POST when data is given) and returning ((decoded) body as bytes, response headers). Raises urllib.error.HTTPError on a non 2xx answer.
+        @params:
+            url         - Required  :  full request URL (Str)
+            data        - Optional  :  body to POST (Bytes)
+            contenttype - Optional  :  Content-Type of the body (Str)
+        """
+        import gzip
+        import http.client
+        import urllib.error
+        import urllib.parse
+
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        method = "GET" if data is None else "POST"
+        headers = {"Connection": "keep-alive"}
+        if self.gzip:
+            headers["Accept-Encoding"] = "gzip"
+        if data is not None:
+            headers["Content-Type"] = contenttype
+
+        connection, reused = self._acquire(parts.scheme, parts.netloc)
+        try:
+            try:
+                connection.request(method, path, body=data, headers=headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server may have closed an idle keep-alive connection: retrying once on a fresh one
+                if not reused:
+                    raise
+                connection.close()
+                with self._lock:
+                    self.connections += 1
+                connection.request(method, path, body=data, headers=headers)
+                response = connection.getresponse()
+
+            body = response.read()
+        except:
+            connection.close()
+            raise
+
+        with self._lock:
+            self.requests += 1
+            self.bytes += len(body)
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(parts.scheme, parts.netloc, connection)
+
+        if response.getheader("Content-Encoding", "") == "gzip":
+            body = gzip.decompress(body)
+
+        # 201 Created answers the creation of a dataflow job
+        if not 200 <= response.status < 300:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+        return body, response.headers
+
+    def close(self):
+        """ Closing all the idle connections """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class BingRunAborted(Exception):
+    """ Raised when every following request would fail the same way: the extract methods stop at once instead of flagging the remaining rows as errors,
+    so that the checkpoint journal is left intact for resumeextraction() """
+
+
+class BingQuotaExceeded(BingRunAborted):
+    """ Raised instead of sending a request once the daily quota given to BingMapsDTExtract is used up """
+
+
+class BingAuthenticationError(BingRunAborted):
+    """ Raised when Bing rejects the key (HTTP 401 or 403) """
+
+
+class _RateLimiter:
+    """ Private class. Token bucket shared by all the requests of a BingMapsDTExtract instance, with a daily quota.
+    The rate adapts to throttling: it is halved each time Bing throttles and grows back by about 1 request/s per second of successful requests (AIMD).
+    
+    @params:
+        qps         - Optional  :  maximum number of requests per second, None for no limit until Bing throttles (Float)
+        dailyquota  - Optional  :  maximum number of requests per (UTC) day, None for no quota (Int)
+    
+    List of attributes:
+       >>self.rate       : current number of requests per second allowed, None while unlimited (Float)
+       >>self.throttled  : number of throttling answers received (Int)
+       >>self.used       : number of requests sent today (Int)
+       """
+
+    def __init__(self, qps = None, dailyquota = None):
+        import threading
+        from collections import deque
+
+        self.qps = qps
+        self.dailyquota = dailyquota
+        self.rate = qps
+        self.throttled = 0
+        self.used = 0
+        self._day = None
+        self._tokens = 1.0
+        self._last = None
+        self._decreased = None
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Waiting until a request can be sent. Raises BingQuotaExceeded once the daily quota is used up """
+        import time
+
+        while True:
+            with self._lock:
+                now = time.time()
+
+                today = time.strftime("%Y-%m-%d", time.gmtime(now))
+                if today != self._day:
+                    self._day = today
+                    self.used = 0
+                if self.dailyquota is not None and self.used >= self.dailyquota:
+                    raise BingQuotaExceeded("Daily quota of " + str(self.dailyquota) + " requests used up")
+
+                # Requests sent during the last second, used to pick a starting rate when Bing throttles an unlimited client
+                self._recent.append(now)
+                while self._recent and self._recent[0] < now - 1:
+                    self._recent.popleft()
+
+                if self.rate is None:
+                    self.used += 1
+                    return
+
+                if self._last is not None:
+                    self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.used += 1
+                    return
+
+                self._recent.pop()
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+    def onthrottle(self):
+        """ Multiplicative decrease of the rate after a throttling answer. The requests in flight throttled together only count for one decrease """
+        import time
+
+        with self._lock:
+            self.throttled += 1
+            now = time.time()
+            if self._decreased is not None and now - self._decreased < 1:
+                return
+            self._decreased = now
+            if self.rate is None:
+                self.rate = max(len(self._recent), 1.0)
+            self.rate = max(self.rate / 2, 0.1)
+            self._tokens = min(self._tokens, 0.0)
+
+    def onsuccess(self):
+        """ Additive increase of the rate after a successful answer, never above qps """
+        with self._lock:
+            if self.rate is None:
+                return
+            ceiling = self.qps if self.qps is not None else float("inf")
+            self.rate = min(ceiling, self.rate + 1.0 / max(self.rate, 1.0))
+
+
+class _CentroidCache:
+    """ Private class. Memoized coordinates of the centre of countries and admin districts, keyed by (countryRegion, adminDistrict).
+    Country centroids are stored with an empty adminDistrict. The store can be persisted in a JSON file to be reused across runs.
+    
+    @params:
+        file    - Optional  :  path to the JSON file used to load and save the centroids (Str)
+       """
+
+    def __init__(self, file = None):
+        import threading
+
+        self.file = None
+        self.centroids = {}
+        self.failed = set()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if file is not None:
+            self.load(file)
+
+    def load(self, file):
+        """ Loading the centroids stored in file (if it exists) and using it for the next save() """
+        import json
+        import os
+
+        self.file = file
+        if os.path.exists(file):
+            with open(file, 'r', encoding='utf-8') as f:
+                for country, admindistrict, latitude, longitude in json.load(f):
+                    self.centroids[(country, admindistrict)] = (float(latitude), float(longitude))
+
+    def save(self):
+        """ Writing the centroids to the JSON file given to load(). Failed lookups are not persisted """
+        import json
+        import os
+
+        if self.file is None:
+            return
+        with self._lock:
+            rows = [[country, admindistrict, latitude, longitude] for (country, admindistrict), (latitude, longitude) in sorted(self.centroids.items())]
+        with open(self.file + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False)
+        os.replace(self.file + ".tmp", self.file)
+
+    def get(self, country, admindistrict, resolve):
+        """ Returning the (latitude, longitude) of the region, calling resolve() only the first time the region is seen. None if it could not be resolved
+        @params:
+            country         - Required  :  countryRegion of the region (Str)
+            admindistrict   - Required  :  adminDistrict of the region, "" for the whole country (Str)
+            resolve         - Required  :  function returning (latitude, longitude) or raising an exception
+        """
+        key = (country, admindistrict)
+        with self._lock:
+            if key in self.centroids:
+                self.hits += 1
+                return self.centroids[key]
+            if key in self.failed:
+                self.hits += 1
+                return None
+            self.misses += 1
+
+        try:
+            centroid = resolve()
+        except BingRunAborted:
+            raise
+        except Exception:
+            centroid = None
+
+        with self._lock:
+            if centroid is None:
+                self.failed.add(key)
+            else:
+                self.centroids[key] = centroid
+        return centroid
+
+
+class _RouteCache:
+    """ Private class. Local SQLite store of the routes already extracted, keyed on KeyID (Source+Destination).
+    Lookups go through the primary key index so history never has to be loaded in memory.
+    
+    @params:
+        file    - Required  :  path to the SQLite file (Str)
+        ttl     - Optional  :  number of days after which a stored travel time is considered stale and routed again (Float)
+       """
+
+    def __init__(self, file, ttl = None):
+        import sqlite3
+        import threading
+
+        self.file = file
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS routes (
+                                        KeyID TEXT PRIMARY KEY,
+                                        Source TEXT,
+                                        Destination TEXT,
+                                        TravelDuration REAL,
+                                        TravelDistance REAL,
+                                        FlightDistance REAL,
+                                        Created REAL)""")
+        self._connection.commit()
+
+    def _oldest(self):
+        """ Private method. Creation time below which a route is expired """
+        import time
+
+        if self.ttl is None:
+            return float("-inf")
+        return time.time() - self.ttl * 86400
+
+    def lookup(self, keys):
+        """ Returning {KeyID: (TravelDuration, TravelDistance, FlightDistance)} for the keys stored and not expired
+        @params:
+            keys    - Required  :  keys to look up (List)
+        """
+        keys = list(keys)
+        oldest = self._oldest()
+        found = {}
+
+        with self._lock:
+            # SQLite limits the number of parameters of a statement
+            for i in range(0, len(keys), 900):
+                chunk = keys[i:i+900]
+                rows = self._connection.execute("SELECT KeyID, TravelDuration, TravelDistance, FlightDistance FROM routes WHERE Created >= ? AND KeyID IN (%s)" % ",".join("?" * len(chunk)),
+                                                [oldest] + chunk)
+                for key, duration, distance, flight in rows:
+                    found[key] = (duration, distance, flight)
+        return found
+
+    def store(self, queries):
+        """ Adding (or refreshing) routes
+        @params:
+            queries - Required  :  Pandas Dataframe [KeyID],[Source],[Destination],[TravelDuration],[TravelDistance] and optionally [FlightDistance]
+        """
+        import time
+
+        now = time.time()
+        flight = queries['FlightDistance'] if 'FlightDistance' in queries else [None] * len(queries)
+        rows = [(str(key), source, destination, float(duration), float(distance), None if f is None else float(f), now)
+                for key, source, destination, duration, distance, f in zip(queries['KeyID'], queries['Source'], queries['Destination'],
+                                                                           queries['TravelDuration'], queries['TravelDistance'], flight)]
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._connection.commit()
+
+    def purge(self):
+        """ Deleting the expired routes and returning how many were deleted """
+        with self._lock:
+            deleted = self._connection.execute("DELETE FROM routes WHERE Created < ?", [self._oldest()]).rowcount
+            self._connection.commit()
+        return deleted
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class _GeocodeIndex:
+    """ Private class. Local SQLite index of the addresses already geocoded: address -> Latitude, Longitude, Country_check, Admdist_check, Confidence.
+    The table is clustered on the address (WITHOUT ROWID) and read through a memory map, so opening it does not depend on its size
+    and a lookup is one B-tree search.
+    
+    @params:
+        file    - Required  :  path to the SQLite file (Str)
+       """
+
+    def __init__(self, file):
+        import sqlite3
+        import threading
+
+        self.file = file
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA mmap_size=1073741824")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS addresses (
+                                        Address TEXT PRIMARY KEY,
+                                        Latitude REAL,
+                                        Longitude REAL,
+                                        Country TEXT,
+                                        AdminDistrict TEXT,
+                                        Confidence TEXT,
+                                        Created REAL) WITHOUT ROWID""")
+        self._connection.commit()
+
+    def get(self, address):
+        """ Returning (Latitude, Longitude, Country, AdminDistrict, Confidence) of one address, None if it is not indexed
+        @params:
+            address - Required  :  address key (Str)
+        """
+        with self._lock:
+            return self._connection.execute("SELECT Latitude, Longitude, Country, AdminDistrict, Confidence FROM addresses WHERE Address = ?", [address]).fetchone()
+
+    def lookup(self, addresses):
+        """ Returning {Address: (Latitude, Longitude, Country, AdminDistrict, Confidence)} for the addresses indexed
+        @params:
+            addresses   - Required  :  address keys to look up (List)
+        """
+        addresses = list(addresses)
+        found = {}
+
+        with self._lock:
+            # SQLite limits the number of parameters of a statement
+            for i in range(0, len(addresses), 900):
+                chunk = addresses[i:i+900]
+                rows = self._connection.execute("SELECT Address, Latitude, Longitude, Country, AdminDistrict, Confidence FROM addresses WHERE Address IN (%s)" % ",".join("?" * len(chunk)), chunk)
+                for row in rows:
+                    found[row[0]] = row[1:]
+        return found
+
+    def store(self, entries):
+        """ Adding (or refreshing) addresses
+        @params:
+            entries - Required  :  {Address: (Latitude, Longitude, Country, AdminDistrict, Confidence)} (Dict)
+        """
+        import time
+
+        now = time.time()
+        rows = [(str(address), float(lat), float(lon), country, admdist, confidence, now) for address, (lat, lon, country, admdist, confidence) in entries.items()]
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM addresses").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class _Journal:
+    """ Private class. Checkpoint journal of an extraction: one JSON line per completed batch (or group of results given to buffer()), appended and flushed to disk as soon as it is done.
+    The first line records the extract method so that the run can be resumed with resumeextraction().
+    
+    @params:
+        file    - Required  :  path to the journal file (Str)
+       """
+
+    def __init__(self, file):
+        import threading
+        import time
+
+        self.file = file
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flushed = time.monotonic()
+
+    def load(self):
+        """ Returning (method, {key: values}) for everything already recorded. A truncated last line (crash while writing) is ignored """
+        import json
+        import os
+
+        method = None
+        finished = {}
+        if not os.path.exists(self.file):
+            return method, finished
+
+        with open(self.file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if "method" in entry:
+                    method = entry["method"]
+                finished.update(entry.get("done", {}))
+        return method, finished
+
+    def start(self, method):
+        """ Recording the extract method at the top of a new journal """
+        import os
+
+        if not os.path.exists(self.file) or os.path.getsize(self.file) == 0:
+            self._append({"method": method})
+            return
+
+        # Terminating a line truncated by a crash so that the next entries are not glued to it
+        with open(self.file, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+    def record(self, done):
+        """ Recording the results of a completed batch
+        @params:
+            done    - Required  :  {key: values} (Dict)
+        """
+        if len(done) != 0:
+            self._append({"done": done})
+
+    def buffer(self, done, size = 500, seconds = 5.0):
+        """ Recording results one at a time without an fsync for each: they are written once size entries are waiting or seconds have passed since the last write.
+        flush() writes what is left
+        @params:
+            done    - Required  :  {key: values} (Dict)
+            size    - Optional  :  number of entries written together (Int)
+            seconds - Optional  :  maximum age of the entries waiting (Float)
+        """
+        import time
+
+        with self._lock:
+            self._pending.update(done)
+            due = len(self._pending) >= size or time.monotonic() - self._flushed >= seconds
+        if due:
+            self.flush()
+
+    def flush(self):
+        """ Writing the entries waiting in the buffer """
+        import time
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.monotonic()
+        self.record(pending)
+
+    def _append(self, entry):
+        """ Private method. Appending one line and forcing it to disk """
+        import json
+        import os
+
+        with self._lock:
+            with open(self.file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def clear(self):
+        """ Deleting the journal, once its results are safely stored """
+        import os
+
+        with self._lock:
+            if os.path.exists(self.file):
+                os.remove(self.file)
+
+
+class _AddressNormalizer:
+    """ Private class. Canonical form of the addresses used to build the keys of the routes and of the geocoded addresses,
+    so that "10 Main Ave., Paris" and " 10 main avenue  PARIS" share the same key: Unicode folding (accents removed, case folded),
+    punctuation replaced by spaces, whitespace collapsed and common street abbreviations unified.
+    Each distinct address is normalized once and remembered.
+    
+    List of attributes:
+       >>self.canonical  : canonical form of every address seen (Dict)
+       """
+    
+    # Only abbreviations that mean nothing else: St (Street/Saint), Ste (Suite/Sainte) and Dr (Drive/Doctor) are ambiguous,
+    # so Street, Suite, Drive and their abbreviations are kept as written
+    ABBREVIATIONS = {'avenue': 'ave', 'av': 'ave', 'avda': 'ave',
+                     'road': 'rd', 'boulevard': 'blvd', 'bd': 'blvd', 'bvd': 'blvd',
+                     'lane': 'ln', 'place': 'pl', 'square': 'sq', 'court': 'ct',
+                     'highway': 'hwy', 'parkway': 'pkwy', 'terrace': 'ter',
+                     'north': 'n', 'south': 's', 'east': 'e', 'west': 'w'}
+    
+    def __init__(self):
+        import re
+        
+        self.canonical = {}
+        self._punctuation = re.compile(r"[^\w]+|_")
+        
+    def normalize(self, address):
+        """ Canonical form of one address, non string values are returned unchanged """
+        import unicodedata
+        
+        if not isinstance(address, str):
+            return address
+        
+        canonical = self.canonical.get(address)
+        
+        if canonical is None:
+            folded = unicodedata.normalize('NFKD', address.casefold())
+            folded = "".join(c for c in folded if not unicodedata.combining(c))
+            words = self._punctuation.sub(" ", folded).split()
+            canonical = " ".join(self.ABBREVIATIONS.get(w, w) for w in words)
+            self.canonical[address] = canonical
+            
+        return canonical
+    
+    def normalizeall(self, addresses):
+        """ Canonical form of a Pandas Series of addresses, each distinct value is normalized once """
+        import pandas as pd
+        
+        uniques = addresses.unique()
+        
+        return addresses.map(pd.Series([self.normalize(a) for a in uniques], index=uniques))
+
+
+class _Metrics:
+    """ Private class. Counters and latency histograms of a run, shared by all the methods of BingMapsDTExtract and exported with exportmetrics().
+    Every series is a metric name plus labels (e.g. endpoint="routes/driving"), the histograms use fixed buckets in seconds as Prometheus does.
+    
+    List of attributes:
+       >>self.counters   : {name: {labels: value}} (Dict)
+       >>self.histograms : {name: {labels: [bucket counts, sum, count, max]}} (Dict)
+       """
+    
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0, float("inf"))
+    
+    def __init__(self):
+        import threading
+        
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        
+    def inc(self, name, value = 1, **labels):
+        """ Adding value to a counter """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+            
+    def observe(self, name, seconds, **labels):
+        """ Adding a duration to a histogram """
+        import bisect
+        
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [[0] * len(self.BUCKETS), 0.0, 0, 0.0]
+            histogram[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            histogram[3] = max(histogram[3], seconds)
+            
+    def timer(self, name, **labels):
+        """ Context manager adding the duration of its block to a histogram, and counting the blocks ending with an exception in name_errors """
+        import contextlib
+        import time
+        
+        @contextlib.contextmanager
+        def timing():
+            start = time.perf_counter()
+            try:
+                yield
+            except BaseException:
+                self.inc(name.replace("_seconds", "") + "_errors_total", **labels)
+                raise
+            finally:
+                self.observe(name, time.perf_counter() - start, **labels)
+                
+        return timing()
+    
+    def counter(self, name, **labels):
+        """ Returning the value of a counter, 0 if it was never incremented """
+        with self._lock:
+            return self.counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+        
+    def histogram(self, name, **labels):
+        """ Returning (sum, count) of a histogram, (0.0, 0) if nothing was observed """
+        with self._lock:
+            histogram = self.histograms.get(name, {}).get(tuple(sorted(labels.items())))
+        return (0.0, 0) if histogram is None else (histogram[1], histogram[2])
+    
+    def quantile(self, histogram, q):
+        """ Estimating a quantile of a histogram by linear interpolation inside its bucket """
+        buckets, total, count, largest = histogram
+        rank = q * count
+        cumulative = 0
+        lower = 0.0
+        
+        for upper, n in zip(self.BUCKETS, buckets):
+            if n != 0 and cumulative + n >= rank:
+                upper = min(upper, largest)
+                return lower + (upper - lower) * (rank - cumulative) / n
+            cumulative += n
+            lower = upper
+            
+        return largest
+    
+    def snapshot(self):
+        """ Returning the counters and the histograms (count, sum, mean, p50, p90, p99, max) as a dictionary that can be dumped in JSON """
+        with self._lock:
+            counters = {name: [dict(labels, value=value) for labels, value in series.items()] for name, series in self.counters.items()}
+            histograms = {name: [dict(labels, count=h[2], sum=h[1], mean=h[1] / h[2] if h[2] else 0.0,
+                                      p50=self.quantile(h, 0.5), p90=self.quantile(h, 0.9), p99=self.quantile(h, 0.99), max=h[3])
+                                 for labels, h in series.items()] for name, series in self.histograms.items()}
+        return {'counters': counters, 'histograms': histograms}
+    
+    def prometheus(self):
+        """ Returning the metrics in the Prometheus text exposition format """
+        
+        def labelstext(labels, extra = ()):
+            labels = list(labels) + list(extra)
+            if len(labels) == 0:
+                return ""
+            return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+        
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append("# TYPE " + name + " counter")
+                for labels, value in series.items():
+                    lines.append(name + labelstext(labels) + " " + repr(value))
+            for name, series in sorted(self.histograms.items()):
+                lines.append("# TYPE " + name + " histogram")
+                for labels, (buckets, total, count, largest) in series.items():
+                    cumulative = 0
+                    for upper, n in zip(self.BUCKETS, buckets):
+                        cumulative += n
+                        lines.append(name + "_bucket" + labelstext(labels, [("le", "+Inf" if upper == float("inf") else repr(upper))]) + " " + str(cumulative))
+                    lines.append(name + "_sum" + labelstext(labels) + " " + repr(total))
+                    lines.append(name + "_count" + labelstext(labels) + " " + str(count))
+        return "\n".join(lines) + "\n"
+    
+    
+def _instrumented(method):
+    """ Private decorator. Timing a method of BingMapsDTExtract as a stage of the run: stage_seconds{stage=<method>} and stage_errors_total """
+    import functools
+    
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.timer("stage_seconds", stage=method.__name__):
+            return method(self, *args, **kwargs)
+        
+    return wrapper
+
+
 class BingMapsDTExtract:
     """ Class used to get the travel distances and times between two addresses.
     
     List of methods:
+       >> openengine(url, poolsize, maxoverflow): Setting the database shared by all the SQL methods, created lazily with a connection pool
+           url          - Required  :  any SQLAlchemy URL (Str)
+           poolsize     - Optional  :  number of connections kept open (Int)
+           maxoverflow  - Optional  :  number of extra connections allowed when the pool is exhausted (Int)
+       >> closeengine(): Closing the connections of the shared engine
+       >> enginestats(): Statistics of the connection pool (connections opened, checkouts, checked in/out)
+       NB: In the SQL methods below, server can also be a full SQLAlchemy URL (db is then ignored) or None to use the URL given to openengine()
+       >> exportmetrics(file, format): Writing the counters and latency histograms of the run (stages, Bing requests per endpoint/status, bytes, retries, cache hits, SQL rows) in JSON or Prometheus text format
+           file         - Optional  :  path of the file written (Str)
+           format       - Optional  :  "json" or "prometheus" (Str)
        >> getnewqueries(server,db,query): Extracting new source and destination information from SQL Server
            server   - Required  :  SQL Server name (Str)
            db:      - Required  :  Data Base name (Str)
@@ -24,28 +791,127 @@ class BingMapsDTExtract:
            db:      - Required  :  Data Base name (Str)
            query    - Required  : SQL query (Str)
            NB: This methods expects to receive one column: [Adresses]   
-       >>cleanqueries(): Checking the new and past queries to select the net new ones and the ones that were already queried in the past
-       >>extractdtfrombing(file): Extracting the TravelDuration and TravelTime using BingAPI
+       >>getnetnewqueries(server, db, query, pasttable, createindex): Same as getnewqueries() with the anti-join against the past queries done in SQL (NOT EXISTS), replaces getpastqueries()
+           pasttable    - Required  :  table holding the past queries and their [KeyID] (Str)
+           createindex  - Optional  :  creating an index on pasttable.[KeyID] if missing (Bool)
+       >>openroutecache(file, ttl): Opening the local SQLite route cache used by cleanqueries() and filled by the extract methods
+           file     - Required  :   path to the SQLite file (Str)
+           ttl      - Optional  :   number of days after which a cached travel time is routed again (Float)
+       >>cleanqueries(symmetric, mindistance): Checking the new and past queries to select the net new ones and the ones that were already queried in the past
+           symmetric    - Optional  :   reusing a known B > A route for A > B and routing each unordered couple once per run, flagged by a [Reversed] column (Bool)
+           mindistance  - Optional  :   a B > A route is only reused if it is at least mindistance km long (Float)
+       >>computeflightdistance(maxdistance): Computing the FlightDistance of couples given as coordinates and flagging the ones that do not need a route
+           maxdistance  - Optional  :   couples further apart than this flight distance (km) are not routed (Float)
+       >>extractdtfrombing(file, workers, journal): Extracting the TravelDuration and TravelTime using BingAPI
            file     - Required  :   path to the file where the BingMapsKey is stored (Str)
+           workers  - Optional  :   number of requests in flight at the same time (Int)
+           journal  - Optional  :   path to a checkpoint journal recording each completed batch (Str)
        >>extractdtfrombing_obo(file): Extracting the TravelDuration and TravelTime using BingAPI one by one (one couple at a time)
            file     - Required  :   path to the file where the BingMapsKey is stored (Str)
-       >>extractcoorfrombing_obo(file):Extracting the Latitude and Longitude using BingAPI one by one (obo)
-            file     - Required  :   path to the file where the BingMapsKey is stored (Str)
+       >>extractmatrixfrombing(file, origins, destinations, workers): Extracting the TravelDuration and TravelDistance of every origin x destination with the Distance Matrix API
+           origins      - Required  :   "latitude,longitude" of the origins (List)
+           destinations - Required  :   "latitude,longitude" of the destinations (List)
+       >>matrixtoqueries(): Flattening the matrix into donequeries/errorqueries
+       >>extractcoorfrombing_obo(file, centroidfile, journal):Extracting the Latitude and Longitude using BingAPI one by one (obo)
+            file            - Required  :   path to the file where the BingMapsKey is stored (Str)
+            centroidfile    - Optional  :   JSON file where the country/state centroids are kept across runs (Str)
         '''
-       >>storequeries(server, db, table_done, table_errors): Storing the results and errors in SQL
+       >>extractcoorfrombing_dataflow(file, centroidfile, jobsize, poll, timeout): Same outputs as extractcoorfrombing_obo() with the addresses geocoded in batch jobs of the Bing Spatial Data Services Geocode Dataflow
+            jobsize         - Optional  :   number of addresses per job, 200 000 at most (Int)
+            poll            - Optional  :   seconds between two status requests (Float)
+            timeout         - Optional  :   seconds after which the pending jobs are given up (Float)
+       >>geocodeaddresses(file, addresses, workers): Pandas-free geocoding of a list of addresses returning a list of (Latitude, Longitude, Country_check, Country_check latitude, Country_check longitude, Confidence)
+            addresses       - Required  :   addresses to geocode (List)
+       >>opengeocodeindex(file): Opening the local SQLite geocode index checked by the extractcoorfrombing methods before any request and filled with their results
+            file            - Required  :   path to the SQLite file (Str)
+       >>seedgeocodeindex(server, db, query, chunksize): Filling the geocode index with the geocoding results stored in SQL by storequeries()
+       >>selectshard(shard, shards, unordered): Keeping only the new queries of one shard (crc32 of the key modulo shards), between getnewqueries() and cleanqueries()
+       >>mergeshards(server, db, table, shards, upsert): Merging the tables written by the shards of a batch into table
+       >>storequeries(server, db, table_done, table_errors, chunksize, upsert): Storing the results and errors in SQL
             server          - Required  :  SQL Server name (Str)
             db:             - Required  :  Data Base name (Str)
             table_done:     - Required  :  Table name to store the good results (Str)
             table_errors:   - Required  :  Table name to store the errors (Str)
+            chunksize       - Optional  :  number of rows sent per executemany batch (Int)
+            upsert          - Optional  :  merging on the key through a staging table so that re-runs do not duplicate keys (Bool)
+       >>resumeextraction(file, journal): Resuming an interrupted extractdtfrombing or extractcoorfrombing_obo from its checkpoint journal
+            journal         - Required  :  path to the checkpoint journal (Str)
+       >>streamqueries(file, server, db, query, table_done, table_errors, chunksize, workers, maxdistance, symmetric, shard, shards, upsert): Full pipeline run chunk by chunk with bounded memory
+            chunksize       - Optional  :  number of new queries read, routed and stored at a time (Int)
 
     List of attributes:
+       >>self.centroids    : cache of the country/state centroids used by the geocoding methods, shared by all the calls of the instance
+       >>self.routecache   : local route cache opened by openroutecache(), None otherwise
+       >>self.geocodeindex : local geocode index opened by opengeocodeindex(), None otherwise
+       >>self.failedjobs   : ids of the dataflow jobs that failed, were aborted or given up in the last extractcoorfrombing_dataflow(), their addresses are in errorqueries
+       >>self.ratelimiter  : token bucket and daily quota shared by all the requests, self.ratelimiter.rate and self.ratelimiter.throttled show how Bing throttles the run
+       >>self.normalizer   : address normalizer used for the keys when the instance is created with normalize=True, None otherwise
+       >>self.keystats     : hit-rate statistics of the last cleanqueries(): queries, known (couples not routed again), hitrate, keys
+                             (and when normalizing rawkeys and normalizedhits, the known couples that their raw key would have routed again)
+       >>self.metrics      : counters and latency histograms of the run, see exportmetrics()
+       >>self.jsonloads    : JSON decoder of the answers, orjson.loads when installed and fastjson=True, json.loads otherwise (set at the first answer)
+       >>self.bytesperbatch: bytes of route answer per request in the last extractdtfrombing() once gzip decoded, with self.wirebytesperbatch (before decoding) and self.parsesecondsperbatch
+       >>self.engine       : SQLAlchemy engine shared by all the SQL methods, None until the first SQL call
+       >>self.transport    : HTTP transport shared by all the extract methods, self.transport.connections, self.transport.requests and self.transport.bytes count the connections opened, requests sent and bytes received
        >>self.donequeries  : queries for which the travel distance and time was calculated. Pandas Dataframe [KeyID],[Source],[Destination],[TravelDuration] and [TravelDistance]
        >>self.errorqueries : queries that resulted in an error message from Bing API. Pandas Dataframe [Source] and [Destination]
        >>self.pastqueries  : queries already done in the past. Pandas Dataframe [KeyID],[Source],[Destination],[TravelDuration] and [TravelDistance]
        """
        
-    def __init__(self):
-        print("Use __doc__ attribute to get the list of attributes and methods for this class")
+    # Smallest answers the APIs can give for what the extract methods read: no itinerary (maneuvers) in the route legs, a single route and a single location
+    ROUTEOPTIONS = "&routeAttributes=excludeItinerary&maxSolutions=1"
+    LOCATIONOPTIONS = "&maxResults=1"
+    
+    # Fields of the Geocode Dataflow input and output files (data schema 2.0), the first three are filled in the input
+    GEOCODEFIELDS = ["Id", "GeocodeRequest/Culture", "GeocodeRequest/Query",
+                     "GeocodeResponse/Address/CountryRegion", "GeocodeResponse/Confidence",
+                     "GeocodeResponse/Point/Latitude", "GeocodeResponse/Point/Longitude",
+                     "StatusCode", "FaultReason"]
+    
+    def __init__(self, bingurl = "http://dev.virtualearth.net/REST", gzip = True, maxconnections = 16, qps = None, dailyquota = None, retries = 5, backoff = 1.0, normalize = False,
+                 spatialurl = "http://spatial.virtualearth.net/REST", fastjson = True):
+        """
+        @params:
+            bingurl         - Optional  : root URL of the Bing Maps REST services, can point to a local stand-in server (Str)
+            gzip            - Optional  : asking Bing for gzip encoded answers (Bool)
+            maxconnections  - Optional  : maximum number of idle keep-alive connections kept in the pool (Int)
+            qps             - Optional  : maximum number of requests per second, None for no limit until Bing throttles (Float)
+            dailyquota      - Optional  : maximum number of requests sent per day (Int)
+            retries         - Optional  : number of retries of a request throttled by Bing or failing on the network (Int)
+            backoff         - Optional  : base delay in seconds of the jittered exponential backoff between retries (Float)
+            normalize       - Optional  : building the route keys from normalized addresses and geocoding each normalized address once (Bool)
+            spatialurl      - Optional  : root URL of the Bing Spatial Data Services used by the dataflow geocoding, can point to a local stand-in server (Str)
+            fastjson        - Optional  : decoding the answers with orjson when it is installed, json otherwise (Bool)
+        """
+        import sys
+        
+        # The banner is for interactive sessions only, not for scripts and short-lived shard workers
+        if hasattr(sys, 'ps1') or sys.flags.interactive:
+            print("Use __doc__ attribute to get the list of attributes and methods for this class")
+        self.bingurl = bingurl
+        self.spatialurl = spatialurl
+        self.transport = _BingTransport(gzip=gzip, maxconnections=maxconnections)
+        self.ratelimiter = _RateLimiter(qps, dailyquota)
+        self.retries = retries
+        self.backoff = backoff
+        self.centroids = _CentroidCache()
+        self.routecache = None
+        self.geocodeindex = None
+        self.failedjobs = []
+        self.journal = None
+        self.engine = None
+        self.engineurl = None
+        self.poolsize = 5
+        self.maxoverflow = 10
+        self.sqlconnections = 0
+        self.sqlcheckouts = 0
+        self.netnew = None
+        self.duplicatequeries = None
+        self.normalizer = _AddressNormalizer() if normalize else None
+        self.keystats = {}
+        self.metrics = _Metrics()
+        self.fastjson = fastjson
+        self.jsonloads = None
         
     def _printprogressbar (self,iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█'):
         """
@@ -73,7 +939,368 @@ class BingMapsDTExtract:
         if iteration == total: 
             print()
 
+    def _requestjson(self, url, payload = None):
+        """
+        Private method. Sending a GET request to the Bing API through the shared keep-alive transport and rate limiter and decoding the JSON answer.
+        Throttled (429/503) and failed requests are retried with a jittered exponential backoff honoring Retry-After
+        @params:
+            url         - Required  : full request URL including the key (Str)
+            payload     - Optional  : object sent as a JSON body in a POST request (Dict)
+        """
+        import json
+
+        data = None if payload is None else json.dumps(payload).encode("utf-8")
+        
+        # Decoder picked at the first answer: orjson parses the bytes directly and several times faster than json
+        if self.jsonloads is None:
+            self.jsonloads = json.loads
+            if self.fastjson:
+                try:
+                    import orjson
+                    self.jsonloads = orjson.loads
+                except ImportError:
+                    pass
+        
+        return self._request(url, data, parse=self.jsonloads)
         
+    def _request(self, url, data = None, contenttype = "application/json", parse = None):
+        """
+        Private method. Sending a request to the Bing API through the shared keep-alive transport and rate limiter, with the retries of _requestjson()
+        @params:
+            url         - Required  : full request URL including the key (Str)
+            data        - Optional  : body sent in a POST request (Bytes)
+            contenttype - Optional  : Content-Type of the body (Str)
+            parse       - Optional  : function applied to the (gzip decoded) bytes of the answer, a failure is retried like a truncated answer. None returns the bytes (Function)
+        """
+        import random
+        import time
+        import urllib.error
+        import urllib.parse
+
+        attempt = 0
+        
+        # Label of the metrics: "routes/driving", "locations", "dataflows/geocode"...
+        endpoint = "/".join(urllib.parse.urlsplit(url).path.lower().split("/v1/")[-1].split("/")[:2])
+        
+        while True:
+            
+            start = time.perf_counter()
+            self.ratelimiter.acquire()
+            self.metrics.observe("bing_ratelimiter_wait_seconds", time.perf_counter() - start, endpoint=endpoint)
+            retry_after = 0
+            
+            try:
+                start = time.perf_counter()
+                try:
+                    body, headers = self.transport.request(url, data, contenttype)
+                finally:
+                    self.metrics.observe("bing_request_seconds", time.perf_counter() - start, endpoint=endpoint)
+                    
+                self.metrics.inc("bing_response_bytes_total", len(body), endpoint=endpoint)
+                
+                # Bing answers a throttled request with an empty 200 and this header
+                if headers.get("X-MS-BM-WS-INFO", "0") != "1":
+                    self.ratelimiter.onsuccess()
+                    result = body
+                    if parse is not None:
+                        start = time.perf_counter()
+                        result = parse(body)
+                        self.metrics.observe("bing_parse_seconds", time.perf_counter() - start, endpoint=endpoint)
+                    self.metrics.inc("bing_requests_total", endpoint=endpoint, status="200")
+                    return result
+                
+                self.ratelimiter.onthrottle()
+                self.metrics.inc("bing_requests_total", endpoint=endpoint, status="throttled")
+                error = urllib.error.HTTPError(url, 200, "Throttled (X-MS-BM-WS-INFO)", headers, None)
+                
+            except urllib.error.HTTPError as e:
+                self.metrics.inc("bing_requests_total", endpoint=endpoint, status=str(e.code))
+                # A rejected key fails every request of the run the same way
+                if e.code in (401, 403):
+                    raise BingAuthenticationError("Bing rejected the key (HTTP " + str(e.code) + " on " + endpoint + ")") from None
+                # Anything else than throttling or a temporary server error will not get better by retrying
+                if e.code not in (429, 500, 502, 503, 504):
+                    raise
+                if e.code in (429, 503):
+                    self.ratelimiter.onthrottle()
+                retry_after = self._retryafter(e.headers)
+                error = e
+                
+            except (OSError, ValueError) as e:
+                # Network errors (URLError, timeouts, resets) and truncated answers
+                self.metrics.inc("bing_requests_total", endpoint=endpoint, status=type(e).__name__)
+                error = e
+                
+            if attempt >= self.retries:
+                raise error
+            
+            self.metrics.inc("bing_retries_total", endpoint=endpoint)
+            
+            # Jittered exponential backoff, never shorter than what Bing asked for
+            time.sleep(max(retry_after, random.uniform(0, self.backoff * 2 ** attempt)))
+            attempt += 1
+
+    def _retryafter(self, headers):
+        """
+        Private method. Reading the Retry-After header (seconds or HTTP date) of an answer, 0 if absent
+        """
+        import email.utils
+        import time
+
+        value = headers.get("Retry-After") if headers is not None else None
+        if value is None:
+            return 0
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            try:
+                return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                return 0
+
+    def _getcentroid(self, bingMapsKey, country, admindistrict = ""):
+        """
+        Private method. Getting the coordinates of the center of a country (or of one of its admin districts) through the centroid cache. Returns (latitude, longitude) as floats or None
+        @params:
+            bingMapsKey     - Required  : Bing Maps key (Str)
+            country         - Required  : countryRegion (Str)
+            admindistrict   - Optional  : adminDistrict, "" for the center of the whole country (Str)
+        """
+        import urllib.parse
+
+        # '0' is the placeholder of the rows that were not geocoded: there is no country to look up, and nothing to cache
+        if country in (None, "", "0"):
+            return None
+
+        def resolve():
+            routeUrl = self.bingurl + "/v1/Locations" + "?countryRegion=" + urllib.parse.quote(country, safe='')
+            if admindistrict != "":
+                routeUrl = routeUrl + "&adminDistrict=" + urllib.parse.quote(admindistrict, safe='')
+            routeUrl = routeUrl + self.LOCATIONOPTIONS + "&key=" + bingMapsKey
+
+            result = self._requestjson(routeUrl)
+            return (round(float(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][0]),4),
+                    round(float(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][1]),4))
+
+        return self.centroids.get(country, admindistrict, resolve)
+
+    def _haversine(self, lat1, lon1, lat2, lon2):
+        """
+        Private method. Great-circle distance in km between arrays of coordinates in degrees, computed on whole NumPy arrays (no Python loop). NaN in, NaN out
+        @params:
+            lat1, lon1  - Required  : coordinates of the starting points (Array)
+            lat2, lon2  - Required  : coordinates of the end points (Array)
+        """
+        import numpy as np
+
+        lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype='float64')) for a in (lat1, lon1, lat2, lon2))
+        
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        
+        # Mean Earth radius (km). Haversine is within 0.5% of Vincenty, which is plenty for a flight distance
+        return 2 * 6371.0088 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+    def _openjournal(self, journal, method):
+        """
+        Private method. Opening the checkpoint journal of an extract method and returning what it already contains as {key: values}
+        @params:
+            journal     - Required  : path to the journal file, None to run without checkpoints (Str)
+            method      - Required  : name of the extract method writing the journal (Str)
+        """
+        if journal is None:
+            self.journal = None
+            return {}
+        
+        self.journal = _Journal(journal)
+        previous, finished = self.journal.load()
+        
+        if previous is not None and previous != method:
+            raise ValueError("The journal " + journal + " was written by " + previous + ", not by " + method)
+        
+        self.journal.start(method)
+        
+        if len(finished) != 0:
+            print("Resuming from the journal: " + str(len(finished)) + " entries already done")
+        return finished
+
+    def _errormask(self, length):
+        """
+        Private method. NumPy boolean array, True for the entries with no error, built in one pass from the set self.error_indexes
+        @params:
+            length      - Required  : number of entries (Int)
+        """
+        import numpy as np
+
+        error_mask = np.ones(length, dtype=bool)
+        if len(self.error_indexes) != 0:
+            error_mask[np.fromiter(self.error_indexes, dtype=np.int64, count=len(self.error_indexes))] = False
+        return error_mask
+
+    def _jsonfloat(self, value):
+        """
+        Private method. NaN is not valid JSON: converting it to None before writing it to the journal
+        """
+        import math
+
+        value = float(value)
+        return None if math.isnan(value) else value
+
+    def _runordered(self, func, items, workers = 1):
+        """
+        Private method. Calling func on each item and yielding (item, result, error) in the input order
+        @params:
+            func        - Required  : function called on each item
+            items       - Required  : items to process (List)
+            workers     - Optional  : maximum number of calls in flight at the same time (Int)
+        """
+        # BingRunAborted is not an error of the item: it is raised to the caller and stops the run
+        def call(item):
+            try:
+                return func(item), None
+            except BingRunAborted:
+                raise
+            except Exception as e:
+                return None, e
+
+        if workers <= 1:
+            for item in items:
+                result, error = call(item)
+                yield item, result, error
+            return
+
+        # Only imported when needed: concurrent.futures is one of the slowest imports of a serial worker
+        from concurrent.futures import ThreadPoolExecutor
+        from collections import deque
+
+        # Sliding window: never more than 'workers' calls in flight and results are released in the submission order
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            try:
+                for item in items:
+                    pending.append((item, executor.submit(call, item)))
+                    if len(pending) >= workers:
+                        item_done, future = pending.popleft()
+                        result, error = future.result()
+                        yield item_done, result, error
+                while pending:
+                    item_done, future = pending.popleft()
+                    result, error = future.result()
+                    yield item_done, result, error
+            finally:
+                # Stopped early (BingRunAborted or the caller gave up): the calls not started yet are not sent
+                for item_done, future in pending:
+                    future.cancel()
+
+        
+    def openengine(self, url, poolsize = 5, maxoverflow = 10):
+        """ Setting the database used by all the SQL methods of the instance. The engine and its connection pool are created at the first SQL call and then reused
+        @params:
+            url         - Required  :  any SQLAlchemy URL, e.g. "mssql+pyodbc://server/db?driver=SQL+Server" or "sqlite:///queries.db" (Str)
+            poolsize    - Optional  :  number of connections kept open in the pool (Int)
+            maxoverflow - Optional  :  number of extra connections opened when the pool is exhausted (Int)
+        NB: once an engine is opened, the SQL methods can be called with server=None and db=None
+        """
+        self.closeengine()
+        self.engineurl = url
+        self.poolsize = poolsize
+        self.maxoverflow = maxoverflow
+        
+    def closeengine(self):
+        """ Closing all the connections of the shared engine. The next SQL call opens a new pool
+        """
+        if self.engine is not None:
+            self.engine.dispose()
+            self.engine = None
+            
+    def enginestats(self):
+        """ Returning (and printing) the statistics of the connection pool of the shared engine
+        """
+        stats = {'url': self.engineurl,
+                 'connections': self.sqlconnections,
+                 'checkouts': self.sqlcheckouts}
+        
+        if self.engine is not None:
+            pool = self.engine.pool
+            for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+                if hasattr(pool, name):
+                    stats[name] = getattr(pool, name)()
+            print(pool.status())
+                    
+        print(str(self.sqlconnections) + " database connections opened for " + str(self.sqlcheckouts) + " checkouts")
+        
+        return stats
+    
+    def exportmetrics(self, file = None, format = "json"):
+        """ Writing the metrics of the run: stage durations, Bing requests per endpoint and status, latency histograms (p50/p90/p99), bytes, retries, cache hits, SQL rows
+        @params:
+            file    - Optional  :  path of the file written, None only returns the metrics (Str)
+            format  - Optional  :  "json" or "prometheus" (text exposition format) (Str)
+        """
+        import json
+        
+        if format == "json":
+            text = json.dumps(self.metrics.snapshot(), indent=1)
+        elif format == "prometheus":
+            text = self.metrics.prometheus()
+        else:
+            raise ValueError("format must be 'json' or 'prometheus'")
+        
+        if file is not None:
+            with open(file, "w") as f:
+                f.write(text)
+                
+        return text
+    
+    def _getengine(self, server = None, db = None):
+        """
+        Private method. Returning the shared engine, created on first use
+        @params:
+            server  - Optional  :  SQL Server name or full SQLAlchemy URL, None for the URL given to openengine() (Str)
+            db      - Optional  :  Data Base name, ignored when server is a URL (Str)
+        """
+        import sqlalchemy
+        
+        if server is not None:
+            if "://" in server:
+                url = server
+            else:
+                encoding='utf-8'
+                driver = 'SQL+Server'
+                url = 'mssql+pyodbc://{}/{}?driver={}?encoding={}'.format(server, db, driver, encoding)
+            
+            if url != self.engineurl:
+                self.openengine(url, self.poolsize, self.maxoverflow)
+                
+        if self.engineurl is None:
+            raise ValueError("No database: call openengine(url) or give a server")
+            
+        if self.engine is None:
+            options = {}
+            # An in-memory SQLite database only lives in its single connection: no pool
+            if self.engineurl.rstrip("/") != "sqlite:" and ":memory:" not in self.engineurl:
+                options = {'poolclass': sqlalchemy.pool.QueuePool, 'pool_size': self.poolsize, 'max_overflow': self.maxoverflow, 'pool_pre_ping': True}
+            # fast_executemany: pyodbc sends each batch of parameters in one round-trip instead of one INSERT per row
+            if self.engineurl.startswith("mssql+pyodbc"):
+                options['fast_executemany'] = True
+                
+            self.engine = sqlalchemy.create_engine(self.engineurl, **options)
+            
+            # The statistics describe the pool of the current engine only
+            self.sqlconnections = 0
+            self.sqlcheckouts = 0
+            
+            def onconnect(connection, record):
+                self.sqlconnections += 1
+                
+            def oncheckout(connection, record, proxy):
+                self.sqlcheckouts += 1
+                
+            sqlalchemy.event.listen(self.engine, "connect", onconnect)
+            sqlalchemy.event.listen(self.engine, "checkout", oncheckout)
+            
+        return self.engine
+        
+    @_instrumented
     def getnewqueries(self,server,db,query):
         """ Extracting new source and destination information from SQL Server
         @params:
@@ -83,64 +1310,352 @@ class BingMapsDTExtract:
         NB: This methods expects to receive two columns: [Source] and [Destination]
         """
         
-        import sqlalchemy
         import pandas as pd
         
-        self.server = server
-        self.db = db
-        self.query = query
+        self.server = server
+        self.db = db
+        self.query = query
+        
+        engine = self._getengine(server, db)
+
+        NewQueries = pd.read_sql(self.query,con=engine)
+        
+        self._setnewqueries(NewQueries)
+        
+    def _setnewqueries(self, NewQueries):
+        """
+        Private method. Building self.new from a DataFrame of new queries
+        @params:
+            NewQueries  - Required  : Pandas Dataframe [Source] and [Destination]
+        """
+        import pandas as pd
+        
+        # Net new flags of getnetnewqueries() only apply to the queries it read
+        self.netnew = None
+        
+        #Creating additional columns: Key by concatenating Source and Destination, TravelDuration and TravelDistance
+        self.new = pd.DataFrame({'NewKey': self._routekeys(NewQueries['Source'], NewQueries['Destination']).rename("NewKey"),
+                                   'NewSource': NewQueries['Source'],
+                                   'NewDestination': NewQueries['Destination'],
+                                   'NewTravelDuration': 0,
+                                   'NewTravelDistance': 0,
+                                   'NewFlightDistance': 0})
+
+
+    
+    def _routekeys(self, source, destination):
+        """
+        Private method. Keys of the couples: Source+'+'+Destination, made of the normalized addresses when the instance normalizes them
+        @params:
+            source      - Required  : Pandas Series of the sources
+            destination - Required  : Pandas Series of the destinations
+        """
+        if self.normalizer is not None:
+            source = self.normalizer.normalizeall(source)
+            destination = self.normalizer.normalizeall(destination)
+            
+        return source.str.cat(others=destination, sep='+')
+    
+    @_instrumented
+    def getpastqueries(self,server,db,query):
+        """ Extracting past queries to avoid overusing the Bing API
+        @params:
+            server   - Required  :  SQL Server name (Str)
+            db:      - Required  :  Data Base name (Str)
+            query    - Required  : SQL query (Str)
+        NB: NB: This methods expects to receive five columns: [KeyID],[Source],[Destination],[TravelDuration] and [TravelDistance]
+        """
+        
+        import pandas as pd
+         
+        self.server = server
+        self.db = db
+        self.query = query
+        
+        engine = self._getengine(server, db)
+       
+        self.past = pd.read_sql(self.query,con=engine)
+
+
+    
+    @_instrumented
+    def getnetnewqueries(self, server, db, query, pasttable, createindex = True):
+        """ Extracting new source and destination information from SQL Server with the anti-join against the past queries done in the database:
+         each new couple is flagged with NOT EXISTS against the [KeyID] of pasttable, so the history never leaves the server.
+         cleanqueries() then uses these flags instead of merging with getpastqueries()
+        @params:
+            server      - Required  :  SQL Server name (Str)
+            db:         - Required  :  Data Base name (Str)
+            query       - Required  :  SQL query (Str)
+            pasttable   - Required  :  table holding the past queries, with a [KeyID] column made of Source+'+'+Destination, may be schema qualified (dbo.PastQueries) (Str)
+            createindex - Optional  :  creating an index on pasttable.[KeyID] when there is none, so that NOT EXISTS is an index seek (Bool)
+        NB: This methods expects to receive two columns: [Source] and [Destination]. query is used as a subquery: no ORDER BY on SQL Server
+            The key is compared as written, case and trailing spaces included (binary collation on SQL Server), as cleanqueries() does.
+            Not available when the instance normalizes the addresses, use getnewqueries() and cleanqueries()
+        """
+        
+        import pandas as pd
+        import sqlalchemy
+        
+        # The database cannot rebuild the normalized keys: the anti-join would disagree with cleanqueries()
+        if self.normalizer is not None:
+            raise ValueError("getnetnewqueries() compares the raw keys in the database and cannot be used with normalize=True, use getnewqueries() and cleanqueries()")
+        
+        self.server = server
+        self.db = db
+        self.query = query
+        
+        engine = self._getengine(server, db)
+        quote = engine.dialect.identifier_preparer.quote
+        
+        if createindex:
+            self._indexkey(engine, pasttable, 'KeyID')
+        
+        # Same key as _setnewqueries(), built by the database
+        concat = " + " if engine.dialect.name == 'mssql' else " || "
+        key = "n." + quote('Source') + concat + "'+'" + concat + "n." + quote('Destination')
+        
+        match = "p." + quote('KeyID') + " = " + key
+        if engine.dialect.name == 'mssql':
+            # The default collations of SQL Server ignore case and trailing spaces, the pandas merge of cleanqueries() does not.
+            # The plain equality keeps the index seek, the binary collation and the length with a sentinel make the match exact
+            match += (" AND p." + quote('KeyID') + " COLLATE Latin1_General_BIN2 = (" + key + ") COLLATE Latin1_General_BIN2" +
+                      " AND LEN(p." + quote('KeyID') + " + 'x') = LEN(" + key + " + 'x')")
+        
+        sql = ("SELECT n." + quote('Source') + ", n." + quote('Destination') +
+               ", CASE WHEN NOT EXISTS (SELECT 1 FROM " + self._quotetable(engine, pasttable) + " p WHERE " + match + ") THEN 1 ELSE 0 END AS " + quote('NetNew') +
+               " FROM (" + query + ") n")
+        
+        NewQueries = pd.read_sql(sqlalchemy.text(sql), con=engine)
+        
+        self._setnewqueries(NewQueries)
+        self.netnew = NewQueries['NetNew'].to_numpy(dtype=bool)
+        
+        print(str(len(self.netnew)) + " new queries read, " + str(int(self.netnew.sum())) + " never queried in the past")
+        
+    def _quotetable(self, engine, table):
+        """
+        Private method. Quoting a table name that may be schema qualified: each dot separated part is quoted on its own ([dbo].[PastQueries], not [dbo.PastQueries])
+        @params:
+            engine  - Required  :  SQLAlchemy engine (Engine)
+            table   - Required  :  table name (Str)
+        """
+        quote = engine.dialect.identifier_preparer.quote
+        
+        return ".".join(quote(part) for part in table.split("."))
+    
+    def _indexkey(self, engine, table, column):
+        """
+        Private method. Creating an index on table.column if no index starts with this column
+        @params:
+            engine  - Required  :  SQLAlchemy engine (Engine)
+            table   - Required  :  table name, may be schema qualified (Str)
+            column  - Required  :  indexed column (Str)
+        """
+        import sqlalchemy
+        
+        schema, name = table.rsplit(".", 1) if "." in table else (None, table)
+        
+        for index in sqlalchemy.inspect(engine).get_indexes(name, schema=schema):
+            if index['column_names'][:1] == [column]:
+                return
+        
+        quote = engine.dialect.identifier_preparer.quote
+        index = quote("IX_" + name + "_" + column)
+        
+        # SQLite puts the schema on the index name, the other databases on the table
+        if engine.dialect.name == 'sqlite':
+            target = (self._quotetable(engine, schema) + "." + index if schema is not None else index) + " ON " + quote(name)
+        else:
+            target = index + " ON " + self._quotetable(engine, table)
+        
+        try:
+            with engine.begin() as connection:
+                connection.execute(sqlalchemy.text("CREATE INDEX " + target + " (" + quote(column) + ")"))
+            print("Index created on " + table + "." + column)
+        except sqlalchemy.exc.DBAPIError as e:
+            # e.g. a NVARCHAR(MAX) key on SQL Server: the anti-join still works, with a scan
+            print("No index created on " + table + "." + column + ": " + str(e.orig))
+    
+    def openroutecache(self, file, ttl = None):
+        """ Opening (or creating) the local route cache used by cleanqueries() and filled by the extract methods
+        @params:
+            file     - Required  :  path to the SQLite file (Str)
+            ttl      - Optional  :  number of days after which a cached travel time is routed again (Float)
+        NB: To seed the cache from the history once: getpastqueries(...) then self.routecache.store(self.past)
+        """
+        
+        if self.routecache is not None:
+            self.routecache.close()
+        self.routecache = _RouteCache(file, ttl)
+    
+    
+    def opengeocodeindex(self, file):
+        """ Opening (or creating) the local geocode index checked by the extractcoorfrombing methods before any request and filled with their results
+        @params:
+            file     - Required  :  path to the SQLite file (Str)
+        NB: The addresses are indexed normalized when the instance normalizes them: use the index with the same normalize option
+        """
+        
+        if self.geocodeindex is not None:
+            self.geocodeindex.close()
+        self.geocodeindex = _GeocodeIndex(file)
+        
+    @_instrumented
+    def seedgeocodeindex(self, server, db, query, chunksize = 100000):
+        """ Filling the geocode index with the addresses already geocoded and stored in SQL by storequeries()
+        @params:
+            server      - Required  :  SQL Server name (Str)
+            db:         - Required  :  Data Base name (Str)
+            query       - Required  :  SQL query (Str)
+            chunksize   - Optional  :  number of rows read and indexed at a time (Int)
+        NB: This methods expects to receive the columns of the geocoding donequeries: [Adresses] (or [Address]),[Latitude],[Longitude],[Country_check],[Confidence]
+        """
+        
+        import pandas as pd
+        
+        engine = self._getengine(server, db)
+        total = 0
         
-        encoding='utf-8'
-        driver = 'SQL+Server'      
-        engine = sqlalchemy.create_engine('mssql+pyodbc://{}/{}?driver={}?encoding={}'.format(self.server, self.db, driver, encoding))
-
-        NewQueries = pd.read_sql(self.query,con=engine)
+        for chunk in pd.read_sql(query, con=engine, chunksize=chunksize):
+            addresses = chunk['Adresses'] if 'Adresses' in chunk else chunk['Address']
+            admdist = chunk['Admdist_check'] if 'Admdist_check' in chunk else [None] * len(chunk)
+            self.geocodeindex.store({self._geocodekey(a): (lat, lon, country, adm, confidence)
+                                     for a, lat, lon, country, adm, confidence in zip(addresses, chunk['Latitude'], chunk['Longitude'], chunk['Country_check'], admdist, chunk['Confidence'])})
+            total += len(chunk)
+            
+        print(str(total) + " geocoded addresses indexed, " + str(len(self.geocodeindex)) + " in the index")
         
-        #Creating additional columns: Key by concatenating Source and Destination, TravelDuration and TravelDistance
-        self.new = pd.DataFrame({'NewKey': NewQueries['Source'].str.cat(others=NewQueries['Destination'],sep='+').rename("NewKey"),
-                                   'NewSource': NewQueries['Source'],
-                                   'NewDestination': NewQueries['Destination'],
-                                   'NewTravelDuration': 0,
-                                   'NewTravelDistance': 0,
-                                   'NewFlightDistance': 0})
-
-
-    
-    def getpastqueries(self,server,db,query):
-        """ Extracting past queries to avoid overusing the Bing API
+    def _geocodekey(self, address):
+        """
+        Private method. Key of an address in the geocode index, normalized when the instance normalizes the addresses
         @params:
-            server   - Required  :  SQL Server name (Str)
-            db:      - Required  :  Data Base name (Str)
-            query    - Required  : SQL query (Str)
-        NB: NB: This methods expects to receive five columns: [KeyID],[Source],[Destination],[TravelDuration] and [TravelDistance]
+            address - Required  :  address, or tuple of the address segments (Str)
         """
-        
-        import sqlalchemy
-        import pandas as pd
-         
-        self.server = server
-        self.db = db
-        self.query = query
-        
-        encoding='utf-8'
-        driver = 'SQL+Server'      
-        engine = sqlalchemy.create_engine('mssql+pyodbc://{}/{}?driver={}?encoding={}'.format(self.server, self.db, driver, encoding))
-       
-        self.past = pd.read_sql(self.query,con=engine)
-
-
-    
-    def cleanqueries(self):
+        if isinstance(address, tuple):
+            return "|".join(self._geocodekey(a) for a in address)
+        if self.normalizer is not None:
+            return self.normalizer.normalize(address)
+        return str(address)
+        
+    @_instrumented
+    def cleanqueries(self, symmetric = False, mindistance = 0.0):
         """ Creating a mask that will select queries never made in the past (that are not in PastQueries table). 
          Using a LEFT merge on the Key created above and selecting the ones with NA (not in PastQueries)
+         When a route cache is open (openroutecache()) the keys are looked up in it and getpastqueries() becomes optional
+         When the new queries come from getnetnewqueries() the anti-join was done in the database and getpastqueries() is not needed
+        @params:
+            symmetric   - Optional  : reusing a known B > A route for A > B, and sending each unordered couple only once per run.
+                                      The reused routes are flagged by a [Reversed] column in pastqueries and donequeries (Bool)
+            mindistance - Optional  : tolerance of the symmetric mode, a B > A route is only reused if its TravelDistance is at least mindistance (km).
+                                      As the distance is not known before routing, above 0 only the exact duplicates of the run are sent once (Float)
         """
         
+        import numpy as np
         import pandas as pd
 
+        cached = {}
         
-        merge = self.new.merge(self.past, how='left', left_on='NewKey', right_on='KeyID')
+        # Positional boolean array: selecting with it does not depend on the index of self.new
+        self.query_mask = np.ones(len(self.new), dtype=bool)
         
-        self.query_mask=merge['KeyID'].isnull()
+        if self.routecache is not None:
+            cached = self.routecache.lookup(self.new['NewKey'].unique())
+            self.query_mask &= ~self.new['NewKey'].isin(list(cached.keys())).to_numpy()
+            
+        if self.netnew is not None:
+            # Anti-join already done in the database by getnetnewqueries()
+            self.query_mask &= self.netnew
+        elif self.routecache is None or hasattr(self, 'past'):
+            past = self.past
+            if self.normalizer is not None and len(past) != 0:
+                # The past keys were built from the raw addresses
+                past = pd.DataFrame({'KeyID': self._routekeys(past['Source'], past['Destination']).drop_duplicates()})
+            # One row per past key: a key queried twice in the past would duplicate the new query in the merge
+            merge = self.new.merge(past[['KeyID']].drop_duplicates(), how='left', left_on='NewKey', right_on='KeyID')
+            self.query_mask &= merge['KeyID'].isnull().to_numpy()
+            
+        known = int((~self.query_mask).sum())
+        
+        # Couples known under their normalized key only: the raw keys would have routed them again
+        if self.normalizer is not None:
+            rawkeys = self.new['NewSource'].str.cat(others=self.new['NewDestination'], sep='+')
+            rawknown = np.zeros(len(self.new), dtype=bool)
+            if self.routecache is not None:
+                rawknown |= rawkeys.isin(list(self.routecache.lookup(rawkeys.unique()).keys())).to_numpy()
+            if hasattr(self, 'past') and len(self.past) != 0:
+                rawknown |= rawkeys.isin(self.past['Source'].str.cat(others=self.past['Destination'], sep='+')).to_numpy()
+            normalizedhits = int((~self.query_mask & ~rawknown).sum())
+        
+        reversedresults = {}
+        reversed_mask = np.zeros(len(self.new), dtype=bool)
+        duplicate_mask = np.zeros(len(self.new), dtype=bool)
+        self.duplicatequeries = None
+        
+        if symmetric:
+            
+            # B > A key of every A > B couple
+            reverse = self._routekeys(self.new['NewDestination'], self.new['NewSource'])
+            candidates = reverse[self.query_mask].unique()
+            
+            if self.routecache is not None:
+                for k, v in self.routecache.lookup(candidates).items():
+                    reversedresults[k] = v[:2]
+                    
+            if hasattr(self, 'past') and 'TravelDistance' in self.past.columns:
+                pastkeys = self._routekeys(self.past['Source'], self.past['Destination']) if self.normalizer is not None else self.past['KeyID']
+                found = pastkeys.isin(candidates).to_numpy()
+                for k, duration, distance in zip(pastkeys[found], self.past['TravelDuration'][found], self.past['TravelDistance'][found]):
+                    reversedresults.setdefault(k, (duration, distance))
+            
+            reversedresults = {k: v for k, v in reversedresults.items() if v[1] is not None and v[1] >= mindistance}
+            reversed_mask = self.query_mask & reverse.isin(list(reversedresults.keys())).to_numpy()
+            self.query_mask &= ~reversed_mask
+            
+            # In-batch dedup: the first occurrence of each couple is routed, the others get its result in _expandduplicates()
+            forward = self.new['NewKey']
+            if mindistance == 0:
+                pair = forward.where(forward.fillna('') <= reverse.fillna(''), reverse)
+            else:
+                pair = forward
+            todo = np.flatnonzero(self.query_mask)
+            duplicated = pair.iloc[todo].duplicated().to_numpy()
+            duplicate_mask[todo[duplicated]] = True
+            self.query_mask &= ~duplicate_mask
+            
+            first = todo[~duplicated]
+            representative = pair.iloc[todo[duplicated]].map(pd.Series(forward.iloc[first].to_numpy(), index=pair.iloc[first].to_numpy()))
+            
+            self.duplicatequeries = pd.DataFrame({'KeyID': forward[duplicate_mask],
+                                                  'Source': self.new['NewSource'][duplicate_mask],
+                                                  'Destination': self.new['NewDestination'][duplicate_mask],
+                                                  'RepresentativeKey': representative.to_numpy()})
+            self.duplicatequeries['Reversed'] = self.duplicatequeries['KeyID'] != self.duplicatequeries['RepresentativeKey']
+            
+        # Hit-rate statistics: every known query is a couple not routed again
+        self.metrics.inc("queries_total", len(self.new))
+        self.metrics.inc("queries_known_total", known)
+        self.metrics.inc("queries_reused_total", int(reversed_mask.sum()), reuse="reversed")
+        self.metrics.inc("queries_reused_total", int(duplicate_mask.sum()), reuse="duplicate")
+        self.keystats = {'queries': len(self.new),
+                         'known': known,
+                         'hitrate': known / len(self.new) if len(self.new) else 0.0,
+                         'keys': int(self.new['NewKey'].nunique())}
+        if self.normalizer is not None:
+            self.metrics.inc("queries_known_normalized_total", normalizedhits)
+            self.keystats['rawkeys'] = int(rawkeys.nunique())
+            self.keystats['normalizedhits'] = normalizedhits
+            
+        print(str(known) + " of " + str(len(self.new)) + " queries already known (" + str(round(100 * self.keystats['hitrate'], 1)) + "% hit rate)" +
+              ("" if self.normalizer is None else ", " + str(self.keystats['rawkeys']) + " raw keys normalized into " + str(self.keystats['keys']) +
+               ", " + str(normalizedhits) + " of the known couples found only by their normalized key (routes not requested again)"))
+        
+        if symmetric:
+            self.keystats['reversed'] = int(reversed_mask.sum())
+            self.keystats['duplicates'] = int(duplicate_mask.sum())
+            # Couples, not requests: with batched routing a request carries up to 12 couples
+            print("Symmetric mode: " + str(self.keystats['reversed'] + self.keystats['duplicates']) + " more couples reused instead of routed, " + str(self.keystats['reversed']) + " reversed known routes and " +
+                  str(self.keystats['duplicates']) + " duplicates in the run (" + str(int(self.duplicatequeries['Reversed'].sum())) + " of them reversed)")
 
         # Creating output Panda series that will be filled with the results
         self.key = self.new['NewKey'][self.query_mask]
@@ -148,18 +1663,102 @@ class BingMapsDTExtract:
         self.destination = self.new['NewDestination'][self.query_mask]
         self.travelduration = self.new['NewTravelDuration'][self.query_mask]
         self.traveldistance = self.new['NewTravelDistance'][self.query_mask]
-        self.flightdistance = self.new['NewTravelDistance'][self.query_mask]
+        self.flightdistance = self.new['NewFlightDistance'][self.query_mask]
         
-        #Storing the queries that were already made in the past
-        #self.pastqueries = self.new[[not i for i in self.query_mask]]  
+        # Couples flagged by computeflightdistance() as not needing a route, reset for every new selection
+        self.skip_identical = None
+        self.skip_toofar = None
         
+        #Storing the queries that were already made in the past
+        past_mask = ~self.query_mask & ~duplicate_mask
         self.pastqueries  = pd.DataFrame({'KeyID': self.new['NewKey'],
                           'Source': self.new['NewSource'],
                           'Destination': self.new['NewDestination'],
                           'TravelDuration': self.new['NewTravelDuration'],
-                          'TravelDistance': self.new['NewTravelDistance']})[[not i for i in self.query_mask]] 
+                          'TravelDistance': self.new['NewTravelDistance']})[past_mask]
+        
+        # The cached routes come with their travel duration and distance
+        if len(cached) != 0:
+            keys = self.pastqueries['KeyID']
+            self.pastqueries['TravelDuration'] = keys.map(pd.Series({k: v[0] for k, v in cached.items()})).fillna(self.pastqueries['TravelDuration'])
+            self.pastqueries['TravelDistance'] = keys.map(pd.Series({k: v[1] for k, v in cached.items()})).fillna(self.pastqueries['TravelDistance'])
+            
+        # The reversed routes come with the travel duration and distance of the B > A route
+        if symmetric:
+            self.pastqueries['Reversed'] = reversed_mask[past_mask]
+            if len(reversedresults) != 0:
+                keys = reverse[past_mask].where(self.pastqueries['Reversed'])
+                self.pastqueries['TravelDuration'] = keys.map(pd.Series({k: v[0] for k, v in reversedresults.items()})).fillna(self.pastqueries['TravelDuration'])
+                self.pastqueries['TravelDistance'] = keys.map(pd.Series({k: v[1] for k, v in reversedresults.items()})).fillna(self.pastqueries['TravelDistance'])
+            
+    def _expandduplicates(self):
+        """
+        Private method. Adding to donequeries (or errorqueries) the couples left out by the in-batch dedup of cleanqueries(symmetric=True),
+        with the result of the couple actually routed
+        """
+        import pandas as pd
+        
+        if self.duplicatequeries is None:
+            return
+        
+        duplicates = self.duplicatequeries
+        self.donequeries['Reversed'] = False
+        
+        done = self.donequeries.drop_duplicates('KeyID').set_index('KeyID')
+        found = duplicates['RepresentativeKey'].isin(done.index).to_numpy()
+        
+        copies = done.loc[duplicates['RepresentativeKey'][found]]
+        copies.index = duplicates.index[found]
+        copies.insert(0, 'KeyID', duplicates['KeyID'][found])
+        copies['Source'] = duplicates['Source'][found]
+        copies['Destination'] = duplicates['Destination'][found]
+        copies['Reversed'] = duplicates['Reversed'][found]
+        
+        errors = duplicates[~found][['Source', 'Destination']].reindex(columns=self.errorqueries.columns)
+        
+        self.donequeries = pd.concat([self.donequeries, copies[self.donequeries.columns]])
+        self.errorqueries = pd.concat([self.errorqueries, errors])
+        
+        print(str(len(duplicates)) + " duplicate couples of the run filled from the routed ones without calling Bing (" + str(int(copies['Reversed'].sum())) + " reversed)")
 
     
+    @_instrumented
+    def computeflightdistance(self, maxdistance = None):
+        """ Computing the FlightDistance (great-circle distance in km) of the couples selected by cleanqueries() whose Source and Destination are "latitude,longitude" coordinates,
+        and flagging the couples that extractdtfrombing() does not need to route
+        @params:
+            maxdistance - Optional  :  couples further apart than this flight distance (km) are not routed and logged as errors (Float)
+        NB: Identical Source and Destination get a TravelDuration and TravelDistance of 0 without calling Bing.
+            Couples given as addresses get their FlightDistance from the coordinates returned by Bing in extractdtfrombing()
+        """
+        
+        import numpy as np
+        import pandas as pd
+        
+        coordinates = r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$'
+        
+        source = self.source.astype(str).str.extract(coordinates).astype('float64')
+        destination = self.destination.astype(str).str.extract(coordinates).astype('float64')
+        
+        distance = self._haversine(source[0], source[1], destination[0], destination[1])
+        known = ~np.isnan(distance)
+        
+        self.flightdistance = pd.Series(np.where(known, distance, self.flightdistance.to_numpy(dtype='float64')), index=self.source.index)
+        
+        normalized_source = self.source.astype(str).str.strip().str.lower().to_numpy()
+        normalized_destination = self.destination.astype(str).str.strip().str.lower().to_numpy()
+        
+        self.skip_identical = (normalized_source == normalized_destination) | (known & (distance == 0))
+        
+        if maxdistance is not None:
+            self.skip_toofar = known & (distance > maxdistance) & ~self.skip_identical
+        else:
+            self.skip_toofar = np.zeros(len(self.source), dtype=bool)
+            
+        print("Flight distance computed for " + str(int(known.sum())) + " couples. Not routed: " + str(int(self.skip_identical.sum())) + " identical, " + str(int(self.skip_toofar.sum())) + " too far apart")
+    
+    
+    @_instrumented
     def getnewaddresses(self,server,db,query):    
         """ Extracting new addresses to get exact coordinates from Bing API
         @params:
@@ -169,16 +1768,13 @@ class BingMapsDTExtract:
         NB: This methods expects to receive one column: [Address]
         """
         
-        import sqlalchemy
         import pandas as pd
         
         self.server = server
         self.db = db
         self.query = query
         
-        encoding='utf-8'
-        driver = 'SQL+Server'      
-        engine = sqlalchemy.create_engine('mssql+pyodbc://{}/{}?driver={}?encoding={}'.format(self.server, self.db, driver, encoding))
+        engine = self._getengine(server, db)
 
         NewQueries = pd.read_sql(self.query,con=engine)
         
@@ -187,14 +1783,19 @@ class BingMapsDTExtract:
                                    'Latitude': 0,
                                    'Longitude': 0,
                                    'Country_check' : 0,
+                                   'Country_check_latitude' : 0,
+                                   'Country_check_longitude' : 0,
                                    'Confidence' : 0})
     
         self.address = self.new['Address']
         self.latitude = self.new['Latitude']
         self.longitude = self.new['Longitude']
         self.country_check= self.new['Country_check']
+        self.country_check_latitude = self.new['Country_check_latitude']
+        self.country_check_longitude = self.new['Country_check_longitude']
         self.confidence= self.new['Confidence']
         
+    @_instrumented
     def getnewaddresses_xls(self,path):    
         """ Extracting new addresses to get exact coordinates from Bing API
         @params:
@@ -213,15 +1814,20 @@ class BingMapsDTExtract:
                                    'Latitude': 0,
                                    'Longitude': 0,
                                    'Country_check' : 0,
+                                   'Country_check_latitude' : 0,
+                                   'Country_check_longitude' : 0,
                                    'Confidence' : 0})
     
         self.address = self.new['Address']
         self.latitude = self.new['Latitude']
         self.longitude = self.new['Longitude']
         self.country_check= self.new['Country_check']
+        self.country_check_latitude = self.new['Country_check_latitude']
+        self.country_check_longitude = self.new['Country_check_longitude']
         self.confidence= self.new['Confidence']
         
         
+    @_instrumented
     def getnewaddresses_segmented(self,server,db,query):    
         """ Extracting new addresses to get exact coordinates from Bing API
         @params:
@@ -231,16 +1837,13 @@ class BingMapsDTExtract:
         NB: This methods expects to receive one column: [countryRegion],[adminDistrict],[locality],[postalCode],[addressLine]
         """
         
-        import sqlalchemy
         import pandas as pd
         
         self.server = server
         self.db = db
         self.query = query
         
-        encoding='utf-8'
-        driver = 'SQL+Server'      
-        engine = sqlalchemy.create_engine('mssql+pyodbc://{}/{}?driver={}?encoding={}'.format(self.server, self.db, driver, encoding))
+        engine = self._getengine(server, db)
 
         NewQueries = pd.read_sql(self.query,con=engine)
         
@@ -277,6 +1880,7 @@ class BingMapsDTExtract:
         self.confidence= self.new['Confidence']
         
         
+    @_instrumented
     def getnewaddresses_segmented_xls(self,path):    
         """ Extracting new addresses to get exact coordinates from Bing API
         @params:
@@ -319,14 +1923,17 @@ class BingMapsDTExtract:
         self.admdist_check_longitude = self.new['Admdist_check_longitude']
         self.confidence= self.new['Confidence']
     
-    def extractdtfrombing(self, file):
+    @_instrumented
+    def extractdtfrombing(self, file, workers = 1, journal = None):
         """Extracting the TravelDuration and TravelTime using BingAPI
         @params:
             file     - Required  :   path to the file where the BingMapsKey is stored (Str)
+            workers  - Optional  :   number of requests in flight at the same time. 1 keeps the serial loop (Int)
+            journal  - Optional  :   path to the checkpoint journal. Couples already in the journal are not routed again (Str)
+        NB: The couples flagged by computeflightdistance() are not sent to Bing
         """
         
-        import urllib.request
-        import json
+        import numpy as np
         import pandas as pd
         
         len_s = len(self.source)
@@ -336,8 +1943,7 @@ class BingMapsDTExtract:
         bingMapsKey =  open(file, 'r').read()
         
         #Variables to log indexes of errors
-        self.error_indexes = []
-        all_indexes = list(range(0,len_s))
+        self.error_indexes = set()
         
         self._printprogressbar(0, len_s, prefix = 'Progress:', suffix = 'Complete', length = 50)
         
@@ -346,57 +1952,90 @@ class BingMapsDTExtract:
             
             warning = ""
             
-            for i in range(0,int(len_s/12)+1):
-
-                wp_i = 0;
-                routeUrl = "http://dev.virtualearth.net/REST/V1/Routes/Driving?"
+            # Pre-filter from computeflightdistance(): identical Source and Destination are done without routing, couples too far apart are errors
+            skip_identical = getattr(self, 'skip_identical', None)
+            skip_toofar = getattr(self, 'skip_toofar', None)
+            if skip_identical is None or len(skip_identical) != len_s:
+                skip_identical = np.zeros(len_s, dtype=bool)
+            if skip_toofar is None or len(skip_toofar) != len_s:
+                skip_toofar = np.zeros(len_s, dtype=bool)
+                
+            # Results are written in preallocated typed arrays and put in the output DataFrames once at the end
+            duration = pd.to_numeric(self.travelduration, errors='coerce').to_numpy(dtype='float32', copy=True)
+            distance = pd.to_numeric(self.traveldistance, errors='coerce').to_numpy(dtype='float32', copy=True)
+            
+            duration[skip_identical] = 0
+            distance[skip_identical] = 0
+            self.error_indexes.update(int(k) for k in np.flatnonzero(skip_toofar))
+            
+            # Coordinates of the start and end of each route as returned by Bing, to compute the missing flight distances
+            start_lat = np.full(len_s, np.nan)
+            start_lon = np.full(len_s, np.nan)
+            end_lat = np.full(len_s, np.nan)
+            end_lon = np.full(len_s, np.nan)
+            
+            # Restoring the couples already completed by an interrupted run
+            finished = self._openjournal(journal, "extractdtfrombing")
+            resumed = np.zeros(len_s, dtype=bool)
+            
+            if len(finished) != 0:
+                for k, key in enumerate(self.key):
+                    if key in finished:
+                        duration[k], distance[k], start_lat[k], start_lon[k], end_lat[k], end_lon[k] = [np.nan if v is None else v for v in finished[key]]
+                        resumed[k] = True
+            
+            positions = [int(k) for k in np.flatnonzero(~(skip_identical | skip_toofar | resumed))]
+            
+            # Batches of couples packed into at most 25 waypoints each, sent serially or concurrently
+            batches, batchlegs = self._planbatches(positions)
+            
+            done = len_s - len(positions)
+            self.bisectrequests = 0
+            
+            # Download and decoding counters before the batches, to report what this extraction alone cost
+            wire_start = self.transport.bytes
+            bytes_start = self.metrics.counter("bing_response_bytes_total", endpoint="routes/driving")
+            parse_start = self.metrics.histogram("bing_parse_seconds", endpoint="routes/driving")[0]
+            
+            for indexes, (legs, errors, requests, empty), error in self._runordered(lambda batch: self._routebatch(batch, bingMapsKey), batches, workers):
                 
-                indexes = []
+                # A failed batch is split in halves by _routebatch() until the couple(s) Bing cannot route are isolated, the other couples keep their results
+                self.error_indexes.update(errors)
+                self.bisectrequests += requests - 1
                 
-                # One URL can contain up to 25 waypoints. We use 24 for 12 couples (Source > Destination): Source 1 > Destination 1 > Source 2 > Destination 2 > ... > Destination 12
-                # Obviously we are not interested in the Destination n > Source n+1 part. We will ignore it lower in the code.
-                while (wp_i<12 and (12*i+wp_i) < len_s):
+                if empty:
+                    #result may be empty
+                    warning = "Warning. No results received from Bing API"
                 
-                    #print("Index: " + str(12*i+wp_i))
-                    indexes.append(12*i+wp_i)
+                # We are interested in the Source --> Destintation legs, the legs linking two couples are already ignored by _routebatch()
+                for k, leg in legs.items():
                     
-                    encodedSource = urllib.parse.quote(self.source.iloc[12*i+wp_i], safe='')
-                    encodedDest = urllib.parse.quote(self.destination.iloc[12*i+wp_i], safe='')
+                    duration[k] = leg["travelDuration"]
+                    distance[k] = leg["travelDistance"]
                     
-                    routeUrl = routeUrl + "&wp." +str(2*wp_i)+"="+ encodedSource + "&wp." +str(2*wp_i + 1)+"="+ encodedDest
-        
-                    wp_i += 1
-                
-                
-                routeUrl = routeUrl + "&key=" + bingMapsKey
-                #print(routeUrl)
+                    if "actualStart" in leg and "actualEnd" in leg:
+                        start_lat[k], start_lon[k] = leg["actualStart"]["coordinates"][:2]
+                        end_lat[k], end_lon[k] = leg["actualEnd"]["coordinates"][:2]
                 
-                try:
-                    request = urllib.request.Request(routeUrl)
-                    response = urllib.request.urlopen(request)
+                if self.journal is not None:
+                    self.journal.record({self.key.iloc[k]: [float(duration[k]), float(distance[k]),
+                                                            self._jsonfloat(start_lat[k]), self._jsonfloat(start_lon[k]),
+                                                            self._jsonfloat(end_lat[k]), self._jsonfloat(end_lon[k])] for k in legs})
                 
-                    r = response.read().decode(encoding="utf-8")
-                    result = json.loads(r)
-                    
-                except:
-                    # N.B.We don't have a way to to identify which couple(s) from the 12 caused the error so we log all the 12 couples as errors.
-                    self.error_indexes += indexes
-        
-                try:
-                    # We are interested in the Source --> Destintation and ignoring the Destination --> Source info. So taking only even indexes.        
-                    for j in range(0,2*wp_i,2):
-         
-                        self.travelduration.iloc[12*i+int(j/2)] = result["resourceSets"][0]["resources"][0]["routeLegs"][j]["travelDuration"]
-                        self.traveldistance.iloc[12*i+int(j/2)] = result["resourceSets"][0]["resources"][0]["routeLegs"][j]["travelDistance"]
-                        
-                except:
-                    #result may be empty
-                    warning = "Warning. No results received from Bing API"
-                    
-                self._printprogressbar(12*i+wp_i, len_s, prefix = 'Progress:', suffix = 'Complete', length = 50)
+                done += len(indexes)
+                self._printprogressbar(done, len_s, prefix = 'Progress:', suffix = 'Complete', length = 50)
+            
+            # Filling the flight distances that are still unknown with the coordinates of the routed legs, in one vectorized pass
+            flightdistance = pd.to_numeric(self.flightdistance, errors='coerce').to_numpy(dtype='float64')
+            routed_distance = self._haversine(start_lat, start_lon, end_lat, end_lon)
+            missing = (np.isnan(flightdistance) | (flightdistance == 0)) & ~np.isnan(routed_distance)
+            self.flightdistance = pd.Series(np.where(missing, routed_distance, flightdistance).astype('float32'), index=self.source.index)
+            
+            self.travelduration = pd.Series(duration, index=self.source.index)
+            self.traveldistance = pd.Series(distance, index=self.source.index)
                     
-            # Preparing the error mask to select the entries with no errors and log the ones with errors
-            error_mask = [i not in self.error_indexes for i in all_indexes]
+            # Preparing the error mask (NumPy boolean array) to select the entries with no errors and log the ones with errors
+            error_mask = self._errormask(len_s)
             
             #Creating the DataFrame containing the couples (Source Destination) for which we got a Travel Duration and Travel Distance
             self.donequeries  = pd.DataFrame({'KeyID': self.key,
@@ -407,10 +2046,32 @@ class BingMapsDTExtract:
                           'FlightDistance': self.flightdistance})[error_mask]
             
             #Creating the Dataframe containing the couples (Source Destination) for which we couldn't not get the Travel Duration and Travel Distance
-            self.errorqueries = pd.DataFrame({'Source': self.source,'Destination': self.destination, 'FlightDistance': self.flightdistance})[[not i for i in error_mask]]
+            self.errorqueries = pd.DataFrame({'Source': self.source,'Destination': self.destination, 'FlightDistance': self.flightdistance})[~error_mask]
+            
+            if self.routecache is not None:
+                self.routecache.store(self.donequeries)
+            
+            # Only the routes really sent to Bing go to the cache, the in-batch duplicates are added afterwards
+            self._expandduplicates()
+            
+            # Useful legs (Source > Destination of a couple) per request, the other legs only link two couples
+            self.usefullegs = len(positions) / max(len(batches), 1)
+            self.routedlegs = sum(batchlegs) / max(len(batches), 1)
+            print(str(len(positions)) + " couples routed in " + str(len(batches)) + " requests: " + str(round(self.usefullegs, 1)) + " useful legs per request out of " + str(round(self.routedlegs, 1)) + " routed")
+            
+            if (self.bisectrequests != 0):
+                print(str(self.bisectrequests) + " additional requests were used to isolate the couples in error")
+            
+            # Bytes received (on the wire and once gzip decoded) and JSON decoding time per request
+            requests = max(len(batches) + self.bisectrequests, 1)
+            self.wirebytesperbatch = (self.transport.bytes - wire_start) / requests
+            self.bytesperbatch = (self.metrics.counter("bing_response_bytes_total", endpoint="routes/driving") - bytes_start) / requests
+            self.parsesecondsperbatch = (self.metrics.histogram("bing_parse_seconds", endpoint="routes/driving")[0] - parse_start) / requests
+            print("Per request: " + str(round(self.wirebytesperbatch / 1024, 1)) + " KB downloaded (" + str(round(self.bytesperbatch / 1024, 1)) + " KB decoded), "
+                  + str(round(self.parsesecondsperbatch * 1000, 2)) + " ms of JSON parsing")
             
             if (len(self.error_indexes) != 0):
-                print("The script encountered a problem on the following indexes: " + str(self.error_indexes))
+                print("The script encountered a problem on the following indexes: " + str(sorted(self.error_indexes)))
                 
             if (len(warning) != 0):
                 print(warning)
@@ -419,14 +2080,160 @@ class BingMapsDTExtract:
             print("Source and destination lists have different lengths")
 
 
+    def _planbatches(self, positions, maxwaypoints = 25):
+        """
+        Private method. Ordering the couples in chains where the Destination of one couple is the Source of the next (Di == Sj), so that the leg between them is useful,
+        and cutting the chains into batches that fit in one request. Returns ([batches], [number of legs routed by each batch])
+        @params:
+            positions       - Required  : positions of the couples to route in self.source/self.destination (List)
+            maxwaypoints    - Optional  : maximum number of waypoints per request (Int)
+        """
+        from collections import defaultdict, deque
+        
+        sources = [str(v).strip() for v in self.source.iloc[positions]]
+        destinations = [str(v).strip() for v in self.destination.iloc[positions]]
+        
+        # Couples not used yet, by Source
+        by_source = defaultdict(deque)
+        for n in range(len(positions)):
+            by_source[sources[n]].append(n)
+        
+        used = [False] * len(positions)
+        destination_set = set(destinations)
+        order = []
+        
+        # Chains start preferably on a couple whose Source is nobody's Destination, then on the couples left (cycles)
+        starts = [n for n in range(len(positions)) if sources[n] not in destination_set] + list(range(len(positions)))
+        
+        for n in starts:
+            while not used[n]:
+                used[n] = True
+                order.append(n)
+                
+                following = by_source.get(destinations[n])
+                while following and used[following[0]]:
+                    following.popleft()
+                if not following:
+                    break
+                n = following[0]
+        
+        # Cutting the chains in batches of at most maxwaypoints waypoints, counted as _packwaypoints() packs them:
+        # a couple adds its Destination, and its Source unless it is the previous Destination
+        batches = []
+        legs = []
+        batch = []
+        waypoints = 0
+        previous = None
+        
+        for n in order:
+            added = 1 if previous is not None and destinations[previous] == sources[n] else 2
+            if len(batch) != 0 and waypoints + added > maxwaypoints:
+                batches.append(batch)
+                legs.append(waypoints - 1)
+                batch = []
+                waypoints = 0
+                added = 2
+            batch.append(positions[n])
+            waypoints += added
+            previous = n
+                
+        if len(batch) != 0:
+            batches.append(batch)
+            legs.append(waypoints - 1)
+            
+        return batches, legs
+
+
+    def _packwaypoints(self, indexes):
+        """
+        Private method. Waypoints of one request for a batch of couples, in order. When the Source of a couple is the last waypoint (the Destination of the previous couple)
+        it is not repeated. Returns (waypoints, {index: number of the leg going from its Source to its Destination})
+        @params:
+            indexes     - Required  : positions of the couples in self.source/self.destination (List)
+        """
+        waypoints = []
+        legs = {}
+        
+        for k in indexes:
+            
+            source = str(self.source.iloc[k])
+            
+            if len(waypoints) == 0 or waypoints[-1].strip() != source.strip():
+                waypoints.append(source)
+                
+            legs[k] = len(waypoints) - 1
+            waypoints.append(str(self.destination.iloc[k]))
+            
+        return waypoints, legs
+
+
+    def _routeurl(self, waypoints, bingMapsKey):
+        """
+        Private method. Building the Routes URL going through the waypoints in order
+        @params:
+            waypoints   - Required  : addresses of the waypoints, 25 at most (List)
+            bingMapsKey - Required  : Bing Maps key (Str)
+        """
+        import urllib.parse
+        
+        routeUrl = self.bingurl + "/V1/Routes/Driving?"
+        
+        for wp_i, waypoint in enumerate(waypoints):
+            routeUrl = routeUrl + "&wp." + str(wp_i) + "=" + urllib.parse.quote(waypoint, safe='')
+        
+        return routeUrl + self.ROUTEOPTIONS + "&key=" + bingMapsKey
+
+
+    def _routebatch(self, indexes, bingMapsKey):
+        """
+        Private method. Routing a batch of couples (see _planbatches()) in one request. When Bing rejects the request (4xx, typically a waypoint it cannot resolve),
+        the batch is split in halves recursively until the bad couple(s) are isolated: one bad couple among 12 costs about 2*log2(12) extra requests.
+        Returns ({index: Source > Destination routeLeg}, [indexes in error], number of requests sent, True if Bing sent an empty result)
+        @params:
+            indexes     - Required  : positions of the couples in self.source/self.destination (List)
+            bingMapsKey - Required  : Bing Maps key (Str)
+        """
+        import urllib.error
+        
+        try:
+            waypoints, legs = self._packwaypoints(indexes)
+            result = self._requestjson(self._routeurl(waypoints, bingMapsKey))
+            
+        except urllib.error.HTTPError as e:
+            # Only a waypoint Bing cannot resolve (400, 404) is worth splitting for. Throttling and server errors are already retried by _requestjson(),
+            # a rejected key raises BingAuthenticationError
+            if len(indexes) == 1 or e.code not in (400, 404):
+                return {}, list(indexes), 1, False
+            
+            half = len(indexes) // 2
+            legs, errors, requests, empty = self._routebatch(indexes[:half], bingMapsKey)
+            legs_2, errors_2, requests_2, empty_2 = self._routebatch(indexes[half:], bingMapsKey)
+            legs.update(legs_2)
+            
+            return legs, errors + errors_2, 1 + requests + requests_2, empty or empty_2
+        
+        except BingRunAborted:
+            raise
+        
+        except Exception:
+            return {}, list(indexes), 1, False
+        
+        try:
+            routeLegs = result["resourceSets"][0]["resources"][0]["routeLegs"]
+            return {k: routeLegs[leg] for k, leg in legs.items()}, [], 1, False
+        
+        except (KeyError, IndexError, TypeError):
+            return {}, list(indexes), 1, True
+
+
+    @_instrumented
     def extractdtfrombing_obo(self, file):
         """Extracting the TravelDuration and TravelTime using BingAPI one by one (obo)
         @params:
             file     - Required  :   path to the file where the BingMapsKey is stored (Str)
         """
         
-        import urllib.request
-        import json
+        import urllib.parse
         import pandas as pd
         
         len_s = len(self.source)
@@ -436,8 +2243,7 @@ class BingMapsDTExtract:
         bingMapsKey =  open(file, 'r').read()
         
         #Variables to log indexes of errors
-        self.error_indexes = []
-        all_indexes = list(range(0,len_s))
+        self.error_indexes = set()
         
         self._printprogressbar(0, len_s, prefix = 'Progress:', suffix = 'Complete', length = 50)
         
@@ -448,40 +2254,48 @@ class BingMapsDTExtract:
             
             indexes = []
             
+            # Inputs read once as arrays, results written in preallocated typed arrays and put in the output DataFrames once at the end
+            sources = self.source.to_numpy()
+            destinations = self.destination.to_numpy()
+            duration = pd.to_numeric(self.travelduration, errors='coerce').to_numpy(dtype='float32', copy=True)
+            distance = pd.to_numeric(self.traveldistance, errors='coerce').to_numpy(dtype='float32', copy=True)
+            
             for i in range(0,len_s):
 
-                routeUrl = "http://dev.virtualearth.net/REST/V1/Routes/Driving?"
+                routeUrl = self.bingurl + "/V1/Routes/Driving?"
                 
                 indexes.append(i)
                 
-                encodedSource = urllib.parse.quote(self.source.iloc[i], safe='')
-                encodedDest = urllib.parse.quote(self.destination.iloc[i], safe='')
+                encodedSource = urllib.parse.quote(sources[i], safe='')
+                encodedDest = urllib.parse.quote(destinations[i], safe='')
                 
-                routeUrl = routeUrl + "&wp.0="+ encodedSource + "&wp.1="+ encodedDest + "&key=" + bingMapsKey
+                routeUrl = routeUrl + "&wp.0="+ encodedSource + "&wp.1="+ encodedDest + self.ROUTEOPTIONS + "&key=" + bingMapsKey
                 
                 try:
-                    request = urllib .request.Request(routeUrl)
-                    response = urllib.request.urlopen(request)
-                
-                    r = response.read().decode(encoding="utf-8")
-                    result = json.loads(r)
+                    result = self._requestjson(routeUrl)
                     
+                except BingRunAborted:
+                    raise
+                
                 except:
-                    self.error_indexes.append(i)
+                    self.error_indexes.add(i)
         
                 try:
        
-                    self.travelduration.iloc[i] = result["resourceSets"][0]["resources"][0]["routeLegs"][0]["travelDuration"]
-                    self.traveldistance.iloc[i] = result["resourceSets"][0]["resources"][0]["routeLegs"][0]["travelDistance"]
+                    duration[i] = result["resourceSets"][0]["resources"][0]["routeLegs"][0]["travelDuration"]
+                    distance[i] = result["resourceSets"][0]["resources"][0]["routeLegs"][0]["travelDistance"]
                         
                 except:
                     #result may be empty
                     warning = "Warning. No results received from Bing API"
                     
                 self._printprogressbar(i, len_s, prefix = 'Progress:', suffix = 'Complete', length = 50)
+            
+            self.travelduration = pd.Series(duration, index=self.source.index)
+            self.traveldistance = pd.Series(distance, index=self.source.index)
                     
-            # Preparing the error mask to select the entries with no errors and log the ones with errors
-            error_mask = [i not in self.error_indexes for i in all_indexes]
+            # Preparing the error mask (NumPy boolean array) to select the entries with no errors and log the ones with errors
+            error_mask = self._errormask(len_s)
             
             #Creating the DataFrame containing the couples (Source Destination) for which we got a Travel Duration and Travel Distance
             self.donequeries  = pd.DataFrame({'KeyID': self.key,
@@ -491,10 +2305,16 @@ class BingMapsDTExtract:
                           'TravelDistance': self.traveldistance})[error_mask]
             
             #Creating the Dataframe containing the couples (Source Destination) for which we couldn't not get the Travel Duration and Travel Distance
-            self.errorqueries = pd.DataFrame({'Source': self.source,'Destination': self.destination})[[not i for i in error_mask]]
+            self.errorqueries = pd.DataFrame({'Source': self.source,'Destination': self.destination})[~error_mask]
+            
+            if self.routecache is not None:
+                self.routecache.store(self.donequeries)
+            
+            # Only the routes really sent to Bing go to the cache, the in-batch duplicates are added afterwards
+            self._expandduplicates()
             
             if (len(self.error_indexes) != 0):
-                print("The script encountered a problem on the following indexes: " + str(self.error_indexes))
+                print("The script encountered a problem on the following indexes: " + str(sorted(self.error_indexes)))
                 
             if (len(warning) != 0):
                 print(warning)
@@ -504,14 +2324,139 @@ class BingMapsDTExtract:
      
         
         
-    def extractcoorfrombing_obo_segmented(self, file):
+    @_instrumented
+    def extractmatrixfrombing(self, file, origins, destinations, workers = 1, maxcells = 2500):
+        """Extracting the TravelDuration and TravelDistance between every origin and every destination using the Bing Distance Matrix API
+        @params:
+            file            - Required  :   path to the file where the BingMapsKey is stored (Str)
+            origins         - Required  :   origins as "latitude,longitude" strings or (latitude, longitude) tuples (List)
+            destinations    - Required  :   destinations, same format as origins (List)
+            workers         - Optional  :   number of requests in flight at the same time (Int)
+            maxcells        - Optional  :   maximum number of origin x destination cells per request allowed by the service (Int)
+        NB: The Distance Matrix API only accepts coordinates: addresses must be geocoded first (extractcoorfrombing_obo).
+            The results are in self.matrixduration (seconds) and self.matrixdistance (km), NaN where Bing could not route. matrixtoqueries() flattens them.
+        """
+        
+        import numpy as np
+        
+        # Your Bing Maps Key 
+        bingMapsKey =  open(file, 'r').read()
+        
+        self.matrixorigins = [self._coordinates(o) for o in origins]
+        self.matrixdestinations = [self._coordinates(d) for d in destinations]
+        
+        n_o = len(self.matrixorigins)
+        n_d = len(self.matrixdestinations)
+        
+        self.matrixduration = np.full((n_o, n_d), np.nan)
+        self.matrixdistance = np.full((n_o, n_d), np.nan)
+        
+        if n_o == 0 or n_d == 0:
+            return
+        
+        # Largest tiles allowed by the service: all the destinations (up to maxcells) and as many origins as fit
+        tile_d = min(n_d, maxcells)
+        tile_o = max(1, min(n_o, maxcells // tile_d))
+        
+        tiles = [(o, d) for o in range(0, n_o, tile_o) for d in range(0, n_d, tile_d)]
+        
+        def requesttile(tile):
+            o, d = tile
+            payload = {"origins": [{"latitude": lat, "longitude": lon} for lat, lon in self.matrixorigins[o:o+tile_o]],
+                       "destinations": [{"latitude": lat, "longitude": lon} for lat, lon in self.matrixdestinations[d:d+tile_d]],
+                       "travelMode": "driving",
+                       "timeUnit": "second",
+                       "distanceUnit": "km"}
+            return self._requestjson(self.bingurl + "/v1/Routes/DistanceMatrix?key=" + bingMapsKey, payload)
+        
+        self.matrixrequests = len(tiles)
+        self.error_tiles = []
+        
+        self._printprogressbar(0, len(tiles), prefix = 'Progress:', suffix = 'Complete', length = 50)
+        
+        for done, ((o, d), result, error) in enumerate(self._runordered(requesttile, tiles, workers)):
+            
+            try:
+                if error is not None:
+                    raise error
+                
+                cells = result["resourceSets"][0]["resources"][0]["results"]
+                
+                origin_index = np.array([c["originIndex"] for c in cells], dtype=int) + o
+                destination_index = np.array([c["destinationIndex"] for c in cells], dtype=int) + d
+                duration = np.array([c.get("travelDuration", -1) for c in cells], dtype='float64')
+                distance = np.array([c.get("travelDistance", -1) for c in cells], dtype='float64')
+                
+                # Bing gives -1 for the cells it could not route
+                self.matrixduration[origin_index, destination_index] = np.where(duration < 0, np.nan, duration)
+                self.matrixdistance[origin_index, destination_index] = np.where(distance < 0, np.nan, distance)
+                
+            except Exception:
+                self.error_tiles.append((o, d))
+                
+            self._printprogressbar(done + 1, len(tiles), prefix = 'Progress:', suffix = 'Complete', length = 50)
+            
+        print(str(n_o) + " x " + str(n_d) + " matrix extracted in " + str(len(tiles)) + " requests. " + str(int(np.isnan(self.matrixduration).sum())) + " cells in error")
+
+
+    @_instrumented
+    def matrixtoqueries(self):
+        """Flattening the matrix of extractmatrixfrombing() into self.donequeries and self.errorqueries, with the same columns as extractdtfrombing()
+        NB: Source and Destination are the "latitude,longitude" of the origin and destination. FlightDistance is computed for every cell at once
+        """
+        
+        import numpy as np
+        import pandas as pd
+        
+        origins = np.array(["%s,%s" % o for o in self.matrixorigins], dtype=object)
+        destinations = np.array(["%s,%s" % d for d in self.matrixdestinations], dtype=object)
+        
+        n_o = len(origins)
+        n_d = len(destinations)
+        
+        source = np.repeat(origins, n_d)
+        destination = np.tile(destinations, n_o)
+        
+        latitude_o = np.repeat([o[0] for o in self.matrixorigins], n_d)
+        longitude_o = np.repeat([o[1] for o in self.matrixorigins], n_d)
+        latitude_d = np.tile([d[0] for d in self.matrixdestinations], n_o)
+        longitude_d = np.tile([d[1] for d in self.matrixdestinations], n_o)
+        
+        queries = pd.DataFrame({'KeyID': source + '+' + destination,
+                                'Source': source,
+                                'Destination': destination,
+                                'TravelDuration': self.matrixduration.ravel(),
+                                'TravelDistance': self.matrixdistance.ravel(),
+                                'FlightDistance': self._haversine(latitude_o, longitude_o, latitude_d, longitude_d)})
+        
+        error_mask = np.isnan(self.matrixduration.ravel())
+        
+        self.donequeries = queries[~error_mask]
+        self.errorqueries = queries[error_mask][['Source', 'Destination', 'FlightDistance']]
+        
+        if self.routecache is not None:
+            self.routecache.store(self.donequeries)
+
+
+    def _coordinates(self, point):
+        """
+        Private method. (latitude, longitude) floats from a "latitude,longitude" string or a (latitude, longitude) tuple
+        """
+        if isinstance(point, str):
+            point = point.split(",")
+        return float(point[0]), float(point[1])
+
+
+    @_instrumented
+    def extractcoorfrombing_obo_segmented(self, file, centroidfile = None):
         """Extracting the Latitude and Longitude using BingAPI one by one (obo) on segmented addresses
         @params:
-            file     - Required  :   path to the file where the BingMapsKey is stored (Str)
+            file            - Required  :   path to the file where the BingMapsKey is stored (Str)
+            centroidfile    - Optional  :   JSON file where the country/state centroids are kept across runs (Str)
         """
         
-        import urllib.request
-        import json
+        import urllib.parse
+        import numpy as np
         import pandas as pd
         
         len_a = len(self.countryregion)
@@ -519,9 +2464,11 @@ class BingMapsDTExtract:
         # Your Bing Maps Key 
         bingMapsKey =  open(file, 'r').read()
         
+        if centroidfile is not None:
+            self.centroids.load(centroidfile)
+        
         #Variables to log indexes of errors
-        self.error_indexes = []
-        all_indexes = list(range(0,len_a))
+        self.error_indexes = set()
         
         self._printprogressbar(0, len_a, prefix = 'Progress:', suffix = 'Complete', length = 50)
             
@@ -534,113 +2481,112 @@ class BingMapsDTExtract:
         self.locality = self.new['locality']
         self.postalcode = self.new['postalCode']
         self.addressline = self.new['addressLine']
+        
+        # Inputs read once as arrays, results written in preallocated typed arrays and put in the output DataFrame once at the end
+        countryregion = self.countryregion.astype(str).to_numpy()
+        admindistrict = self.admindistrict.astype(str).to_numpy()
+        locality = self.locality.astype(str).to_numpy()
+        postalcode = self.postalcode.astype(str).to_numpy()
+        addressline = self.addressline.astype(str).to_numpy()
+        
+        latitude = np.zeros(len_a, dtype='float64')
+        longitude = np.zeros(len_a, dtype='float64')
+        country_check = np.array(['0'] * len_a, dtype=object)
+        admdist_check = np.array(['0'] * len_a, dtype=object)
+        country_check_latitude = np.zeros(len_a, dtype='float64')
+        country_check_longitude = np.zeros(len_a, dtype='float64')
+        admdist_check_latitude = np.zeros(len_a, dtype='float64')
+        admdist_check_longitude = np.zeros(len_a, dtype='float64')
+        confidence = np.array([None] * len_a, dtype=object)
+        
+        # Addresses already resolved by a previous run, looked up in one pass before any request
+        keys = [self._geocodekey(segments) for segments in zip(countryregion, admindistrict, locality, postalcode, addressline)]
+        indexed = {}
+        newentries = {}
+        if self.geocodeindex is not None:
+            indexed = self.geocodeindex.lookup(set(keys))
             
         for i in range(0,len_a):
-
-            routeUrl = "http://dev.virtualearth.net/REST/v1/Locations" 
-                
+            
             indexes.append(i)
-                        
-            encoded_countryregion = urllib.parse.quote(str(self.countryregion.iloc[i]), safe='')
-            encoded_admindistrict = urllib.parse.quote(str(self.admindistrict.iloc[i]), safe='')
-            encoded_locality= urllib.parse.quote(str(self.locality.iloc[i]), safe='')
-            encoded_postalcode = urllib.parse.quote(str(self.postalcode.iloc[i]), safe='')
-            encoded_addressline= urllib.parse.quote(str(self.addressline.iloc[i]), safe='')
-                
-            routeUrl = routeUrl + "?countryRegion="+ encoded_countryregion +"&adminDistrict="+ encoded_admindistrict + "&locality="+ encoded_locality + "&postalCode=" + encoded_postalcode + "&addressLine=" + encoded_addressline + "&key=" + bingMapsKey
-            #print(routeUrl)
             
-            try:
-                request = urllib.request.Request(routeUrl)
-                response = urllib.request.urlopen(request)
+            if keys[i] in indexed:
                 
-                r = response.read().decode(encoding="utf-8")
-                result = json.loads(r)
-                    
-            except:
-                self.error_indexes.append(i)
-        
-            try:
-
-                self.latitude.iloc[i] = str("%.4f" % round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][0],4))
-                self.longitude.iloc[i] = str("%.4f" % round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][1],4))
-                self.country_check.iloc[i] = str(result["resourceSets"][0]["resources"][0]["address"]["countryRegion"])
-                self.admdist_check.iloc[i] = str(result["resourceSets"][0]["resources"][0]["address"]["adminDistrict"])
-                self.confidence.iloc[i] = str(result["resourceSets"][0]["resources"][0]["confidence"])
-                                        
-            except:
-                #result may be empty
-                warning = "Warning. No results received from Bing API"
+                latitude[i], longitude[i], country_check[i], admdist_check[i], confidence[i] = indexed[keys[i]]
+                result = None
                 
-            # Getting coordinates of the center of the country
-            routeUrl = "http://dev.virtualearth.net/REST/v1/Locations" 
-  
-            encodedCountry_check = urllib.parse.quote(str(self.country_check.iloc[i]), safe='')
-  
-            routeUrl = routeUrl + "?countryRegion="+ encodedCountry_check + "&key=" + bingMapsKey
-            
-            #print(routeUrl)
-            
-            try:
-                #print(1)
-                request = urllib.request.Request(routeUrl)
-                #print(2)
-                response = urllib.request.urlopen(request)
-                #print(3)
-                r = response.read().decode(encoding="utf-8")
-                #print(4)
-                result = json.loads(r)
-                #print(result)
+            else:
+                
+                routeUrl = self.bingurl + "/v1/Locations" 
+                        
+                encoded_countryregion = urllib.parse.quote(countryregion[i], safe='')
+                encoded_admindistrict = urllib.parse.quote(admindistrict[i], safe='')
+                encoded_locality= urllib.parse.quote(locality[i], safe='')
+                encoded_postalcode = urllib.parse.quote(postalcode[i], safe='')
+                encoded_addressline= urllib.parse.quote(addressline[i], safe='')
                     
-            except:
-                warning = "Country check coordinates error"
-                #print("Country check coordinates error")
+                routeUrl = routeUrl + "?countryRegion="+ encoded_countryregion +"&adminDistrict="+ encoded_admindistrict + "&locality="+ encoded_locality + "&postalCode=" + encoded_postalcode + "&addressLine=" + encoded_addressline + self.LOCATIONOPTIONS + "&key=" + bingMapsKey
+                
+                try:
+                    result = self._requestjson(routeUrl)
+                        
+                except BingRunAborted:
+                    raise
                 
+                except:
+                    self.error_indexes.add(i)
+                    result = None
+        
             try:
-
-                self.country_check_latitude.iloc[i] = str("%.4f" % round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][0],4))
-                self.country_check_longitude.iloc[i] = str("%.4f" % round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][1],4))
-                                    
+                
+                if result is not None:
+                    latitude[i] = round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][0],4)
+                    longitude[i] = round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][1],4)
+                    country_check[i] = str(result["resourceSets"][0]["resources"][0]["address"]["countryRegion"])
+                    admdist_check[i] = str(result["resourceSets"][0]["resources"][0]["address"]["adminDistrict"])
+                    confidence[i] = str(result["resourceSets"][0]["resources"][0]["confidence"])
+                    
+                    newentries[keys[i]] = (latitude[i], longitude[i], country_check[i], admdist_check[i], confidence[i])
+                                        
             except:
-                #print("Country check coordinates error")
-                self.country_check_latitude.iloc[i] = 0
-                self.country_check_longitude.iloc[i] = 0
+                #result may be empty
+                warning = "Warning. No results received from Bing API"
                 
+            # Getting coordinates of the center of the country, each country is only queried once. No country to check for an address that was not geocoded
+            if i not in self.error_indexes and country_check[i] != '0':
                 
-            # Getting coordinates of the center of the state for the United States
-            if self.countryregion.iloc[i] == "United States":
-                routeUrl = "http://dev.virtualearth.net/REST/v1/Locations" 
-      
-                encodedCountry_check = urllib.parse.quote(str(self.country_check.iloc[i]), safe='')
-                encodedAdmdist_check = urllib.parse.quote(str(self.admdist_check.iloc[i]), safe='')
-      
-                routeUrl = routeUrl + "?countryRegion="+ encodedCountry_check +"&adminDistrict="+ encodedAdmdist_check + "&key=" + bingMapsKey
+                centroid = self._getcentroid(bingMapsKey, country_check[i])
                 
-                try:
-                    request = urllib.request.Request(routeUrl)
-                    response = urllib.request.urlopen(request)
+                if centroid is not None:
+                    country_check_latitude[i], country_check_longitude[i] = centroid
+                else:
+                    warning = "Country check coordinates error"
                     
-                    r = response.read().decode(encoding="utf-8")
-                    result = json.loads(r)
-                        
-                except:
-                    warning = "State check coordinates error"
-                    print("State check coordinates error")
+                # Getting coordinates of the center of the state for the United States, each state is only queried once
+                if countryregion[i] == "United States":
                     
-                try:
-    
-                    self.admdist_check_latitude.iloc[i] = str("%.4f" % round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][0],4))
-                    self.admdist_check_longitude.iloc[i] = str("%.4f" % round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][1],4))
-                                            
-                except:
-                    print("Country check coordinates error")
-                    self.admdist_check_latitude.iloc[i] = 0
-                    self.admdist_check_longitude.iloc[i] = 0
+                    centroid = self._getcentroid(bingMapsKey, country_check[i], admdist_check[i])
+                    
+                    if centroid is not None:
+                        admdist_check_latitude[i], admdist_check_longitude[i] = centroid
+                    else:
+                        warning = "State check coordinates error"
                     
             self._printprogressbar(i, len_a, prefix = 'Progress:', suffix = 'Complete', length = 50)
+        
+        index = self.countryregion.index
+        self.latitude = pd.Series(latitude, index=index)
+        self.longitude = pd.Series(longitude, index=index)
+        self.country_check = pd.Series(country_check, index=index)
+        self.admdist_check = pd.Series(admdist_check, index=index)
+        self.country_check_latitude = pd.Series(country_check_latitude, index=index)
+        self.country_check_longitude = pd.Series(country_check_longitude, index=index)
+        self.admdist_check_latitude = pd.Series(admdist_check_latitude, index=index)
+        self.admdist_check_longitude = pd.Series(admdist_check_longitude, index=index)
+        self.confidence = pd.Series(pd.Categorical(confidence), index=index)
                     
-        # Preparing the error mask to select the entries with no errors and log the ones with errors
-        error_mask = [i not in self.error_indexes for i in all_indexes]
+        # Preparing the error mask (NumPy boolean array) to select the entries with no errors and log the ones with errors
+        error_mask = self._errormask(len_a)
             
         #Creating the DataFrame containing the couples (Source Destination) for which we got a Travel Duration and Travel Distance
 
@@ -663,22 +2609,32 @@ class BingMapsDTExtract:
 
             
         #Creating the Dataframe containing the couples (Source Destination) for which we couldn't not get the Travel Duration and Travel Distance
-        self.errorqueries = pd.DataFrame({'Address': self.addressline})[[not i for i in error_mask]]
+        self.errorqueries = pd.DataFrame({'Address': self.addressline})[~error_mask]
+            
+        self.centroids.save()
+        
+        if self.geocodeindex is not None:
+            self.geocodeindex.store(newentries)
+            self.metrics.inc("geocodeindex_hits_total", len(indexed))
+            print(str(len(indexed)) + " addresses found in the geocode index without calling Bing, " + str(len(newentries)) + " added")
             
         if (len(self.error_indexes) != 0):
-            print("The script encountered a problem on the following indexes: " + str(self.error_indexes))
+            print("The script encountered a problem on the following indexes: " + str(sorted(self.error_indexes)))
                 
         if (len(warning) != 0):
             print(warning)
             
-    def extractcoorfrombing_obo(self, file):
+    @_instrumented
+    def extractcoorfrombing_obo(self, file, centroidfile = None, journal = None):
         """Extracting the Latitude and Longitude using BingAPI one by one (obo)
         @params:
-            file     - Required  :   path to the file where the BingMapsKey is stored (Str)
+            file            - Required  :   path to the file where the BingMapsKey is stored (Str)
+            centroidfile    - Optional  :   JSON file where the country/state centroids are kept across runs (Str)
+            journal         - Optional  :   path to the checkpoint journal. Addresses already in the journal are not geocoded again (Str)
         """
         
-        import urllib.request
-        import json
+        import urllib.parse
+        import numpy as np
         import pandas as pd
         
         len_a = len(self.address)
@@ -686,80 +2642,132 @@ class BingMapsDTExtract:
         # Your Bing Maps Key 
         bingMapsKey =  open(file, 'r').read()
         
+        if centroidfile is not None:
+            self.centroids.load(centroidfile)
+        
         #Variables to log indexes of errors
-        self.error_indexes = []
-        all_indexes = list(range(0,len_a))
+        self.error_indexes = set()
         
         self._printprogressbar(0, len_a, prefix = 'Progress:', suffix = 'Complete', length = 50)
             
         warning = ""
             
         indexes = []
+        
+        # Restoring the addresses already completed by an interrupted run
+        finished = self._openjournal(journal, "extractcoorfrombing_obo")
+        
+        # Inputs read once as an array, results written in preallocated typed arrays and put in the output DataFrame once at the end
+        address = self.address.astype(str).to_numpy()
+        
+        latitude = np.zeros(len_a, dtype='float64')
+        longitude = np.zeros(len_a, dtype='float64')
+        country_check = np.array(['0'] * len_a, dtype=object)
+        country_check_latitude = np.zeros(len_a, dtype='float64')
+        country_check_longitude = np.zeros(len_a, dtype='float64')
+        confidence = np.array([None] * len_a, dtype=object)
+        
+        # Normalized address -> index of the row where it was geocoded, so that variants of an address are only sent once
+        geocoded = {}
+        self.geocodereused = 0
+        
+        # Addresses already resolved by a previous run, looked up in one pass before any request
+        indexed = {}
+        newentries = {}
+        if self.geocodeindex is not None:
+            indexed = self.geocodeindex.lookup(set(self._geocodekey(a) for a in address))
             
-        for i in range(0,len_a):
-
-            routeUrl = "http://dev.virtualearth.net/REST/v1/Locations" 
+        # The journal entries are written in groups: one fsync per group instead of one per address, only the last group can be lost in a crash
+        try:
+            for i in range(0,len_a):
+            
+                indexes.append(i)
+            
+                canonical = self.normalizer.normalize(address[i]) if self.normalizer is not None else None
+                key = self._geocodekey(address[i])
+            
+                if address[i] in finished:
                 
-            indexes.append(i)
-  
-            encodedAddress = urllib.parse.quote(str(self.address.iloc[i]), safe='')
+                    latitude[i], longitude[i], country_check[i], confidence[i] = finished[address[i]]
                 
-            routeUrl = routeUrl + "?q="+ encodedAddress+ "&key=" + bingMapsKey
-            print(routeUrl)
-            
-            try:
-                request = urllib.request.Request(routeUrl)
-                response = urllib.request.urlopen(request)
+                elif key in indexed:
                 
-                r = response.read().decode(encoding="utf-8")
-                result = json.loads(r)
-                    
-            except:
-                self.error_indexes.append(i)
-        
-            try:
-
-                self.latitude.iloc[i] = str("%.4f" %round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][0],4))
-                self.longitude.iloc[i] = str("%.4f" %round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][1],4))
-                self.country_check.iloc[i] = str(result["resourceSets"][0]["resources"][0]["address"]["countryRegion"])
-                self.confidence.iloc[i] = str(result["resourceSets"][0]["resources"][0]["confidence"])
-                                        
-            except:
-                #result may be empty
-                warning = "Warning. No results received from Bing API"
+                    latitude[i], longitude[i], country_check[i], _, confidence[i] = indexed[key]
                 
+                elif canonical in geocoded:
                 
-            routeUrl = "http://dev.virtualearth.net/REST/v1/Locations" 
-  
-            encodedCountry_check = urllib.parse.quote(str(self.country_check.iloc[i]), safe='')
-  
-            routeUrl = routeUrl + "?countryRegion="+ encodedCountry_check + "&key=" + bingMapsKey
-            
-            try:
-                request = urllib.request.Request(routeUrl)
-                response = urllib.request.urlopen(request)
+                    j = geocoded[canonical]
+                    latitude[i], longitude[i], country_check[i], confidence[i] = latitude[j], longitude[j], country_check[j], confidence[j]
+                    self.geocodereused += 1
                 
-                r = response.read().decode(encoding="utf-8")
-                result = json.loads(r)
+                else:
+
+                    routeUrl = self.bingurl + "/v1/Locations" 
+  
+                    encodedAddress = urllib.parse.quote(address[i], safe='')
                     
-            except:
-                print("Country check coordinates error")
+                    routeUrl = routeUrl + "?q="+ encodedAddress + self.LOCATIONOPTIONS + "&key=" + bingMapsKey
                 
-            try:
-
-                self.country_check_latitude.iloc[i] = str("%.4f" % round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][0],4))
-                self.country_check_longitude.iloc[i] = str("%.4f" % round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][1],4))
-                                        
-            except:
-                print("Country check coordinates error")
-                self.country_check_latitude.iloc[i] = 0
-                self.country_check_longitude.iloc[i] = 0
+                    requested = True
+                    # A failed request must not leave the answer of the previous address in result
+                    result = None
+                
+                    try:
+                        result = self._requestjson(routeUrl)
+                        
+                    except BingRunAborted:
+                        raise
+                
+                    except:
+                        self.error_indexes.add(i)
+                        requested = False
             
+                    try:
+    
+                        latitude[i] = round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][0],4)
+                        longitude[i] = round(result["resourceSets"][0]["resources"][0]["point"]["coordinates"][1],4)
+                        country_check[i] = str(result["resourceSets"][0]["resources"][0]["address"]["countryRegion"])
+                        confidence[i] = str(result["resourceSets"][0]["resources"][0]["confidence"])
                     
-            self._printprogressbar(i, len_a, prefix = 'Progress:', suffix = 'Complete', length = 50)
+                        if canonical is not None and requested:
+                            geocoded[canonical] = i
+                        
+                        if requested:
+                            newentries[key] = (latitude[i], longitude[i], country_check[i], None, confidence[i])
+                    
+                        if self.journal is not None and requested:
+                            self.journal.buffer({address[i]: [float(latitude[i]), float(longitude[i]), country_check[i], confidence[i]]})
+                                            
+                    except:
+                        #result may be empty
+                        warning = "Warning. No results received from Bing API"
+                
+                
+                # Getting coordinates of the center of the country, each country is only queried once. No country to check for an address that was not geocoded
+                if i not in self.error_indexes and country_check[i] != '0':
+                
+                    centroid = self._getcentroid(bingMapsKey, country_check[i])
+                
+                    if centroid is not None:
+                        country_check_latitude[i], country_check_longitude[i] = centroid
+                    else:
+                        print("Country check coordinates error")
                     
-        # Preparing the error mask to select the entries with no errors and log the ones with errors
-        error_mask = [i not in self.error_indexes for i in all_indexes]
+                self._printprogressbar(i, len_a, prefix = 'Progress:', suffix = 'Complete', length = 50)
+        finally:
+            if self.journal is not None:
+                self.journal.flush()
+        
+        index = self.address.index
+        self.latitude = pd.Series(latitude, index=index)
+        self.longitude = pd.Series(longitude, index=index)
+        self.country_check = pd.Series(country_check, index=index)
+        self.country_check_latitude = pd.Series(country_check_latitude, index=index)
+        self.country_check_longitude = pd.Series(country_check_longitude, index=index)
+        self.confidence = pd.Series(pd.Categorical(confidence), index=index)
+                    
+        # Preparing the error mask (NumPy boolean array) to select the entries with no errors and log the ones with errors
+        error_mask = self._errormask(len_a)
             
         #Creating the DataFrame containing the couples (Source Destination) for which we got a Travel Duration and Travel Distance
         
@@ -773,67 +2781,657 @@ class BingMapsDTExtract:
 
             
         #Creating the Dataframe containing the couples (Source Destination) for which we couldn't not get the Travel Duration and Travel Distance
-        self.errorqueries = pd.DataFrame({'Address': self.address})[[not i for i in error_mask]]
+        self.errorqueries = pd.DataFrame({'Address': self.address})[~error_mask]
+            
+        self.centroids.save()
+        
+        if self.geocodeindex is not None:
+            self.geocodeindex.store(newentries)
+            self.metrics.inc("geocodeindex_hits_total", len(indexed))
+            print(str(len(indexed)) + " addresses found in the geocode index without calling Bing, " + str(len(newentries)) + " added")
+        
+        if self.normalizer is not None:
+            print(str(self.geocodereused) + " of " + str(len_a) + " addresses reused the result of a normalized duplicate (" + str(self.geocodereused) + " API calls avoided)")
             
         if (len(self.error_indexes) != 0):
-            print("The script encountered a problem on the following indexes: " + str(self.error_indexes))
+            print("The script encountered a problem on the following indexes: " + str(sorted(self.error_indexes)))
                 
         if (len(warning) != 0):
             print(warning)
 
                     
                     
-    def storequeries(self, server, db, table_done, table_errors):
+    @_instrumented
+    def extractcoorfrombing_dataflow(self, file, centroidfile = None, jobsize = 200000, poll = 15, timeout = 86400):
+        """Extracting the Latitude and Longitude with the Geocode Dataflow of the Bing Spatial Data Services: the addresses are uploaded as batch jobs,
+        polled until Bing completes them and the results downloaded, instead of one request per address. Same outputs as extractcoorfrombing_obo()
+        @params:
+            file            - Required  :   path to the file where the BingMapsKey is stored (Str)
+            centroidfile    - Optional  :   JSON file where the country/state centroids are kept across runs (Str)
+            jobsize         - Optional  :   number of addresses per job, Bing accepts at most 200 000 (Int)
+            poll            - Optional  :   seconds between two status requests of the pending jobs (Float)
+            timeout         - Optional  :   seconds after which the jobs still pending are given up, their addresses are logged as errors (Float)
+        NB: Each distinct address (normalized address when the instance normalizes them) is sent once.
+            The ids of the jobs aborted, failed or given up are kept in self.failedjobs, their addresses go to errorqueries
+        """
+        
+        import time
+        import numpy as np
+        import pandas as pd
+        
+        len_a = len(self.address)
+        
+        # Your Bing Maps Key 
+        bingMapsKey =  open(file, 'r').read()
+        
+        if centroidfile is not None:
+            self.centroids.load(centroidfile)
+        
+        #Variables to log indexes of errors
+        self.error_indexes = set()
+        
+        address = self.address.astype(str).to_numpy()
+        
+        # One entity per distinct address, its Id is its position in queries
+        canonical = np.array([self.normalizer.normalize(a) for a in address], dtype=object) if self.normalizer is not None else address
+        uniques, first, inverse = np.unique(canonical, return_index=True, return_inverse=True)
+        queries = address[first]
+        
+        # Entity Id: (Latitude, Longitude, Country_check, Confidence), starting with the addresses already resolved by a previous run
+        results = {}
+        keys = [self._geocodekey(q) for q in queries]
+        if self.geocodeindex is not None:
+            indexed = self.geocodeindex.lookup(keys)
+            results = {e: (v[0], v[1], v[2], v[4]) for e, k in enumerate(keys) if k in indexed for v in [indexed[k]]}
+            self.metrics.inc("geocodeindex_hits_total", len(results))
+            print(str(len(results)) + " distinct addresses found in the geocode index without calling Bing")
+            
+        ids = [e for e in range(len(queries)) if e not in results]
+        
+        # Jobs that could not be created or followed: their addresses are logged as errors, the other jobs go on
+        self.failedjobs = []
+        jobs = []
+        
+        for start in range(0, len(ids), jobsize):
+            try:
+                jobs.append(self._submitgeocodejob(queries[ids[start:start+jobsize]], ids[start:start+jobsize], bingMapsKey))
+            except BingRunAborted:
+                raise
+            except Exception as e:
+                print("Dataflow job of the addresses " + str(start) + " to " + str(min(start + jobsize, len(ids)) - 1) + " not created: " + str(e))
+        
+        print(str(len(ids)) + " distinct addresses out of " + str(len_a) + " uploaded in " + str(len(jobs)) + " dataflow job(s)")
+        pending = list(jobs)
+        deadline = time.time() + timeout
+        
+        while len(pending) != 0:
+            
+            for job in list(pending):
+                
+                # A status or download still failing after the retries of _request() only fails this job
+                try:
+                    resource = self._requestjson(self.spatialurl + "/v1/Dataflows/Geocode/" + job + "?output=json&key=" + bingMapsKey)["resourceSets"][0]["resources"][0]
+                    
+                    if resource["status"] == "Completed":
+                        pending.remove(job)
+                        results.update(self._geocodejobresults(resource, bingMapsKey))
+                        
+                    elif resource["status"] == "Aborted":
+                        pending.remove(job)
+                        self.failedjobs.append(job)
+                        print("Dataflow job " + job + " aborted by Bing: " + str(resource.get("errorMessage", "")))
+                        
+                except BingRunAborted:
+                    raise
+                
+                except Exception as e:
+                    pending.remove(job)
+                    self.failedjobs.append(job)
+                    print("Dataflow job " + job + " failed: " + str(e))
+                    
+            self._printprogressbar(len(jobs) - len(pending), len(jobs), prefix = 'Jobs:', suffix = 'Complete', length = 50)
+            
+            if len(pending) != 0:
+                if time.time() >= deadline:
+                    print("Dataflow job(s) still pending after " + str(timeout) + " seconds, given up: " + ", ".join(pending))
+                    self.failedjobs.extend(pending)
+                    break
+                time.sleep(poll)
+        
+        if self.geocodeindex is not None:
+            uploaded = set(ids)
+            self.geocodeindex.store({keys[e]: (lat, lon, country, None, conf) for e, (lat, lon, country, conf) in results.items() if e in uploaded})
+        
+        # Results written in preallocated typed arrays, as in extractcoorfrombing_obo()
+        latitude = np.zeros(len_a, dtype='float64')
+        longitude = np.zeros(len_a, dtype='float64')
+        country_check = np.array(['0'] * len_a, dtype=object)
+        country_check_latitude = np.zeros(len_a, dtype='float64')
+        country_check_longitude = np.zeros(len_a, dtype='float64')
+        confidence = np.array([None] * len_a, dtype=object)
+        
+        for i in range(0, len_a):
+            
+            result = results.get(int(inverse[i]))
+            
+            if result is None:
+                self.error_indexes.add(i)
+                continue
+            
+            latitude[i], longitude[i], country_check[i], confidence[i] = result
+            
+            # Getting coordinates of the center of the country, each country is only queried once
+            centroid = self._getcentroid(bingMapsKey, country_check[i])
+            
+            if centroid is not None:
+                country_check_latitude[i], country_check_longitude[i] = centroid
+            else:
+                print("Country check coordinates error")
+        
+        index = self.address.index
+        self.latitude = pd.Series(latitude, index=index)
+        self.longitude = pd.Series(longitude, index=index)
+        self.country_check = pd.Series(country_check, index=index)
+        self.country_check_latitude = pd.Series(country_check_latitude, index=index)
+        self.country_check_longitude = pd.Series(country_check_longitude, index=index)
+        self.confidence = pd.Series(pd.Categorical(confidence), index=index)
+                    
+        # Preparing the error mask (NumPy boolean array) to select the entries with no errors and log the ones with errors
+        error_mask = self._errormask(len_a)
+        
+        self.donequeries  = pd.DataFrame({'Adresses': self.address,
+                                          'Latitude': self.latitude,
+                                          'Longitude': self.longitude,
+                                          'Country_check' : self.country_check,
+                                          'Country_check latitude' : self.country_check_latitude,
+                                          'Country_check longitude' : self.country_check_longitude,
+                                          'Confidence' : self.confidence})[error_mask]
+        
+        self.errorqueries = pd.DataFrame({'Address': self.address})[~error_mask]
+            
+        self.centroids.save()
+        
+        print(str(len_a - len(self.error_indexes)) + " addresses geocoded with " + str(len(jobs)) + " dataflow job(s), " + str(len(self.error_indexes)) + " errors")
+        
+    def _submitgeocodejob(self, queries, ids, bingMapsKey):
+        """
+        Private method. Uploading addresses as a Geocode Dataflow job (pipe delimited, schema 2.0) and returning the job id
+        @params:
+            queries     - Required  : addresses of the job (Array)
+            ids         - Required  : Id of each address (List)
+            bingMapsKey - Required  : Bing Maps Key (Str)
+        """
+        import json
+        
+        lines = ["Bing Spatial Data Services, 2.0", "|".join(self.GEOCODEFIELDS)]
+        
+        for entity, query in zip(ids, queries):
+            # The pipe and the line breaks are the separators of the format
+            query = " ".join(str(query).replace("|", " ").split())
+            lines.append("|".join([str(entity), "en-US", query] + [""] * (len(self.GEOCODEFIELDS) - 3)))
+            
+        result = self._request(self.spatialurl + "/v1/Dataflows/Geocode?input=pipe&output=json&key=" + bingMapsKey,
+                               "\n".join(lines).encode("utf-8"), "text/plain; charset=utf-8", json.loads)
+        
+        return result["resourceSets"][0]["resources"][0]["id"]
+        
+    def _geocodejobresults(self, resource, bingMapsKey):
+        """
+        Private method. Downloading the succeeded entities of a completed Geocode Dataflow job and returning {Id: (Latitude, Longitude, Country_check, Confidence)}
+        @params:
+            resource    - Required  : status resource of the completed job (Dict)
+            bingMapsKey - Required  : Bing Maps Key (Str)
+        """
+        results = {}
+        
+        for link in resource.get("links", []):
+            
+            if link.get("role") != "output" or link.get("name") != "succeeded":
+                continue
+            
+            url = link["url"]
+            text = self._request(url + ("&" if "?" in url else "?") + "key=" + bingMapsKey).decode("utf-8")
+            
+            header = None
+            
+            for line in text.splitlines():
+                values = line.split("|")
+                
+                if header is None:
+                    if values[0] == "Id":
+                        header = values
+                    continue
+                
+                row = dict(zip(header, values))
+                
+                try:
+                    results[int(row["Id"])] = (round(float(row["GeocodeResponse/Point/Latitude"]), 4),
+                                               round(float(row["GeocodeResponse/Point/Longitude"]), 4),
+                                               row.get("GeocodeResponse/Address/CountryRegion", ""),
+                                               row.get("GeocodeResponse/Confidence", ""))
+                except (KeyError, ValueError):
+                    # Entity without a point: logged as an error by the caller
+                    pass
+                
+        return results
+    
+    @_instrumented
+    def geocodeaddresses(self, file, addresses, workers = 1):
+        """Pandas-free geocoding of a list of addresses: only the standard library is imported, for short-lived workers that do not need the SQL and DataFrame paths.
+        The geocode index (opengeocodeindex()) is checked first, each distinct address (normalized address when the instance normalizes them) is requested once
+        @params:
+            file            - Required  :   path to the file where the BingMapsKey is stored (Str)
+            addresses       - Required  :   addresses to geocode (List)
+            workers         - Optional  :   number of requests in flight at the same time (Int)
+        Returns a list with, for each address, (Latitude, Longitude, Country_check, Country_check latitude, Country_check longitude, Confidence) or None when Bing could not geocode it
+        """
+        
+        import urllib.parse
+        
+        bingMapsKey =  open(file, 'r').read()
+        
+        keys = [self._geocodekey(a) for a in addresses]
+        
+        # Key: (Latitude, Longitude, Country_check, Confidence)
+        found = {}
+        if self.geocodeindex is not None:
+            found = {k: (v[0], v[1], v[2], v[4]) for k, v in self.geocodeindex.lookup(set(keys)).items()}
+            self.metrics.inc("geocodeindex_hits_total", len(found))
+        
+        # First address of each key not indexed yet
+        todo = {}
+        for address, key in zip(addresses, keys):
+            if key not in found and key not in todo:
+                todo[key] = address
+        
+        def geocode(key):
+            result = self._requestjson(self.bingurl + "/v1/Locations?q=" + urllib.parse.quote(str(todo[key]), safe='') + self.LOCATIONOPTIONS + "&key=" + bingMapsKey)
+            resource = result["resourceSets"][0]["resources"][0]
+            return (round(resource["point"]["coordinates"][0], 4), round(resource["point"]["coordinates"][1], 4),
+                    str(resource["address"]["countryRegion"]), str(resource["confidence"]))
+        
+        newentries = {}
+        for key, result, error in self._runordered(geocode, list(todo), workers):
+            if error is None:
+                found[key] = result
+                newentries[key] = (result[0], result[1], result[2], None, result[3])
+                
+        if self.geocodeindex is not None:
+            self.geocodeindex.store(newentries)
+        
+        results = []
+        for key in keys:
+            result = found.get(key)
+            if result is not None:
+                # Getting coordinates of the center of the country, each country is only queried once
+                centroid = self._getcentroid(bingMapsKey, result[2]) or (0.0, 0.0)
+                result = (result[0], result[1], result[2], centroid[0], centroid[1], result[3])
+            results.append(result)
+            
+        print(str(len(addresses)) + " addresses geocoded with " + str(len(todo)) + " requests, " + str(results.count(None)) + " errors")
+        
+        return results
+        
+    @_instrumented
+    def storequeries(self, server, db, table_done, table_errors, chunksize = 10000, upsert = False):
         """Storing the results and errors in SQL
         @params: 
             server          - Required  :  SQL Server name (Str)
             db:             - Required  :  Data Base name (Str)
             table_done:     - Required  :  Table name to store the good results (Str)
             table_errors:   - Required  :  Table name to store the errors (Str)
+            chunksize       - Optional  :  number of rows sent per executemany batch (Int)
+            upsert          - Optional  :  loading through a staging table merged on the key, so that a re-run does not duplicate keys (Bool)
         """
         
-        import sqlalchemy
-        
         self.server = server
         self.db = db
         
-        encoding='utf-8'
-        driver = 'SQL+Server'
+        self._storequeries(self._getengine(server, db), table_done, table_errors, chunksize, upsert)
+        
+    def _storequeries(self, engine, table_done, table_errors, chunksize = 10000, upsert = False):
+        """
+        Private method. Writing donequeries and errorqueries with the given SQLAlchemy engine and reporting the rows per second
+        @params:
+            engine          - Required  :  SQLAlchemy engine (Engine)
+            table_done:     - Required  :  Table name to store the good results (Str)
+            table_errors:   - Required  :  Table name to store the errors (Str)
+            chunksize       - Optional  :  number of rows sent per executemany batch (Int)
+            upsert          - Optional  :  merging on the key through a staging table instead of appending (Bool)
+        """
+        import time
+        
+        start = time.time()
+        
+        for frame, table in ((self.donequeries, table_done), (self.errorqueries, table_errors)):
+            with self.metrics.timer("sql_write_seconds", table=table):
+                if upsert:
+                    self._upsert(engine, frame, table, chunksize)
+                else:
+                    frame.to_sql(table, con=engine, if_exists='append', index=False, chunksize=chunksize)
+            self.metrics.inc("sql_rows_written_total", len(frame), table=table)
+                
+        elapsed = time.time() - start
+        rows = len(self.donequeries) + len(self.errorqueries)
+        self.storerowspersecond = rows / elapsed if elapsed > 0 else float("inf")
+        
+        print(str(rows) + " rows stored in " + str(round(elapsed, 2)) + " seconds (" + str(int(self.storerowspersecond)) + " rows/s)")
+        
+        # The results are stored: the checkpoint journal must not be replayed on top of them
+        if self.journal is not None:
+            self.journal.clear()
+            self.journal = None
+        
+    def _upsert(self, engine, frame, table, chunksize = 10000):
+        """
+        Private method. Bulk loading frame in a staging table then merging it into table on its key: [KeyID] if present, else [Source] and [Destination], else the first column.
+        MERGE on SQL Server, DELETE + INSERT in one transaction on the other databases
+        @params:
+            engine      - Required  :  SQLAlchemy engine (Engine)
+            frame       - Required  :  rows to store (DataFrame)
+            table       - Required  :  target table name (Str)
+            chunksize   - Optional  :  number of rows sent per executemany batch (Int)
+        """
+        import sqlalchemy
+        
+        if 'KeyID' in frame.columns:
+            keys = ['KeyID']
+        elif 'Source' in frame.columns and 'Destination' in frame.columns:
+            keys = ['Source', 'Destination']
+        else:
+            keys = [frame.columns[0]]
+        
+        staging = table + "_staging"
+        quote = engine.dialect.identifier_preparer.quote
+        columns = [quote(c) for c in frame.columns]
+        
+        # Creating the target table with the right columns if it does not exist yet
+        if not sqlalchemy.inspect(engine).has_table(table):
+            frame.head(0).to_sql(table, con=engine, index=False)
+        
+        # One row per key: a key repeated in the batch would be inserted twice by DELETE + INSERT and makes MERGE fail on SQL Server
+        frame = frame.drop_duplicates(subset=keys, keep='last')
+        
+        frame.to_sql(staging, con=engine, if_exists='replace', index=False, chunksize=chunksize)
+        
+        on = " AND ".join("t." + quote(k) + " = s." + quote(k) for k in keys)
+        
+        with engine.begin() as connection:
+            if engine.dialect.name == 'mssql':
+                update = ", ".join("t." + c + " = s." + c for c in columns)
+                connection.execute(sqlalchemy.text("MERGE INTO " + quote(table) + " AS t USING " + quote(staging) + " AS s ON " + on +
+                                                   " WHEN MATCHED THEN UPDATE SET " + update +
+                                                   " WHEN NOT MATCHED THEN INSERT (" + ", ".join(columns) + ") VALUES (" + ", ".join("s." + c for c in columns) + ");"))
+            else:
+                matched = " AND ".join(quote(table) + "." + quote(k) + " = s." + quote(k) for k in keys)
+                connection.execute(sqlalchemy.text("DELETE FROM " + quote(table) + " WHERE EXISTS (SELECT 1 FROM " + quote(staging) + " s WHERE " + matched + ")"))
+                connection.execute(sqlalchemy.text("INSERT INTO " + quote(table) + " (" + ", ".join(columns) + ") SELECT " + ", ".join(columns) + " FROM " + quote(staging)))
+            connection.execute(sqlalchemy.text("DROP TABLE " + quote(staging)))
+
+
+    @_instrumented
+    def resumeextraction(self, file, journal, **kwargs):
+        """Resuming an interrupted extraction from its checkpoint journal: only the entries not in the journal are sent to Bing
+        @params:
+            file     - Required  :   path to the file where the BingMapsKey is stored (Str)
+            journal  - Required  :   path to the checkpoint journal given to the interrupted extract method (Str)
+            kwargs   - Optional  :   other parameters of the extract method (workers, centroidfile...)
+        NB: The inputs must be prepared again first (getnewqueries/cleanqueries or getnewaddresses) exactly as for the interrupted run.
+            storequeries() deletes the journal once the results are written, so resuming after a successful store does nothing twice.
+        """
+        
+        method, finished = _Journal(journal).load()
+        
+        if method is None:
+            print("Nothing to resume: the journal " + journal + " is empty or does not exist")
+            return
+        
+        getattr(self, method)(file, journal=journal, **kwargs)
+
+
+    def selectshard(self, shard, shards, unordered = False):
+        """ Keeping in self.new only the queries of one shard, picked by the crc32 of their key modulo shards,
+        so that several processes or hosts can share a batch without overlap. To call between getnewqueries() and cleanqueries()
+        @params:
+            shard       - Required  :  index of the shard kept, from 0 to shards-1 (Int)
+            shards      - Required  :  number of shards (Int)
+            unordered   - Optional  :  hashing the unordered couple, so that A > B and B > A fall in the same shard (for cleanqueries(symmetric=True)) (Bool)
+        """
+        import zlib
+        import numpy as np
+        
+        keys = self.new['NewKey']
+        if unordered:
+            reverse = self._routekeys(self.new['NewDestination'], self.new['NewSource'])
+            keys = keys.where(keys.fillna('') <= reverse.fillna(''), reverse)
+        
+        mask = np.fromiter((zlib.crc32(str(k).encode("utf-8")) % shards == shard for k in keys), dtype=bool, count=len(keys))
+        
+        self.new = self.new[mask].reset_index(drop=True)
+        if self.netnew is not None:
+            self.netnew = self.netnew[mask]
+            
+        print(str(int(mask.sum())) + " of " + str(len(mask)) + " queries in shard " + str(shard) + "/" + str(shards))
+        
+    def _shardtable(self, table, shard, shards):
+        """
+        Private method. Name of the table written by one shard, merged into table by mergeshards()
+        """
+        return table + "_shard" + str(shard) + "of" + str(shards)
+    
+    @_instrumented
+    def mergeshards(self, server, db, table, shards, upsert = False, chunksize = 10000):
+        """ Merging the tables written by the shards of a batch (see the command line) into table, then dropping them
+        @params:
+            server      - Required  :  SQL Server name (Str)
+            db:         - Required  :  Data Base name (Str)
+            table       - Required  :  table name given to the shards (Str)
+            shards      - Required  :  number of shards of the batch (Int)
+            upsert      - Optional  :  merging on the key through a staging table, see storequeries(). Otherwise the rows are appended with INSERT ... SELECT in the database (Bool)
+            chunksize   - Optional  :  number of rows read and merged at a time when upsert is True (Int)
+        """
+        import pandas as pd
+        import sqlalchemy
+        
+        engine = self._getengine(server, db)
+        quote = engine.dialect.identifier_preparer.quote
+        merged = 0
+        
+        for shard in range(shards):
+            
+            source = self._shardtable(table, shard, shards)
+            inspector = sqlalchemy.inspect(engine)
+            
+            if not inspector.has_table(source):
+                print("Shard " + str(shard) + "/" + str(shards) + ": no table " + source)
+                continue
+            
+            columns = [quote(c['name']) for c in inspector.get_columns(source)]
+            
+            if upsert:
+                for frame in pd.read_sql("SELECT * FROM " + quote(source), con=engine, chunksize=chunksize):
+                    self._upsert(engine, frame, table, chunksize)
+                    merged += len(frame)
+                with engine.begin() as connection:
+                    connection.execute(sqlalchemy.text("DROP TABLE " + quote(source)))
+                continue
+            
+            # Creating the target table with the columns of the shard tables if it does not exist yet
+            if not inspector.has_table(table):
+                pd.read_sql("SELECT * FROM " + quote(source) + " WHERE 1 = 0", con=engine).to_sql(table, con=engine, index=False)
+                
+            with engine.begin() as connection:
+                merged += connection.execute(sqlalchemy.text("INSERT INTO " + quote(table) + " (" + ", ".join(columns) + ") SELECT " + ", ".join(columns) + " FROM " + quote(source))).rowcount
+                connection.execute(sqlalchemy.text("DROP TABLE " + quote(source)))
+                
+        print(str(merged) + " rows of " + str(shards) + " shards merged into " + table)
+        
+    @_instrumented
+    def streamqueries(self, file, server, db, query, table_done, table_errors, chunksize = 10000, workers = 1, maxdistance = None, symmetric = False,
+                      shard = 0, shards = 1, upsert = False):
+        """Running getnewqueries > cleanqueries > extractdtfrombing > storequeries chunk by chunk, so that memory stays bounded
+        and the results of each chunk are visible in SQL as soon as it is finished
+        @params:
+            file            - Required  :  path to the file where the BingMapsKey is stored (Str)
+            server          - Required  :  SQL Server name (Str)
+            db:             - Required  :  Data Base name (Str)
+            query           - Required  :  SQL query returning the new queries, two columns: [Source] and [Destination] (Str)
+            table_done:     - Required  :  Table name to store the good results (Str)
+            table_errors:   - Required  :  Table name to store the errors (Str)
+            chunksize       - Optional  :  number of new queries read, routed and stored at a time (Int)
+            workers         - Optional  :  number of requests in flight at the same time, see extractdtfrombing() (Int)
+            maxdistance     - Optional  :  when given, computeflightdistance(maxdistance) is applied to each chunk (Float)
+            symmetric       - Optional  :  symmetric mode of cleanqueries(), the dedup of the unordered couples is done per chunk (Bool)
+            shard           - Optional  :  index of the shard routed by this process, see selectshard() (Int)
+            shards          - Optional  :  number of shards the batch is split into (Int)
+            upsert          - Optional  :  storing through the staging table merged on the key, see storequeries() (Bool)
+        NB: Deduplication uses the route cache (openroutecache()) and/or the past queries loaded with getpastqueries().
+            With the route cache, a couple routed in one chunk is not routed again in the next ones.
+            A SQLite database is switched to WAL journal mode, so that the results can be written while the query is read.
+        """
+        
+        import pandas as pd
         
-        engine = sqlalchemy.create_engine('mssql+pyodbc://{}/{}?driver={}?encoding={}'.format(server, db, driver,encoding))
+        self.server = server
+        self.db = db
+        self.query = query
         
-        self.donequeries.to_sql(table_done, con=engine, if_exists='append', index=False)
-        self.errorqueries.to_sql(table_errors, con=engine, if_exists='append', index=False)
+        engine = self._getengine(server, db)
+
+        # The chunked SELECT keeps its read lock until the last chunk: SQLite only lets the results be written meanwhile in WAL mode
+        if engine.dialect.name == 'sqlite':
+            with engine.connect() as connection:
+                connection.exec_driver_sql("PRAGMA journal_mode=WAL")
 
+        total_new = 0
+        total_past = 0
+        total_done = 0
+        total_errors = 0
+        
+        for chunk, NewQueries in enumerate(pd.read_sql(self.query, con=engine, chunksize=chunksize)):
+            
+            self._setnewqueries(NewQueries.reset_index(drop=True))
+            
+            if shards > 1:
+                self.selectshard(shard, shards, unordered=symmetric)
+                
+            self.cleanqueries(symmetric)
+            
+            total_new += len(self.new)
+            total_past += len(self.pastqueries)
+            
+            if len(self.source) == 0:
+                continue
+            
+            if maxdistance is not None:
+                self.computeflightdistance(maxdistance)
+                
+            self.extractdtfrombing(file, workers)
+            
+            self._storequeries(engine, table_done, table_errors, chunksize, upsert)
+            
+            total_done += len(self.donequeries)
+            total_errors += len(self.errorqueries)
+            
+            print("Chunk " + str(chunk) + " stored. Total so far: " + str(total_new) + " new queries, " + str(total_past) + " already queried, " + str(total_done) + " done, " + str(total_errors) + " errors")
 
 
-def main():
 
+def main(argv = None):
+    """ Command line entry point.
+    
+    run: getnewqueries > cleanqueries > extractdtfrombing > storequeries, chunk by chunk (see streamqueries()).
+         With --shards N, run one process per shard (--shard 0 to N-1, on one or several hosts): each one routes the queries whose key hash falls in its shard,
+         with 1/N of --qps and --daily-quota, and writes to <table>_shard<i>of<N>
+    merge: merging the shard tables of a batch into the final tables
+    
+    e.g. python BingDistanceTimeExtract.py run --key key.txt --server MYSERVER --db Routes --query "SELECT Source, Destination FROM NewRoutes" --done Routes_done --errors Routes_error --shard 0 --shards 4
+         python BingDistanceTimeExtract.py merge --server MYSERVER --db Routes --done Routes_done --errors Routes_error --shards 4
+    """
+    
+    import argparse
     import time
     
+    parser = argparse.ArgumentParser(description="Travel distances and times between addresses with the Bing Maps API")
+    commands = parser.add_subparsers(dest="command", required=True)
     
-    start = time.time()
+    run = commands.add_parser("run", help="running the full pipeline on a batch, or on one shard of it")
+    run.add_argument("--key", required=True, help="path to the file where the BingMapsKey is stored")
+    run.add_argument("--query", required=True, help="SQL query returning the new queries: [Source] and [Destination]")
+    run.add_argument("--past-query", help="SQL query returning the past queries, see getpastqueries()")
+    run.add_argument("--routecache", help="local SQLite route cache, see openroutecache()")
+    run.add_argument("--chunksize", type=int, default=10000, help="number of new queries read, routed and stored at a time")
+    run.add_argument("--workers", type=int, default=1, help="number of requests in flight at the same time")
+    run.add_argument("--qps", type=float, help="maximum number of requests per second of the whole batch, divided between the shards")
+    run.add_argument("--daily-quota", type=int, help="maximum number of requests per day of the whole batch, divided between the shards")
+    run.add_argument("--maxdistance", type=float, help="couples further apart than this flight distance (km) are not routed")
+    run.add_argument("--symmetric", action="store_true", help="symmetric mode of cleanqueries()")
+    run.add_argument("--normalize", action="store_true", help="keys built from normalized addresses")
+    run.add_argument("--upsert", action="store_true", help="storing through a staging table merged on the key")
+    run.add_argument("--shard", type=int, default=0, help="shard routed by this process, from 0 to shards-1")
+    run.add_argument("--metrics", help="file where the metrics of the run are written, Prometheus text format if it ends with .prom, JSON otherwise")
+    run.add_argument("--bingurl", default="http://dev.virtualearth.net/REST", help="root URL of the Bing Maps REST services")
     
-    x = BingMapsDTExtract()
+    merge = commands.add_parser("merge", help="merging the shard tables of a batch into the final tables")
+    merge.add_argument("--upsert", action="store_true", help="merging on the key through a staging table")
     
-    #print(x.__doc__)
+    for command in (run, merge):
+        command.add_argument("--server", required=True, help="SQL Server name, or any SQLAlchemy URL")
+        command.add_argument("--db", help="Data Base name, not needed with a URL")
+        command.add_argument("--done", required=True, help="table name to store the good results")
+        command.add_argument("--errors", required=True, help="table name to store the errors")
+        command.add_argument("--shards", type=int, default=1, help="number of shards the batch is split into")
     
-
-    # Write your code here
+    args = parser.parse_args(argv)
+    
+    start = time.time()
+    
+    if args.command == "run":
+        
+        if not 0 <= args.shard < args.shards:
+            parser.error("--shard must be between 0 and shards-1")
+        
+        # Each shard gets its slice of the rate and of the quota
+        qps = args.qps / args.shards if args.qps is not None else None
+        dailyquota = None
+        if args.daily_quota is not None:
+            dailyquota = args.daily_quota // args.shards + (1 if args.shard < args.daily_quota % args.shards else 0)
+        
+        x = BingMapsDTExtract(bingurl=args.bingurl, qps=qps, dailyquota=dailyquota, normalize=args.normalize)
+        
+        done, errors = args.done, args.errors
+        if args.shards > 1:
+            done, errors = x._shardtable(done, args.shard, args.shards), x._shardtable(errors, args.shard, args.shards)
+        
+        if args.routecache is not None:
+            x.openroutecache(args.routecache)
+        if args.past_query is not None:
+            x.getpastqueries(args.server, args.db, args.past_query)
+        if args.routecache is None and args.past_query is None:
+            import pandas as pd
+            
+            # Nothing to deduplicate against: every new query is routed
+            x.past = pd.DataFrame({'KeyID': [], 'Source': [], 'Destination': []})
+            
+        try:
+            x.streamqueries(args.key, args.server, args.db, args.query, done, errors, args.chunksize, args.workers, args.maxdistance, args.symmetric,
+                            args.shard, args.shards, args.upsert)
+        finally:
+            if args.metrics is not None:
+                x.exportmetrics(args.metrics, "prometheus" if args.metrics.endswith(".prom") else "json")
+        
+    else:
+        
+        x = BingMapsDTExtract()
+        x.mergeshards(args.server, args.db, args.done, args.shards, args.upsert)
+        x.mergeshards(args.server, args.db, args.errors, args.shards, args.upsert)
+    
+    x.closeengine()
 
     end = time.time()-start
     print('It took ' + str(round(end,2)) + ' seconds to execute the script.')
-    
-         
-    
 
 
 if __name__ == '__main__':
     
     main()
-
-
-
-
-
-#x.storequeries(server,db, 'China_AE_done', 'China_AE_error')
\ No newline at end of file
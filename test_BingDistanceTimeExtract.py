@@ -0,0 +1,1282 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of BingMapsDTExtract against the local stand-in of Bing (BingBenchmark.StubBingServer) and SQLite databases.
+No Bing Maps key or API quota is used. Run with: python -m pytest -q (or python -m unittest)
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from BingBenchmark import StubBingServer, _keyfile, _routequeries
+from BingDistanceTimeExtract import BingMapsDTExtract
+
+
+class _StubTestCase(unittest.TestCase):
+    """ Stub server, key file and temporary folder of a test """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.keys = _keyfile()
+        self.keyfile = self.keys.__enter__()
+        self.server = StubBingServer(**self.serveroptions())
+        self.server.__enter__()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        self.keys.__exit__(None, None, None)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def serveroptions(self):
+        return {}
+
+    def extractor(self, **kwargs):
+        return BingMapsDTExtract(bingurl=self.server.url, spatialurl=self.server.url, backoff=0.01, **kwargs)
+
+
+class TestCentroids(_StubTestCase):
+
+    def test_country_centroid_is_requested_once_and_persisted(self):
+        import json
+        import pandas as pd
+
+        centroidfile = os.path.join(self.folder, "centroids.json")
+        for run in range(2):
+            x = self.extractor()
+            x.address = pd.Series(["1 Main Street, Paris", "INVALID address", "2 Main Street, Paris", "3 Main Street, Paris"])
+            x.extractcoorfrombing_obo(self.keyfile, centroidfile=centroidfile)
+
+            self.assertEqual(x.donequeries['Country_check latitude'].iloc[0], 48.8566)
+
+        # 4 addresses per run, the centroid of France in the first run only, none for the address not found
+        self.assertEqual(self.server.requests, 2 * 4 + 1)
+        with open(centroidfile, encoding="utf-8") as f:
+            self.assertEqual(json.load(f), [["France", "", 48.8566, 2.3522]])
+
+    def test_no_centroid_for_a_failed_address(self):
+        import pandas as pd
+
+        x = self.extractor(retries=0)
+        x.address = pd.Series(["BADREQUEST address", "INVALID address"])
+        x.extractcoorfrombing_obo(self.keyfile)
+
+        self.assertEqual(self.server.requests, 2)
+        self.assertNotIn(("0", ""), x.centroids.centroids)
+        self.assertNotIn(("0", ""), x.centroids.failed)
+
+
+class TestTypedResults(_StubTestCase):
+
+    def test_failed_address_does_not_inherit_the_previous_result(self):
+        import pandas as pd
+
+        x = self.extractor(retries=0)
+        x.address = pd.Series(["1 Main Street, Paris", "BADREQUEST address", "2 Main Street, Paris"])
+        x.extractcoorfrombing_obo(self.keyfile)
+
+        self.assertEqual(x.errorqueries['Address'].tolist(), ["BADREQUEST address"])
+        self.assertEqual(x.latitude.iloc[1], 0)
+        self.assertEqual(x.country_check.iloc[1], '0')
+        self.assertEqual(len(x.donequeries), 2)
+        self.assertNotEqual(x.latitude.iloc[0], x.latitude.iloc[2])
+        self.assertEqual(str(x.latitude.dtype), 'float64')
+
+    def test_route_results_are_typed_and_keep_the_index(self):
+        done = {}
+        for method in ("extractdtfrombing", "extractdtfrombing_obo"):
+            x = self.extractor()
+            _routequeries(x, 30)
+            for series in (x.key, x.source, x.destination, x.travelduration, x.traveldistance, x.flightdistance):
+                series.index = series.index + 100
+            getattr(x, method)(self.keyfile)
+            done[method] = x.donequeries
+
+            self.assertEqual(list(x.donequeries.index), list(range(100, 130)))
+            self.assertEqual(str(x.donequeries['TravelDuration'].dtype), 'float32')
+            self.assertEqual(str(x.donequeries['TravelDistance'].dtype), 'float32')
+
+        # The stub times a leg by its position in the request: one couple per request is always the first leg
+        self.assertEqual(done["extractdtfrombing"]['KeyID'].tolist(), done["extractdtfrombing_obo"]['KeyID'].tolist())
+        self.assertEqual(set(done["extractdtfrombing_obo"]['TravelDuration']), {60.0})
+
+    def test_geocoding_results_are_typed(self):
+        import pandas as pd
+
+        x = self.extractor()
+        x.address = pd.Series(["1 Main Street, Paris", "2 Main Street, Paris"], index=[7, 3])
+        x.extractcoorfrombing_obo(self.keyfile)
+
+        self.assertEqual(list(x.donequeries.index), [7, 3])
+        self.assertEqual(str(x.donequeries['Latitude'].dtype), 'float64')
+        self.assertEqual(str(x.donequeries['Confidence'].dtype), 'category')
+        self.assertEqual(x.donequeries['Country_check latitude'].tolist(), [48.8566, 48.8566])
+
+
+class TestJournal(_StubTestCase):
+
+    def test_resume_routes_only_the_missing_couples(self):
+        from BingDistanceTimeExtract import BingQuotaExceeded
+
+        journal = os.path.join(self.folder, "journal.jsonl")
+
+        # 60 couples are 5 requests of 12 couples: the quota stops the run after 2 of them
+        x = self.extractor(dailyquota=2)
+        _routequeries(x, 60)
+        with self.assertRaises(BingQuotaExceeded):
+            x.extractdtfrombing(self.keyfile, journal=journal)
+        self.assertEqual(self.server.requests, 2)
+
+        y = self.extractor()
+        _routequeries(y, 60)
+        y.resumeextraction(self.keyfile, journal)
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(len(y.donequeries), 60)
+        self.assertEqual(len(y.errorqueries), 0)
+
+        # Same results as a run that was never interrupted
+        z = self.extractor()
+        _routequeries(z, 60)
+        z.extractdtfrombing(self.keyfile)
+        self.assertEqual(y.donequeries['TravelDuration'].tolist(), z.donequeries['TravelDuration'].tolist())
+        self.assertEqual(y.donequeries['TravelDistance'].tolist(), z.donequeries['TravelDistance'].tolist())
+
+    def test_geocoding_journal_is_written_in_groups(self):
+        import pandas as pd
+        from BingDistanceTimeExtract import BingQuotaExceeded, _Journal
+
+        journal = os.path.join(self.folder, "journal.jsonl")
+        addresses = pd.Series(["%d Main Street, Paris" % i for i in range(30)])
+
+        # 12 requests: 11 addresses and the centroid of France
+        x = self.extractor(dailyquota=12)
+        x.address = addresses
+        with self.assertRaises(BingQuotaExceeded):
+            x.extractcoorfrombing_obo(self.keyfile, journal=journal)
+
+        # Everything geocoded before the interruption is in the journal, written in one group after the method line
+        self.assertEqual(len(_Journal(journal).load()[1]), 11)
+        with open(journal, encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+        y = self.extractor()
+        y.address = addresses
+        y.resumeextraction(self.keyfile, journal)
+        self.assertEqual(self.server.requests, 12 + 19 + 1)
+        self.assertEqual(len(y.donequeries), 30)
+
+    def test_truncated_last_line_is_ignored(self):
+        from BingDistanceTimeExtract import _Journal
+
+        file = os.path.join(self.folder, "journal.jsonl")
+        journal = _Journal(file)
+        journal.start("extractdtfrombing")
+        journal.record({"A+B": [60.0, 1.0, None, None, None, None]})
+        with open(file, "a", encoding="utf-8") as f:
+            f.write('{"done": {"C+D": [60')
+
+        method, finished = _Journal(file).load()
+        self.assertEqual(method, "extractdtfrombing")
+        self.assertEqual(list(finished), ["A+B"])
+
+        # A restarted run appends on a new line, after the truncated one
+        journal.start("extractdtfrombing")
+        journal.record({"E+F": [60.0, 1.0, None, None, None, None]})
+        self.assertEqual(sorted(_Journal(file).load()[1]), ["A+B", "E+F"])
+
+    def test_storequeries_clears_the_journal(self):
+        journal = os.path.join(self.folder, "journal.jsonl")
+
+        x = self.extractor()
+        x.openengine("sqlite:///" + os.path.join(self.folder, "routes.db"))
+        _routequeries(x, 24)
+        x.extractdtfrombing(self.keyfile, journal=journal)
+        self.assertTrue(os.path.exists(journal))
+
+        x.storequeries(None, None, "Routes_done", "Routes_error")
+        self.assertFalse(os.path.exists(journal))
+        x.closeengine()
+
+
+class TestQuota(_StubTestCase):
+
+    def test_quota_stops_the_run_with_the_journal_intact(self):
+        from BingDistanceTimeExtract import BingQuotaExceeded, _Journal
+
+        journal = os.path.join(self.folder, "journal.jsonl")
+
+        for workers in (1, 4):
+            x = self.extractor(dailyquota=2)
+            _routequeries(x, 60)
+            with self.assertRaises(BingQuotaExceeded):
+                x.extractdtfrombing(self.keyfile, workers=workers, journal=journal)
+
+            # The couples not routed are not turned into errors, the two batches sent are in the journal
+            self.assertFalse(hasattr(x, 'donequeries'))
+            self.assertEqual(len(_Journal(journal).load()[1]), 24)
+            os.remove(journal)
+
+    def test_quota_stops_the_one_by_one_methods(self):
+        import pandas as pd
+        from BingDistanceTimeExtract import BingQuotaExceeded
+
+        x = self.extractor(dailyquota=3)
+        _routequeries(x, 10)
+        with self.assertRaises(BingQuotaExceeded):
+            x.extractdtfrombing_obo(self.keyfile)
+        self.assertEqual(self.server.requests, 3)
+
+        x = self.extractor(dailyquota=3)
+        x.address = pd.Series(["%d Main Street, Paris" % i for i in range(10)])
+        with self.assertRaises(BingQuotaExceeded):
+            x.extractcoorfrombing_obo(self.keyfile)
+
+        x = self.extractor(dailyquota=1)
+        with self.assertRaises(BingQuotaExceeded):
+            x.geocodeaddresses(self.keyfile, ["1 Main Street, Paris", "2 Main Street, Paris"], workers=2)
+
+
+class TestBisect(_StubTestCase):
+
+    def test_bad_couple_is_isolated(self):
+        x = self.extractor()
+        _routequeries(x, 60)
+        # The stub server rejects (400) any request with a waypoint containing INVALID
+        x.destination.iloc[5] = "INVALID address"
+        x.key.iloc[5] = x.source.iloc[5] + "+INVALID address"
+        x.extractdtfrombing(self.keyfile)
+
+        self.assertEqual(x.errorqueries['Destination'].tolist(), ["INVALID address"])
+        self.assertEqual(len(x.donequeries), 59)
+        self.assertFalse(x.donequeries['TravelDuration'].isna().any())
+        # One bad couple among 12 costs at most 2*log2(12) extra requests
+        self.assertGreater(x.bisectrequests, 0)
+        self.assertLessEqual(x.bisectrequests, 8)
+        self.assertEqual(self.server.requests, 5 + x.bisectrequests)
+
+    def test_server_errors_are_not_bisected(self):
+        with StubBingServer(errorrate=1.0, errorstatus=500) as server:
+            x = BingMapsDTExtract(bingurl=server.url, retries=0)
+            _routequeries(x, 60)
+            x.extractdtfrombing(self.keyfile)
+
+            self.assertEqual(x.bisectrequests, 0)
+            self.assertEqual(server.requests, 5)
+            self.assertEqual(len(x.errorqueries), 60)
+
+    def test_rejected_key_aborts_the_run(self):
+        from BingDistanceTimeExtract import BingAuthenticationError
+
+        with StubBingServer(key="ANOTHERKEY") as server:
+            for workers in (1, 4):
+                x = BingMapsDTExtract(bingurl=server.url)
+                _routequeries(x, 120)
+                with self.assertRaises(BingAuthenticationError):
+                    x.extractdtfrombing(self.keyfile, workers=workers)
+
+            # No bisection and no retry: at most the requests already in flight
+            self.assertLessEqual(server.requests, 1 + 4)
+
+
+class TestPlanBatches(unittest.TestCase):
+
+    def planner(self, couples):
+        import pandas as pd
+
+        x = BingMapsDTExtract()
+        x.source = pd.Series([s for s, d in couples])
+        x.destination = pd.Series([d for s, d in couples])
+        return x
+
+    def test_couples_are_chained(self):
+        x = self.planner([("A", "B"), ("C", "D"), ("B ", "C")])
+        batches, legs = x._planbatches([0, 1, 2])
+
+        self.assertEqual(batches, [[0, 2, 1]])
+        self.assertEqual(legs, [3])
+        self.assertEqual(x._packwaypoints(batches[0]), (["A", "B", "C", "D"], {0: 0, 2: 1, 1: 2}))
+
+    def test_batches_fit_in_one_request(self):
+        # Unrelated couples take 2 waypoints each, a chain 1 waypoint per couple
+        for couples, expected in (([("S%d" % i, "D%d" % i) for i in range(30)], [12, 12, 6]),
+                                  ([("P%d" % i, "P%d" % (i + 1)) for i in range(30)], [24, 6])):
+            x = self.planner(couples)
+            batches, legs = x._planbatches(list(range(30)))
+
+            self.assertEqual([len(b) for b in batches], expected)
+            self.assertEqual(sorted(k for b in batches for k in b), list(range(30)))
+            for batch, routed in zip(batches, legs):
+                waypoints = x._packwaypoints(batch)[0]
+                self.assertLessEqual(len(waypoints), 25)
+                self.assertEqual(routed, len(waypoints) - 1)
+
+    def test_leg_counts_match_the_packed_waypoints(self):
+        import random
+
+        rng = random.Random(7)
+        places = ["P%d" % i for i in range(40)]
+        x = self.planner([(rng.choice(places), rng.choice(places)) for i in range(500)])
+        positions = list(range(500))
+        rng.shuffle(positions)
+        batches, legs = x._planbatches(positions)
+
+        self.assertEqual(sorted(k for b in batches for k in b), list(range(500)))
+        self.assertEqual(legs, [len(x._packwaypoints(b)[0]) - 1 for b in batches])
+        self.assertTrue(all(leg <= 24 for leg in legs))
+
+
+class TestErrorMask(_StubTestCase):
+
+    def test_errormask(self):
+        x = BingMapsDTExtract()
+        x.error_indexes = {0, 3, 9}
+        self.assertEqual(x._errormask(10).tolist(), [k not in (0, 3, 9) for k in range(10)])
+        x.error_indexes = set()
+        self.assertTrue(x._errormask(5).all())
+
+    def test_errors_are_positions_not_index_labels(self):
+        x = self.extractor()
+        _routequeries(x, 20)
+        # After cleanqueries() the series keep the index labels of the rows selected in self.new
+        for name in ('key', 'source', 'destination', 'travelduration', 'traveldistance', 'flightdistance'):
+            series = getattr(x, name)
+            series.index = range(100, 140, 2)
+        x.destination.iloc[3] = "INVALID address"
+        x.extractdtfrombing(self.keyfile)
+
+        self.assertEqual(x.errorqueries.index.tolist(), [106])
+        self.assertEqual(x.errorqueries['Destination'].tolist(), ["INVALID address"])
+        self.assertEqual(len(x.donequeries), 19)
+        self.assertNotIn(106, x.donequeries.index)
+
+
+class TestUpsert(unittest.TestCase):
+
+    def setUp(self):
+        import pandas as pd
+
+        self.folder = tempfile.mkdtemp()
+        self.x = BingMapsDTExtract()
+        self.x.openengine("sqlite:///" + os.path.join(self.folder, "routes.db"))
+        keys = ["K%d" % i for i in range(50)] + ["K3"]
+        self.x.donequeries = pd.DataFrame({'KeyID': keys, 'Source': keys, 'Destination': keys,
+                                           'TravelDuration': [float(i) for i in range(51)], 'TravelDistance': 1.0, 'FlightDistance': 1.0})
+        self.x.errorqueries = pd.DataFrame({'Source': ["E", "E"], 'Destination': ["F", "F"], 'FlightDistance': [1.0, 2.0]})
+
+    def tearDown(self):
+        self.x.closeengine()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def read(self, sql):
+        import pandas as pd
+        import sqlalchemy
+
+        return pd.read_sql(sqlalchemy.text(sql), con=self.x._getengine())
+
+    def test_one_row_per_key(self):
+        for run in range(2):
+            self.x.storequeries(None, None, "Routes_done", "Routes_error", chunksize=7, upsert=True)
+
+            self.assertEqual(len(self.read("SELECT * FROM Routes_done")), 50)
+            # The last row of a repeated key wins
+            self.assertEqual(self.read("SELECT TravelDuration FROM Routes_done WHERE KeyID = 'K3'")['TravelDuration'].tolist(), [50.0])
+            self.assertEqual(self.read("SELECT FlightDistance FROM Routes_error")['FlightDistance'].tolist(), [2.0])
+
+    def test_rerun_updates_the_stored_rows(self):
+        self.x.storequeries(None, None, "Routes_done", "Routes_error", upsert=True)
+        self.x.donequeries['TravelDuration'] = 99.0
+        self.x.storequeries(None, None, "Routes_done", "Routes_error", upsert=True)
+
+        durations = self.read("SELECT TravelDuration FROM Routes_done")['TravelDuration']
+        self.assertEqual(len(durations), 50)
+        self.assertTrue((durations == 99.0).all())
+        self.assertFalse(self.read("SELECT name FROM sqlite_master WHERE name LIKE '%staging%'")['name'].tolist())
+
+    def test_append_keeps_every_row(self):
+        self.x.storequeries(None, None, "Routes_done", "Routes_error")
+        self.x.storequeries(None, None, "Routes_done", "Routes_error")
+        self.assertEqual(len(self.read("SELECT * FROM Routes_done")), 102)
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.folder, "routes.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_one_pool_shared_by_the_sql_methods(self):
+        import pandas as pd
+
+        x = BingMapsDTExtract()
+        x.openengine(self.url)
+        x.donequeries = pd.DataFrame({'KeyID': ["A+B"], 'Source': ["A"], 'Destination': ["B"], 'TravelDuration': [60.0], 'TravelDistance': [1.0]})
+        x.errorqueries = pd.DataFrame({'Source': ["C"], 'Destination': ["D"]})
+        for run in range(5):
+            x.storequeries(None, None, "Routes_done", "Routes_error")
+        x.getpastqueries(None, None, "SELECT * FROM Routes_done")
+
+        engine = x._getengine()
+        self.assertIs(x._getengine(self.url), engine)
+        self.assertEqual(x.sqlconnections, 1)
+        self.assertGreaterEqual(x.sqlcheckouts, 6)
+        self.assertEqual(len(x.past), 5)
+        x.closeengine()
+
+    def test_statistics_are_reset_with_the_engine(self):
+        import pandas as pd
+        import sqlalchemy
+
+        x = BingMapsDTExtract()
+        x.openengine(self.url)
+        for run in range(3):
+            pd.read_sql(sqlalchemy.text("SELECT 1"), con=x._getengine())
+        self.assertEqual(x.enginestats()['checkouts'], 3)
+
+        x.closeengine()
+        pd.read_sql(sqlalchemy.text("SELECT 1"), con=x._getengine())
+        stats = x.enginestats()
+        self.assertEqual((stats['connections'], stats['checkouts']), (1, 1))
+        x.closeengine()
+
+    def test_another_url_opens_another_engine(self):
+        x = BingMapsDTExtract()
+        with self.assertRaises(ValueError):
+            x._getengine()
+
+        first = x._getengine(self.url)
+        other = "sqlite:///" + os.path.join(self.folder, "other.db")
+        second = x._getengine(other)
+        self.assertIsNot(second, first)
+        self.assertEqual(x.engineurl, other)
+        # server=None keeps the current engine
+        self.assertIs(x._getengine(None), second)
+        x.closeengine()
+
+
+class TestNetNew(unittest.TestCase):
+
+    def setUp(self):
+        import random
+        import sqlite3
+
+        self.folder = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.folder, "routes.db")
+        rng = random.Random(3)
+        places = ["P%d" % i for i in range(30)]
+        # Case and trailing space variants must not match the past keys
+        new = [(rng.choice(places), rng.choice(places)) for i in range(500)] + [("p1", "P2"), ("P1 ", "P2"), ("P1", "P2")]
+        past = [(rng.choice(places), rng.choice(places)) for i in range(300)] + [("P1", "P2")]
+
+        connection = sqlite3.connect(os.path.join(self.folder, "routes.db"))
+        connection.execute("CREATE TABLE NewRoutes (Source TEXT, Destination TEXT)")
+        connection.execute("CREATE TABLE PastRoutes (KeyID TEXT, Source TEXT, Destination TEXT, TravelDuration REAL, TravelDistance REAL)")
+        connection.executemany("INSERT INTO NewRoutes VALUES (?, ?)", new)
+        connection.executemany("INSERT INTO PastRoutes VALUES (?, ?, ?, 60, 1)", [(s + "+" + d, s, d) for s, d in past])
+        connection.commit()
+        connection.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_anti_join_matches_the_pandas_merge(self):
+        x = BingMapsDTExtract()
+        x.getnewqueries(self.url, None, "SELECT Source, Destination FROM NewRoutes")
+        x.getpastqueries(self.url, None, "SELECT * FROM PastRoutes")
+        x.cleanqueries()
+
+        y = BingMapsDTExtract()
+        # Schema qualified name: each part is quoted on its own
+        y.getnetnewqueries(self.url, None, "SELECT Source, Destination FROM NewRoutes", "main.PastRoutes")
+        y.cleanqueries()
+
+        self.assertEqual(y.key.tolist(), x.key.tolist())
+        self.assertEqual(y.pastqueries['KeyID'].tolist(), x.pastqueries['KeyID'].tolist())
+        self.assertIn("p1+P2", y.key.tolist())
+        self.assertIn("P1 +P2", y.key.tolist())
+        self.assertNotIn("P1+P2", y.key.tolist())
+
+        # The index is created once, in the schema of the table
+        import sqlalchemy
+        indexes = sqlalchemy.inspect(y._getengine()).get_indexes("PastRoutes", schema="main")
+        self.assertEqual([index['column_names'] for index in indexes], [['KeyID']])
+        y.getnetnewqueries(self.url, None, "SELECT Source, Destination FROM NewRoutes", "main.PastRoutes")
+
+    def test_normalize_is_refused(self):
+        x = BingMapsDTExtract(normalize=True)
+        with self.assertRaises(ValueError):
+            x.getnetnewqueries(self.url, None, "SELECT Source, Destination FROM NewRoutes", "PastRoutes")
+
+
+class TestNormalizer(_StubTestCase):
+
+    def test_case_accents_and_punctuation_are_folded(self):
+        from BingDistanceTimeExtract import _AddressNormalizer
+
+        normalizer = _AddressNormalizer()
+        self.assertEqual(normalizer.normalize("  Rue de l'Église,  SAINT-ÉTIENNE "), "rue de l eglise saint etienne")
+        # NFKD: the ligature and the full width digits are decomposed
+        self.assertEqual(normalizer.normalize("ﬁve Straße １２"), normalizer.normalize("FIVE STRASSE 12"))
+        self.assertEqual(normalizer.normalize(None), None)
+
+    def test_unambiguous_abbreviations_are_unified(self):
+        from BingDistanceTimeExtract import _AddressNormalizer
+
+        normalizer = _AddressNormalizer()
+        self.assertEqual(normalizer.normalize("10 Main Avenue, Paris"), normalizer.normalize("10 main ave. PARIS"))
+        self.assertEqual(normalizer.normalize("1 North Boulevard"), "1 n blvd")
+
+    def test_saint_sainte_street_and_suite_stay_distinct(self):
+        from BingDistanceTimeExtract import _AddressNormalizer
+
+        normalizer = _AddressNormalizer()
+        addresses = ["1 Street Paul", "1 St Paul", "1 Saint Paul", "1 Sainte Paul", "1 Suite Paul", "1 Ste Paul", "1 Drive Paul", "1 Dr Paul"]
+        self.assertEqual(len(set(normalizer.normalize(a) for a in addresses)), len(addresses))
+
+    def test_known_couples_found_by_their_normalized_key_are_counted(self):
+        import pandas as pd
+
+        x = self.extractor(normalize=True)
+        x._setnewqueries(pd.DataFrame({'Source': ["10 main ave., Paris", "Lyon", "Lille"], 'Destination': ["Lyon", "Nice", "Nantes"]}))
+        x.past = pd.DataFrame({'KeyID': ["10 Main Avenue Paris+Lyon", "Lyon+Nice"], 'Source': ["10 Main Avenue Paris", "Lyon"], 'Destination': ["Lyon", "Nice"],
+                               'TravelDuration': [100.0, 200.0], 'TravelDistance': [5.0, 6.0]})
+        x.cleanqueries()
+
+        # Lyon > Nice is known under its raw key too, only the first couple was saved by the normalization
+        self.assertEqual(x.keystats['known'], 2)
+        self.assertEqual(x.keystats['normalizedhits'], 1)
+        self.assertEqual(x.source.tolist(), ["Lille"])
+
+    def test_route_cache_keys_round_trip(self):
+        import pandas as pd
+
+        x = self.extractor(normalize=True)
+        x.openroutecache(os.path.join(self.folder, "routes.db"))
+        x._setnewqueries(pd.DataFrame({'Source': ["10 Main Avenue, Paris"], 'Destination': ["Gare de Lyon"]}))
+        x.cleanqueries()
+        x.extractdtfrombing(self.keyfile)
+        self.assertEqual(x.donequeries['KeyID'].tolist(), ["10 main ave paris+gare de lyon"])
+
+        # Another spelling of the same couple is answered by the cache without any request
+        requests = self.server.requests
+        x._setnewqueries(pd.DataFrame({'Source': [" 10 main AVE., paris"], 'Destination': ["GARE DE LYON"]}))
+        x.cleanqueries()
+        self.assertEqual(len(x.key), 0)
+        self.assertEqual(x.keystats['normalizedhits'], 1)
+        self.assertEqual(x.pastqueries['TravelDuration'].tolist(), x.donequeries['TravelDuration'].tolist())
+        self.assertEqual(self.server.requests, requests)
+
+
+class TestSymmetric(_StubTestCase):
+
+    def prepare(self, **kwargs):
+        import pandas as pd
+
+        x = self.extractor(**kwargs)
+        x._setnewqueries(pd.DataFrame({'Source': ["A", "B", "A", "C", "E"], 'Destination': ["B", "A", "B", "D", "F"]}))
+        x.past = pd.DataFrame({'KeyID': ["D+C"], 'Source': ["D"], 'Destination': ["C"], 'TravelDuration': [120.0], 'TravelDistance': [7.0]})
+        return x
+
+    def test_reverse_routes_and_duplicates_are_reused(self):
+        x = self.prepare()
+        x.cleanqueries(symmetric=True)
+
+        # Only A > B (once) and E > F are sent to Bing
+        self.assertEqual(x.key.tolist(), ["A+B", "E+F"])
+        self.assertEqual(x.keystats['reversed'], 1)
+        self.assertEqual(x.keystats['duplicates'], 2)
+        self.assertEqual(x.pastqueries[['KeyID', 'TravelDuration', 'TravelDistance', 'Reversed']].values.tolist(), [["C+D", 120.0, 7.0, True]])
+
+        x.extractdtfrombing(self.keyfile)
+        self.assertEqual(self.server.requests, 1)
+
+        done = x.donequeries.set_index('KeyID')
+        self.assertEqual(sorted(x.donequeries['KeyID']), ["A+B", "A+B", "B+A", "E+F"])
+        self.assertEqual(done.loc["B+A", 'TravelDuration'], done.loc["A+B", 'TravelDuration'].iloc[0])
+        self.assertEqual(done.loc["B+A", 'Source'], "B")
+        self.assertTrue(done.loc["B+A", 'Reversed'])
+        self.assertFalse(done.loc["A+B", 'Reversed'].any())
+
+    def test_mindistance_routes_short_reverse_routes(self):
+        x = self.prepare()
+        x.cleanqueries(symmetric=True, mindistance=10.0)
+
+        # D > C is 7 km: C > D is routed. Above 0 only the exact duplicates are sent once
+        self.assertEqual(x.key.tolist(), ["A+B", "B+A", "C+D", "E+F"])
+        self.assertEqual(x.keystats['reversed'], 0)
+        self.assertEqual(x.keystats['duplicates'], 1)
+
+    def test_reverse_route_from_the_route_cache(self):
+        import pandas as pd
+
+        x = self.prepare()
+        x.openroutecache(os.path.join(self.folder, "routes.db"))
+        x.routecache.store(pd.DataFrame({'KeyID': ["F+E"], 'Source': ["F"], 'Destination': ["E"],
+                                         'TravelDuration': [300.0], 'TravelDistance': [20.0], 'FlightDistance': [15.0]}))
+        x.cleanqueries(symmetric=True)
+
+        self.assertEqual(x.key.tolist(), ["A+B"])
+        reused = x.pastqueries.set_index('KeyID')
+        self.assertEqual(reused.loc["E+F", 'TravelDuration'], 300.0)
+        self.assertTrue(reused.loc["E+F", 'Reversed'])
+
+
+class TestDataflow(_StubTestCase):
+
+    def serveroptions(self):
+        return {"jobdelay": 0.2}
+
+    def addresses(self, x):
+        import pandas as pd
+
+        x.address = pd.Series(["%d Main Street, Paris" % i for i in range(8)] + ["INVALID road", "3 Main Street, Paris"])
+
+    def test_jobs_geocode_each_distinct_address_once(self):
+        x = self.extractor()
+        self.addresses(x)
+        x.extractcoorfrombing_dataflow(self.keyfile, jobsize=4, poll=0.05)
+
+        # 9 distinct addresses in 3 jobs, the failed entity of Bing is an error
+        self.assertEqual(len(self.server.httpd.jobs), 3)
+        self.assertEqual(x.errorqueries['Address'].tolist(), ["INVALID road"])
+        self.assertEqual(len(x.donequeries), 9)
+        self.assertIn(9, x.donequeries.index)
+        self.assertEqual(x.donequeries['Latitude'].tolist(), [48.8566] * 9)
+
+    def test_failed_job_keeps_the_results_of_the_other_jobs(self):
+        x = self.extractor(retries=0)
+        self.addresses(x)
+        submit = x._submitgeocodejob
+        submitted = []
+
+        # The second job disappears from the server: its status request fails with 404
+        def submitandlose(queries, ids, key):
+            job = submit(queries, ids, key)
+            submitted.append(job)
+            if len(submitted) == 2:
+                del self.server.httpd.jobs[job]
+            return job
+
+        x._submitgeocodejob = submitandlose
+        x.extractcoorfrombing_dataflow(self.keyfile, jobsize=4, poll=0.05)
+
+        self.assertEqual(len(x.failedjobs), 1)
+        # Addresses 4 to 7 were in the lost job, INVALID road failed in Bing
+        self.assertEqual(sorted(x.errorqueries.index), [4, 5, 6, 7, 8])
+        self.assertEqual(sorted(x.donequeries.index), [0, 1, 2, 3, 9])
+
+    def test_pending_jobs_are_given_up_after_the_timeout(self):
+        x = self.extractor()
+        self.addresses(x)
+        x.extractcoorfrombing_dataflow(self.keyfile, jobsize=4, poll=0.05, timeout=0.1)
+
+        self.assertEqual(len(x.donequeries), 0)
+        self.assertEqual(len(x.errorqueries), 10)
+
+
+class TestConcurrent(_StubTestCase):
+
+    def test_window_is_bounded_and_results_keep_their_order(self):
+        import random
+        import threading
+        import time
+
+        lock = threading.Lock()
+        inflight = [0, 0]
+
+        def call(item):
+            with lock:
+                inflight[0] += 1
+                inflight[1] = max(inflight[1], inflight[0])
+            time.sleep(random.uniform(0, 0.02))
+            with lock:
+                inflight[0] -= 1
+            if item == 7:
+                raise ValueError("bad item")
+            return item * 10
+
+        x = self.extractor()
+        output = list(x._runordered(call, list(range(40)), workers=4))
+
+        self.assertEqual([item for item, result, error in output], list(range(40)))
+        self.assertEqual([result for item, result, error in output if item != 7], [i * 10 for i in range(40) if i != 7])
+        # One failing call is reported with its item and does not stop the others
+        self.assertIsInstance(output[7][2], ValueError)
+        self.assertLessEqual(inflight[1], 4)
+        self.assertGreater(inflight[1], 1)
+
+    def test_concurrent_run_matches_the_serial_run(self):
+        import time
+
+        with StubBingServer(latency=0.05) as server:
+            elapsed = {}
+            done = {}
+            for workers in (1, 8):
+                x = BingMapsDTExtract(bingurl=server.url)
+                _routequeries(x, 120)
+                start = time.perf_counter()
+                x.extractdtfrombing(self.keyfile, workers=workers)
+                elapsed[workers] = time.perf_counter() - start
+                done[workers] = x.donequeries
+
+            # 10 requests of 12 couples each way
+            self.assertEqual(server.requests, 20)
+            self.assertTrue(done[8].equals(done[1]))
+            self.assertLess(elapsed[8], elapsed[1] / 2)
+
+
+class TestTransport(_StubTestCase):
+
+    def test_serial_requests_share_one_connection(self):
+        x = self.extractor()
+        results = x.geocodeaddresses(self.keyfile, ["%d Main Street, Paris" % i for i in range(29)])
+
+        # 29 addresses and the centroid of France
+        self.assertEqual(results.count(None), 0)
+        self.assertEqual(x.transport.requests, 30)
+        self.assertEqual(x.transport.connections, 1)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_connection_closed_while_idle_is_replaced(self):
+        import socket
+
+        x = self.extractor()
+        x.geocodeaddresses(self.keyfile, ["1 Main Street, Paris"])
+        for connections in x.transport._idle.values():
+            for connection in connections:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+
+        self.assertEqual(x.geocodeaddresses(self.keyfile, ["2 Main Street, Paris"]).count(None), 0)
+        self.assertEqual(x.transport.connections, 2)
+
+    def test_gzip_answers_are_decoded(self):
+        done = {}
+        wire = {}
+        for gzip in (True, False):
+            x = self.extractor(gzip=gzip)
+            _routequeries(x, 60)
+            x.extractdtfrombing(self.keyfile)
+            done[gzip] = x.donequeries
+            wire[gzip] = x.transport.bytes
+
+        self.assertTrue(done[True].equals(done[False]))
+        self.assertLess(wire[True], wire[False] / 2)
+
+
+class TestFlightDistance(_StubTestCase):
+
+    def test_haversine_on_arrays(self):
+        import math
+
+        x = self.extractor()
+        # Paris > London, a couple with a missing coordinate and a null distance
+        distance = x._haversine([48.8566, float("nan"), 10.0], [2.3522, 2.0, 20.0], [51.5074, 45.0, 10.0], [-0.1278, 3.0, 20.0])
+
+        self.assertAlmostEqual(distance[0], 343.5, delta=1.0)
+        self.assertTrue(math.isnan(distance[1]))
+        self.assertEqual(distance[2], 0.0)
+
+    def test_identical_and_distant_couples_are_not_routed(self):
+        import pandas as pd
+
+        x = self.extractor()
+        source = pd.Series(["48.8566,2.3522", "48.8566,2.3522", "48.8566,2.3522", "10 Main Street, Paris"])
+        destination = pd.Series(["48.8566, 2.3522", "51.5074,-0.1278", "40.4168,-3.7038", "Gare de Lyon, Paris"])
+        x.key = source.str.cat(others=destination, sep='+')
+        x.source, x.destination = source, destination
+        x.travelduration = x.traveldistance = x.flightdistance = pd.Series([0] * 4)
+
+        x.computeflightdistance(maxdistance=1000)
+        self.assertEqual(x.skip_identical.tolist(), [True, False, False, False])
+        self.assertEqual(x.skip_toofar.tolist(), [False, False, True, False])
+
+        x.extractdtfrombing(self.keyfile)
+
+        # London and the address are routed together, Madrid (1053 km) is logged as an error
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(x.errorqueries['Destination'].tolist(), ["40.4168,-3.7038"])
+        done = x.donequeries.set_index('Destination')
+        self.assertEqual(done.loc["48.8566, 2.3522", 'TravelDuration'], 0)
+        self.assertAlmostEqual(done.loc["51.5074,-0.1278", 'FlightDistance'], 343.5, delta=1.0)
+        # The address gets its flight distance from the coordinates of the routed leg
+        self.assertGreater(done.loc["Gare de Lyon, Paris", 'FlightDistance'], 0)
+
+
+class TestRouteCache(_StubTestCase):
+
+    def queries(self, n = 24):
+        import pandas as pd
+
+        return pd.DataFrame({'Source': ["Source %d" % i for i in range(n)], 'Destination': ["Destination %d" % i for i in range(n)]})
+
+    def test_second_run_is_answered_by_the_cache(self):
+        cache = os.path.join(self.folder, "routes.db")
+
+        x = self.extractor()
+        x.openroutecache(cache)
+        x._setnewqueries(self.queries())
+        x.cleanqueries()
+        x.extractdtfrombing(self.keyfile)
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(len(x.routecache), 24)
+
+        # A new instance on the same file: nothing to route, the travel times come from the cache
+        y = self.extractor()
+        y.openroutecache(cache)
+        y._setnewqueries(self.queries())
+        y.cleanqueries()
+        self.assertEqual(len(y.key), 0)
+        self.assertEqual(y.pastqueries['TravelDuration'].tolist(), x.donequeries['TravelDuration'].tolist())
+        self.assertEqual(y.keystats['hitrate'], 1.0)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_expired_routes_are_routed_again(self):
+        import sqlite3
+
+        cache = os.path.join(self.folder, "routes.db")
+        x = self.extractor()
+        x.openroutecache(cache)
+        x._setnewqueries(self.queries())
+        x.cleanqueries()
+        x.extractdtfrombing(self.keyfile)
+        x.routecache.close()
+
+        # Half of the routes were stored two days ago
+        with sqlite3.connect(cache) as connection:
+            connection.execute("UPDATE routes SET Created = Created - 2 * 86400 WHERE KeyID < 'Source 2'")
+
+        y = self.extractor()
+        y.openroutecache(cache, ttl=1)
+        y._setnewqueries(self.queries())
+        y.cleanqueries()
+        self.assertEqual(sorted(y.source), ["Source 0", "Source 1"] + ["Source 1%d" % i for i in range(10)])
+
+        # Without a ttl the routes never expire, purge() deletes the expired ones
+        y.openroutecache(cache)
+        self.assertEqual(len(y.routecache.lookup(y.key)), 12)
+        y.openroutecache(cache, ttl=1)
+        self.assertEqual(y.routecache.purge(), 12)
+        self.assertEqual(len(y.routecache), 12)
+
+
+class TestStreaming(_StubTestCase):
+
+    def test_chunks_are_routed_and_stored_one_by_one(self):
+        import pandas as pd
+        import sqlalchemy
+
+        url = "sqlite:///" + os.path.join(self.folder, "stream.db")
+        source = ["Source %d" % i for i in range(40)] + ["Source %d" % i for i in range(10)]
+        destination = ["Destination %d" % i for i in range(40)] + ["Destination %d" % i for i in range(10)]
+        destination[25] = "INVALID address"
+        engine = sqlalchemy.create_engine(url)
+        pd.DataFrame({'Source': source, 'Destination': destination}).to_sql("new", con=engine, index=False)
+        engine.dispose()
+
+        x = self.extractor()
+        x.openroutecache(os.path.join(self.folder, "routes.db"))
+        x.streamqueries(self.keyfile, url, None, "SELECT Source, Destination FROM new", "done", "errors", chunksize=20)
+        x.closeengine()
+
+        # 2 requests for each of the first two chunks (one more to isolate the INVALID couple), the last chunk is all in the cache
+        self.assertEqual(self.server.requests - x.bisectrequests, 4)
+        engine = sqlalchemy.create_engine(url)
+        done = pd.read_sql("SELECT * FROM done", con=engine)
+        errors = pd.read_sql("SELECT * FROM errors", con=engine)
+        engine.dispose()
+        self.assertEqual(len(done), 39)
+        self.assertEqual(done['KeyID'].nunique(), 39)
+        self.assertEqual(errors['Destination'].tolist(), ["INVALID address"])
+
+
+class TestRetry(_StubTestCase):
+
+    def test_throttled_request_waits_for_retry_after(self):
+        import time
+
+        # One request per second: the second address is throttled with Retry-After: 1
+        with StubBingServer(throttleqps=1) as server:
+            x = BingMapsDTExtract(bingurl=server.url, backoff=0.01)
+            start = time.perf_counter()
+            results = x.geocodeaddresses(self.keyfile, ["1 Main Street, Paris", "2 Main Street, Paris"])
+            elapsed = time.perf_counter() - start
+
+            self.assertEqual(results.count(None), 0)
+            self.assertGreaterEqual(server.throttled, 1)
+            self.assertGreaterEqual(elapsed, 1.0)
+            self.assertEqual(x.metrics.counter("bing_retries_total", endpoint="locations"), server.throttled)
+            self.assertGreaterEqual(x.ratelimiter.throttled, 1)
+
+    def test_retries_are_bounded(self):
+        with StubBingServer(errorrate=1.0, errorstatus=500) as server:
+            x = BingMapsDTExtract(bingurl=server.url, retries=2, backoff=0.01)
+            self.assertEqual(x.geocodeaddresses(self.keyfile, ["1 Main Street, Paris"]), [None])
+            self.assertEqual(server.requests, 3)
+
+    def test_client_errors_are_not_retried(self):
+        x = self.extractor()
+        self.assertEqual(x.geocodeaddresses(self.keyfile, ["BADREQUEST"]), [None])
+        self.assertEqual(self.server.requests, 1)
+
+    def test_retry_after_in_seconds_or_http_date(self):
+        import email.utils
+        import time
+
+        x = self.extractor()
+        self.assertEqual(x._retryafter({"Retry-After": "3"}), 3.0)
+        self.assertAlmostEqual(x._retryafter({"Retry-After": email.utils.formatdate(time.time() + 30, usegmt=True)}), 30, delta=2)
+        self.assertEqual(x._retryafter({"Retry-After": "soon"}), 0)
+        self.assertEqual(x._retryafter({}), 0)
+
+
+class TestMatrix(_StubTestCase):
+
+    def test_matrix_is_tiled_within_the_cell_limit(self):
+        origins = ["45.0,2.0", "45.1,2.0", "45.2,2.0"]
+        destinations = [(46.0 + j / 1000.0, 3.0) for j in range(1000)]
+
+        x = self.extractor()
+        x.extractmatrixfrombing(self.keyfile, origins, destinations, workers=2)
+
+        # 2 origins x 1000 destinations per request
+        self.assertEqual(x.matrixrequests, 2)
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(x.error_tiles, [])
+        # The stub gives 60 * (origin + destination + 1) seconds, indexes counted in the tile
+        self.assertEqual(x.matrixduration[1, 5], 60.0 * 7)
+        self.assertEqual(x.matrixduration[2, 5], 60.0 * 6)
+
+    def test_rejected_tile_leaves_its_cells_in_error(self):
+        x = self.extractor()
+        x.extractmatrixfrombing(self.keyfile, ["45.0,2.0", "45.1,2.0", "45.2,2.0"], ["46.0,3.0"] * 1000, maxcells=3000)
+
+        self.assertEqual(x.error_tiles, [(0, 0)])
+        x.matrixtoqueries()
+        self.assertEqual(len(x.donequeries), 0)
+        self.assertEqual(len(x.errorqueries), 3000)
+
+    def test_matrix_is_flattened_like_extractdtfrombing(self):
+        x = self.extractor()
+        x.openroutecache(os.path.join(self.folder, "routes.db"))
+        x.extractmatrixfrombing(self.keyfile, ["48.8566,2.3522", "45.764,4.8357"], ["51.5074,-0.1278", "48.8566,2.3522", "43.2965,5.3698"])
+        x.matrixtoqueries()
+
+        self.assertEqual(list(x.donequeries.columns), ['KeyID', 'Source', 'Destination', 'TravelDuration', 'TravelDistance', 'FlightDistance'])
+        self.assertEqual(len(x.donequeries), 6)
+        done = x.donequeries.set_index('KeyID')
+        self.assertEqual(done.loc["45.764,4.8357+43.2965,5.3698", 'TravelDuration'], 60.0 * 4)
+        self.assertAlmostEqual(done.loc["48.8566,2.3522+51.5074,-0.1278", 'FlightDistance'], 343.5, delta=1.0)
+        self.assertEqual(len(x.routecache), 6)
+
+
+class TestGeocodeIndex(_StubTestCase):
+
+    def addresses(self):
+        import pandas as pd
+
+        return pd.Series(["%d Main Street, Paris" % i for i in range(10)])
+
+    def test_second_run_is_answered_by_the_index(self):
+        index = os.path.join(self.folder, "addresses.db")
+
+        x = self.extractor()
+        x.opengeocodeindex(index)
+        x.address = self.addresses()
+        x.extractcoorfrombing_obo(self.keyfile)
+        self.assertEqual(len(x.geocodeindex), 10)
+        requests = self.server.requests
+
+        # Only the centroid of France is requested again: the centroid cache is not shared between instances
+        y = self.extractor()
+        y.opengeocodeindex(index)
+        y.address = self.addresses()
+        y.extractcoorfrombing_obo(self.keyfile)
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertTrue(y.donequeries.equals(x.donequeries))
+        self.assertEqual(y.metrics.counter("geocodeindex_hits_total"), 10)
+
+    def test_index_seeded_from_the_stored_results(self):
+        url = "sqlite:///" + os.path.join(self.folder, "geocoding.db")
+        x = self.extractor()
+        x.address = self.addresses()
+        x.extractcoorfrombing_obo(self.keyfile)
+        x.storequeries(url, None, "Geocoding_done", "Geocoding_error")
+        x.closeengine()
+
+        y = self.extractor()
+        y.opengeocodeindex(os.path.join(self.folder, "addresses.db"))
+        y.seedgeocodeindex(url, None, "SELECT * FROM Geocoding_done")
+        y.closeengine()
+        requests = self.server.requests
+
+        results = y.geocodeaddresses(self.keyfile, list(self.addresses()) + ["10 Main Street, Paris"])
+        # The new address and the centroid of France
+        self.assertEqual(self.server.requests, requests + 2)
+        self.assertEqual([r[0] for r in results[:10]], x.donequeries['Latitude'].tolist())
+        self.assertEqual([r[5] for r in results], ["High"] * 11)
+
+
+class TestMetrics(_StubTestCase):
+
+    def test_requests_and_stages_are_exported_in_json(self):
+        import json
+
+        x = self.extractor()
+        _routequeries(x, 60)
+        x.extractdtfrombing(self.keyfile)
+        file = os.path.join(self.folder, "metrics.json")
+        x.exportmetrics(file)
+
+        with open(file) as f:
+            metrics = json.load(f)
+        requests = [c for c in metrics['counters']['bing_requests_total'] if c['endpoint'] == "routes/driving"]
+        self.assertEqual(requests, [{'endpoint': "routes/driving", 'status': "200", 'value': 5}])
+        latency = metrics['histograms']['bing_request_seconds'][0]
+        self.assertEqual(latency['count'], 5)
+        self.assertLessEqual(latency['p50'], latency['p99'])
+        self.assertLessEqual(latency['p99'], latency['max'])
+        self.assertEqual([h['count'] for h in metrics['histograms']['stage_seconds'] if h['stage'] == "extractdtfrombing"], [1])
+
+    def test_prometheus_text_format(self):
+        from BingDistanceTimeExtract import BingQuotaExceeded
+
+        x = self.extractor(dailyquota=2)
+        _routequeries(x, 60)
+        with self.assertRaises(BingQuotaExceeded):
+            x.extractdtfrombing(self.keyfile)
+        lines = x.exportmetrics(format="prometheus").splitlines()
+
+        self.assertIn("# TYPE bing_requests_total counter", lines)
+        self.assertIn('bing_requests_total{endpoint="routes/driving",status="200"} 2', lines)
+        # The stage stopped by the quota is counted as an error
+        self.assertIn('stage_errors_total{stage="extractdtfrombing"} 1', lines)
+        # Cumulative buckets, the last one holds every observation
+        buckets = [int(line.split()[-1]) for line in lines if line.startswith('bing_request_seconds_bucket{endpoint="routes/driving"')]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertIn('bing_request_seconds_bucket{endpoint="routes/driving",le="+Inf"} 2', lines)
+        self.assertIn('bing_request_seconds_count{endpoint="routes/driving"} 2', lines)
+
+        with self.assertRaises(ValueError):
+            x.exportmetrics(format="csv")
+
+    def test_quantiles_are_interpolated_in_the_buckets(self):
+        from BingDistanceTimeExtract import _Metrics
+
+        metrics = _Metrics()
+        for seconds in [0.02] * 90 + [0.2] * 10:
+            metrics.observe("latency", seconds)
+        histogram = metrics.histograms["latency"][()]
+
+        # 90 observations in ]0.01, 0.025], 10 in ]0.1, 0.25] capped by the largest one
+        self.assertTrue(0.01 < metrics.quantile(histogram, 0.5) <= 0.025)
+        self.assertTrue(0.1 < metrics.quantile(histogram, 0.99) <= 0.2)
+        self.assertEqual(metrics.histogram("latency"), (sum([0.02] * 90 + [0.2] * 10), 100))
+
+
+class TestReplay(_StubTestCase):
+
+    def test_recorded_answers_are_replayed(self):
+        import json
+        import pandas as pd
+        from BingBenchmark import recordbing
+
+        file = os.path.join(self.folder, "recordings.json")
+        recordbing(file, self.keyfile, [("10 Main Street, Paris", "Gare de Lyon, Paris")], ["10 Main Street, Paris"], bingurl=self.server.url)
+
+        with open(file) as f:
+            recordings = json.load(f)
+        self.assertEqual((len(recordings["routes"]), len(recordings["locations"])), (1, 1))
+        recordings["routes"][0]["routeLegs"][0]["travelDuration"] = 1234
+        recordings["locations"][0]["point"]["coordinates"] = [45.764, 4.8357]
+        with open(file, "w") as f:
+            json.dump(recordings, f)
+
+        with StubBingServer(recordings=file) as server:
+            x = BingMapsDTExtract(bingurl=server.url)
+            _routequeries(x, 24)
+            x.extractdtfrombing(self.keyfile)
+            self.assertEqual(set(x.donequeries['TravelDuration']), {1234.0})
+
+            x.address = pd.Series(["1 Main Street, Paris", "2 Main Street, Paris"])
+            x.extractcoorfrombing_obo(self.keyfile)
+            self.assertEqual(x.donequeries['Latitude'].tolist(), [45.764, 45.764])
+            self.assertGreater(server.httpd.replayed, 0)
+
+    def test_scenarios_are_compared_with_the_history(self):
+        import json
+        from BingBenchmark import run_scenarios
+
+        history = os.path.join(self.folder, "history.jsonl")
+        first = run_scenarios(sizes=[200], scenarios=["cleanqueries", "extractcoorfrombing_obo"], history=history, maxhttprows=100)
+
+        # The scenario sending one request per row is skipped above maxhttprows
+        self.assertEqual([(r["scenario"], r["rows"], r["regressions"]) for r in first], [("cleanqueries", 200, [])])
+
+        # A previous run 1000 times faster and using no memory: both regressions are flagged
+        with open(history) as f:
+            entry = json.loads(f.readline())
+        entry["rowspersecond"] *= 1000
+        entry["peakmb"] = 0.0
+        with open(history, "w") as f:
+            f.write(json.dumps(entry) + "\n")
+
+        second = run_scenarios(sizes=[200], scenarios=["cleanqueries"], history=history)
+        self.assertEqual([flag.split()[:2] for flag in second[0]["regressions"]], [["THROUGHPUT", "REGRESSION"], ["MEMORY", "REGRESSION"]])
+        with open(history) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+
+class TestCommandLine(_StubTestCase):
+
+    def setUp(self):
+        import pandas as pd
+        import sqlalchemy
+
+        _StubTestCase.setUp(self)
+        self.url = "sqlite:///" + os.path.join(self.folder, "batch.db")
+        engine = sqlalchemy.create_engine(self.url)
+        pd.DataFrame({'Source': ["Source %d" % i for i in range(60)], 'Destination': ["Destination %d" % i for i in range(60)]}).to_sql("new", con=engine, index=False)
+        engine.dispose()
+
+    def command(self, *argv):
+        from BingDistanceTimeExtract import main
+
+        main(list(argv) + ["--server", self.url, "--done", "Routes_done", "--errors", "Routes_error", "--shards", "3"])
+
+    def shard(self, shard, *options):
+        self.command("run", "--key", self.keyfile, "--query", "SELECT Source, Destination FROM new", "--bingurl", self.server.url, "--shard", str(shard), *options)
+
+    def tables(self):
+        import sqlalchemy
+
+        engine = sqlalchemy.create_engine(self.url)
+        try:
+            return sorted(sqlalchemy.inspect(engine).get_table_names())
+        finally:
+            engine.dispose()
+
+    def test_shards_route_the_whole_batch_once_and_are_merged(self):
+        import json
+        import pandas as pd
+        import sqlalchemy
+
+        metrics = os.path.join(self.folder, "shard0.json")
+        self.shard(0, "--metrics", metrics)
+        self.shard(1)
+        self.shard(2)
+        self.assertEqual(self.tables(), ["Routes_done_shard0of3", "Routes_done_shard1of3", "Routes_done_shard2of3",
+                                         "Routes_error_shard0of3", "Routes_error_shard1of3", "Routes_error_shard2of3", "new"])
+        with open(metrics) as f:
+            self.assertIn("bing_requests_total", json.load(f)['counters'])
+
+        self.command("merge")
+        self.assertEqual(self.tables(), ["Routes_done", "Routes_error", "new"])
+        engine = sqlalchemy.create_engine(self.url)
+        done = pd.read_sql("SELECT * FROM Routes_done", con=engine)
+        engine.dispose()
+        self.assertEqual(len(done), 60)
+        self.assertEqual(done['KeyID'].nunique(), 60)
+
+    def test_merge_upsert_does_not_duplicate_a_shard_run_twice(self):
+        import pandas as pd
+        import sqlalchemy
+
+        for shard in range(3):
+            self.shard(shard)
+        self.command("merge", "--upsert")
+        self.shard(1)
+        self.command("merge", "--upsert")
+
+        engine = sqlalchemy.create_engine(self.url)
+        self.assertEqual(pd.read_sql("SELECT COUNT(*) AS n FROM Routes_done", con=engine)['n'][0], 60)
+        engine.dispose()
+
+    def test_shard_out_of_range_is_refused(self):
+        import contextlib
+        import io
+
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+            self.shard(3)
+
+    def test_reverse_couples_fall_in_the_same_shard(self):
+        import pandas as pd
+
+        x = self.extractor()
+        couples = pd.DataFrame({'Source': ["A%d" % i for i in range(30)] + ["B%d" % i for i in range(30)],
+                                'Destination': ["B%d" % i for i in range(30)] + ["A%d" % i for i in range(30)]})
+        selected = []
+        for shard in range(3):
+            x._setnewqueries(couples)
+            x.selectshard(shard, 3, unordered=True)
+            selected.append(set(x.new['NewSource'] + ">" + x.new['NewDestination']))
+
+        self.assertEqual(sum(len(s) for s in selected), 60)
+        for s in selected:
+            self.assertEqual(s, {b + ">" + a for a, b in (c.split(">") for c in s)})
+
+
+class TestStartup(_StubTestCase):
+
+    def test_core_path_does_not_load_the_heavy_modules(self):
+        import ast
+        import subprocess
+        import sys
+        from BingBenchmark import _STARTUP
+
+        folder = os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.run([sys.executable, "-c", _STARTUP, self.server.url, self.keyfile], cwd=folder, capture_output=True, text=True, check=True).stdout
+
+        # The report of geocodeaddresses() and the measures, no banner in a non interactive process
+        self.assertEqual(len(output.strip().splitlines()), 2)
+        self.assertIn("1 addresses geocoded with 1 requests, 0 errors", output)
+        self.assertEqual(ast.literal_eval(output.strip().splitlines()[-1])[3], [])
+
+
+class TestPayload(_StubTestCase):
+
+    def test_minimal_answers_give_the_same_results(self):
+        done = {}
+        decoded = {}
+        for options in (BingMapsDTExtract.ROUTEOPTIONS, ""):
+            x = self.extractor()
+            x.ROUTEOPTIONS = options
+            _routequeries(x, 24)
+            x.extractdtfrombing(self.keyfile)
+            done[options] = x.donequeries
+            decoded[options] = x.bytesperbatch
+
+        # Without the itinerary the answer is more than 10 times smaller
+        self.assertTrue(done[""].equals(done[BingMapsDTExtract.ROUTEOPTIONS]))
+        self.assertLess(decoded[BingMapsDTExtract.ROUTEOPTIONS] * 10, decoded[""])
+
+    def test_one_location_per_answer(self):
+        decoded = {}
+        for options in (BingMapsDTExtract.LOCATIONOPTIONS, ""):
+            x = self.extractor()
+            x.LOCATIONOPTIONS = options
+            self.assertEqual(x.geocodeaddresses(self.keyfile, ["1 Main Street, Paris"]).count(None), 0)
+            decoded[options] = x.metrics.counter("bing_response_bytes_total", endpoint="locations")
+
+        # Bing sends 5 candidates by default
+        self.assertLess(decoded[BingMapsDTExtract.LOCATIONOPTIONS] * 4, decoded[""])
+
+    def test_json_decoder(self):
+        import importlib.util
+        import json
+
+        x = self.extractor(fastjson=False)
+        x.geocodeaddresses(self.keyfile, ["1 Main Street, Paris"])
+        self.assertIs(x.jsonloads, json.loads)
+
+        y = self.extractor()
+        self.assertEqual(y.geocodeaddresses(self.keyfile, ["1 Main Street, Paris"]), x.geocodeaddresses(self.keyfile, ["1 Main Street, Paris"]))
+        if importlib.util.find_spec("orjson") is not None:
+            import orjson
+            self.assertIs(y.jsonloads, orjson.loads)
+        self.assertGreater(y.metrics.histogram("bing_parse_seconds", endpoint="locations")[1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()